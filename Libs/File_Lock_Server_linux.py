@@ -1,15 +1,35 @@
 import os, sys, json
+import argparse
 import subprocess
 import socket
-from datetime import datetime
+import signal
+import logging
+import threading
+import time
+import struct
+import itertools
+from contextlib import contextmanager
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, Response, jsonify
+from lock_log_writer import LogWriter, TraceWriter
+from lock_range_index import RangeIndex, LockBusy, SHARED, EXCLUSIVE, EOF_END, range_start, range_end, \
+    expand_range_spec
+from lock_wait_queue import WaitQueue
+from lock_fd_table import FdTable
+from lock_owner_pool import OwnerPool
+from lock_mount_table import MountTable
+from lock_metrics import Registry, Counter, Gauge, Histogram, SIZE_BUCKETS, \
+    timed_syscall, syscall_start, syscall_add, syscall_total
 
 Log_file = '/opt/data/log/app_' + socket.gethostname() + '.log'
+log_writer = LogWriter(Log_file)
 
-def write_log(log):
-    with open(Log_file, 'a') as f:
-        f.write(datetime.now().strftime('[%d-%m-%y%H:%M:%S:%f]') + str(log) + '\n')
-        f.flush()
+def write_log(log, level=logging.INFO):
+    log_writer.write(log, level)
 
 if 'win' in sys.platform:
     # Below is windows based File Locking
@@ -35,182 +55,982 @@ else:
     import fcntl
 
     def _lockFilePosix(f, op=fcntl.LOCK_EX|fcntl.LOCK_NB, offset=0, length=0):
-        fcntl.lockf(f, op, length, offset, 0)
+        with timed_syscall():
+            fcntl.lockf(f, op, length, offset, 0)
 
     def _unlockFilePosix(f, offset=0, length=0):
-        fcntl.lockf(f, fcntl.LOCK_UN, length, offset)
+        with timed_syscall():
+            fcntl.lockf(f, fcntl.LOCK_UN, length, offset)
+
+    # Linux open file description locks: owned by the opened handle instead
+    # of the process, so two handles of this server conflict like two
+    # processes would, and the kernel can be asked who holds a range
+    F_OFD_GETLK = getattr(fcntl, 'F_OFD_GETLK', 36)
+    F_OFD_SETLK = getattr(fcntl, 'F_OFD_SETLK', 37)
+    F_OFD_SETLKW = getattr(fcntl, 'F_OFD_SETLKW', 38)
+    # struct flock: l_type, l_whence, l_start, l_len, l_pid (must be 0 for OFD)
+    FLOCK = struct.Struct('hhqqi4x')
+
+    def _flock(op, offset, length):
+        l_type = fcntl.F_WRLCK if op & fcntl.LOCK_EX else fcntl.F_RDLCK
+        return FLOCK.pack(l_type, os.SEEK_SET, int(offset), int(length), 0)
+
+    def _lockFileOfd(f, op=fcntl.LOCK_EX|fcntl.LOCK_NB, offset=0, length=0):
+        with timed_syscall():
+            fcntl.fcntl(f, F_OFD_SETLK if op & fcntl.LOCK_NB else F_OFD_SETLKW,
+                        _flock(op, offset, length))
+
+    def _unlockFileOfd(f, offset=0, length=0):
+        with timed_syscall():
+            fcntl.fcntl(f, F_OFD_SETLK, FLOCK.pack(fcntl.F_UNLCK, os.SEEK_SET, int(offset), int(length), 0))
+
+    def _getLockOfd(f, op=fcntl.LOCK_EX, offset=0, length=0):
+        """
+        Return:
+            None when the range could be locked with op, else (l_type, l_start,
+            l_len, l_pid) of one conflicting lock, l_pid is -1 for OFD locks
+        """
+        with timed_syscall():
+            result = fcntl.fcntl(f, F_OFD_GETLK, _flock(op, offset, length))
+        l_type, _, l_start, l_len, l_pid = FLOCK.unpack(result)
+        if l_type == fcntl.F_UNLCK:
+            return None
+        return l_type, l_start, l_len, l_pid
+
+    # lock type of a handle -> (lock, unlock)
+    lock_calls = {'posix': (_lockFilePosix, _unlockFilePosix),
+                  'ofd': (_lockFileOfd, _unlockFileOfd)}
+    default_lock_type = 'posix'
 
-    records = dict()
     lock_op = {1: fcntl.LOCK_SH,
                2: fcntl.LOCK_EX,
                5: fcntl.LOCK_SH | fcntl.LOCK_NB,
                6: fcntl.LOCK_EX | fcntl.LOCK_NB}
+    lock_mode = {1: SHARED, 2: EXCLUSIVE, 5: SHARED, 6: EXCLUSIVE}
+    # granted ranges per file and fd, see lock_range_index.py
+    range_index = RangeIndex()
+    # The kernel sees every posix handle of this server as one owner and
+    # merges their locks. --refuse-posix-overlap refuses such a lock with
+    # LockBusy instead; the index check and a reservation of the range are
+    # one step, striped by path, and lockf runs outside the stripe with the
+    # range held in pending_grants so a blocking lockf holds up nobody else.
+    refuse_posix_overlap = False
+    grant_locks = [threading.Lock() for _ in range(64)]
+    pending_grants = {}
+
+    def _pending_conflicts(path, handle, start, end, mode):
+        return [{'fd': fd, 'offset': p_start, 'length': 0 if p_end == EOF_END else p_end - p_start, 'mode': p_mode}
+                for fd, p_start, p_end, p_mode in pending_grants.get(path, ())
+                if fd != handle and p_start < end and start < p_end
+                and (mode == EXCLUSIVE or p_mode == EXCLUSIVE)]
+
+    def _grant(entry, op, offset, length):
+        """
+        Lock a range of an open handle and record it in the index
+
+        Return:
+            ranges of other posix handles of this server the lock overlaps,
+            the kernel merged them; with --refuse-posix-overlap these raise
+            LockBusy instead
+        """
+        lock_range = lock_calls[entry.lock_type][0]
+        mode = lock_mode.get(op, EXCLUSIVE)
+        if entry.lock_type != 'posix':
+            lock_range(entry.fd, op=op, length=length, offset=offset)
+            range_index.add(entry.handle, offset, length, mode)
+            return []
+        path = range_index.path_of(entry.handle)
+        if not refuse_posix_overlap:
+            conflicts = range_index.conflicts(path, offset, length, mode, fd=entry.handle)
+            lock_range(entry.fd, op=op, length=length, offset=offset)
+            range_index.add(entry.handle, offset, length, mode)
+            return conflicts
+        reservation = (entry.handle, range_start(offset, length), range_end(offset, length), mode)
+        stripe = grant_locks[hash(path) % len(grant_locks)]
+        with stripe:
+            conflicts = range_index.conflicts(path, offset, length, mode, fd=entry.handle)
+            conflicts += _pending_conflicts(path, *reservation)
+            if conflicts:
+                raise LockBusy(conflicts, blocking=not op & fcntl.LOCK_NB)
+            pending_grants.setdefault(path, []).append(reservation)
+        try:
+            lock_range(entry.fd, op=op, length=length, offset=offset)
+            range_index.add(entry.handle, offset, length, mode)
+        finally:
+            with stripe:
+                pending = pending_grants[path]
+                pending.remove(reservation)
+                if not pending:
+                    del pending_grants[path]
+        return []
 
-    def mount_nfs(**kwargs):
-        cmd = 'mount -t nfs %s:%s %s'%(kwargs['serverIp'],
-                                       kwargs['fsPath'],
-                                       kwargs['mountPath'])
-        if len(kwargs) > 3:
-            if kwargs['mountVersion'] or kwargs['vers']:
-                cmd += ' -o vers=%s'%(kwargs['vers']|kwargs['mountVersion'])
-            if kwargs['minorversion']:
-                cmd += ' -o minorversion=%s'%(kwargs['minorversion'])
-        # TODO :: need to add more options
-        try:
-            result = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-            if result is None or result == "":
-                return json.dumps({'cmd':cmd, 'result':'success'})
-            return json.dumps({'cmd':cmd, 'result':result})
+    def _release(entry):
+        # the kernel dropped the locks of the closed fd, drop them here too
+        range_index.untrack(entry.handle)
+        waitq.drop_fd(entry.handle)
+        waitq.notify()
+
+    # open handles by client session, see lock_fd_table.py. Clients get the
+    # handle as 'fd', it is translated to the kernel fd before every call.
+    fd_table = FdTable(on_close=_release)
+
+    # Every op below takes the request parameters as one dict, fills in the
+    # result fields in place and returns that same dict. This keeps the
+    # /multi_cmd contract (results read back from 'para') and lets every
+    # server engine share one implementation.
+
+    # current mounts, see lock_mount_table.py
+    mount_table = MountTable()
+
+    def _mount_para(cmd, *names):
+        # pyLock sends mount_ip/export_path/mount_path/mount_vers,
+        # older callers serverIp/fsPath/mountPath/vers
+        for name in names:
+            if cmd.get(name) not in (None, '', 'None'):
+                return str(cmd[name])
+        return None
+
+    def _same_mount(entry, source, vers, minorversion):
+        if entry.source.rstrip('/') != source.rstrip('/'):
+            return False
+        if vers:
+            expected = vers + ('.' + minorversion if minorversion else '')
+            mounted = entry.option('vers') or ''
+            # vers=4 accepts whatever minor version the server negotiated
+            return mounted == expected or (not minorversion and mounted.startswith(expected + '.'))
+        return True
+
+    def mount_nfs(cmd):
+        """
+        Mount an NFS export unless it is mounted there already
+
+        Args (in cmd):
+            mount_ip, export_path, mount_path :: export to mount and where
+            mount_vers, minorversion, timeo, retry :: optional mount options
+        """
+        try:
+            server = _mount_para(cmd, 'mount_ip', 'serverIp')
+            export = _mount_para(cmd, 'export_path', 'fsPath')
+            mount_path = _mount_para(cmd, 'mount_path', 'mountPath')
+            if not (server and export and mount_path):
+                raise Exception('mount needs mount_ip, export_path and mount_path')
+            vers = _mount_para(cmd, 'mount_vers', 'vers', 'mountVersion')
+            minorversion = _mount_para(cmd, 'minorversion')
+            source = '%s:%s'%(server, export)
+            current = mount_table.get(mount_path)
+            if current is not None:
+                if _same_mount(current, source, vers, minorversion):
+                    cmd['result'] = 'success'
+                    cmd['cached'] = True
+                    return cmd
+                raise Exception('%s is already mounted from %s (%s %s)'%(
+                    mount_path, current.source, current.fstype, current.super_options))
+            options = []
+            if vers:
+                options.append('vers=%s'%vers)
+            if minorversion:
+                options.append('minorversion=%s'%minorversion)
+            for name in ('timeo', 'retry'):
+                if _mount_para(cmd, name):
+                    options.append('%s=%s'%(name, cmd[name]))
+            mount = ['mount', '-t', 'nfs'] + (['-o', ','.join(options)] if options else []) + [source, mount_path]
+            cmd['cmd'] = ' '.join(mount)
+            try:
+                with timed_syscall():
+                    result = subprocess.check_output(mount, stderr=subprocess.STDOUT)
+            finally:
+                mount_table.invalidate()
+            if result is None or result == "" or result == b"":
+                cmd['result'] = 'success'
+            else:
+                cmd['result'] = result.decode() if isinstance(result, bytes) else result
         except subprocess.CalledProcessError as e:
-            return json.dumps({'cmd':e.cmd, 'result':'failed', 'reason':e.output})
+            cmd['result'] = 'failed'
+            cmd['reason'] = e.output.decode() if isinstance(e.output, bytes) else e.output
         except Exception as e:
-            return json.dumps({'cmd':kwargs, 'result':'failed', 'reason':e.message})
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+        return cmd
+
+    def unmount_nfs(cmd):
+        """
+        Lazily unmount 'mount_path', nothing to do when it is not mounted
 
-    def unmount_nfs(**kwargs):
+        The path is never stat'ed here, unmount is what gets called when the
+        NFS server hangs. Only a mount point listed as written is known to be
+        mounted, anything else is left to umount.
+        """
         try:
-            cmd = 'umount -lf %s'%(kwargs['mountPath'])
+            mount_path = _mount_para(cmd, 'mount_path', 'mountPath')
+            if not mount_path:
+                raise Exception('unmount needs mount_path')
+            mounted = mount_table.get(mount_path, resolve=False) is not None
+            umount = ['umount', '-lf', mount_path]
+            cmd['cmd'] = ' '.join(umount)
             try:
-                result = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-                if result is None or result == "":
-                    return json.dumps({'cmd': cmd, 'result': 'success'})
-                return json.dumps({'cmd': cmd, 'result': result})
-            except subprocess.CalledProcessError as e:
-                return json.dumps({'cmd': e.cmd, 'result': 'failed', 'reason': e.output})
+                with timed_syscall():
+                    result = subprocess.check_output(umount, stderr=subprocess.STDOUT)
+            finally:
+                mount_table.invalidate()
+            if result is None or result == "" or result == b"":
+                cmd['result'] = 'success'
+            else:
+                cmd['result'] = result.decode() if isinstance(result, bytes) else result
+        except subprocess.CalledProcessError as e:
+            output = e.output.decode() if isinstance(e.output, bytes) else e.output
+            if not mounted and 'not mounted' in (output or ''):
+                cmd['result'] = 'success'
+                cmd['cached'] = True
+                return cmd
+            cmd['result'] = 'failed'
+            cmd['reason'] = output
+        except Exception as e:
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+        return cmd
+
+    mount_workers = 16
+
+    def mount_batch(cmd):
+        """
+        Mount or unmount many exports concurrently, one result per item
+
+        Args (in cmd):
+            mounts (list) :: mount_nfs parameters per item, an item with
+                             'cmd': 'unmount' is unmounted instead
+            parallel (int) :: concurrent mount commands, default --mount-workers
+
+        Items of one mount path run in request order, each item gets its
+        own 'result'/'reason', cmd gets 'passed' and 'failed' counts.
+        """
+        try:
+            groups = {}
+            for item in cmd['mounts']:
+                key = _mount_para(item, 'mount_path', 'mountPath')
+                groups.setdefault(key, []).append(item)
+
+            def run(items):
+                for item in items:
+                    if item.get('cmd') == 'unmount':
+                        unmount_nfs(item)
+                    else:
+                        mount_nfs(item)
+
+            workers = min(int(cmd.get('parallel') or mount_workers), len(groups)) or 1
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run, groups.values()))
+            cmd['failed'] = sum(1 for item in cmd['mounts'] if item.get('result') == 'failed')
+            cmd['passed'] = len(cmd['mounts']) - cmd['failed']
+            cmd['result'] = 'success'
         except Exception as e:
-            return json.dumps({'cmd': kwargs, 'result': 'failed', 'reason': e.message})
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+        return cmd
 
-    def open_file(**kwargs):
+    def list_mounts(cmd):
+        """
+        NFS mounts of this host from the cached mount table, all mounts with 'all'
+        """
+        show_all = str(cmd.get('all', '')).lower() in ('1', 'true')
+        cmd['mounts'] = [entry.to_dict() for _, entry in sorted(mount_table.snapshot().items())
+                         if show_all or entry.fstype.startswith('nfs')]
+        cmd['result'] = 'success'
+        return cmd
+
+    def open_file(cmd):
         try:
-            fh = open(kwargs['file_path'], kwargs['mode'])
-            fd = fh.fileno()
-            records[fd] = fh
-            kwargs['fd'] = fd
-            kwargs['mode'] = fh.mode
-            return json.dumps(kwargs)
+            lock_type = cmd.get('lock_type') or default_lock_type
+            if lock_type not in lock_calls:
+                raise Exception('Invalid lock_type: %s'%lock_type)
+            with timed_syscall():
+                entry = fd_table.open(cmd['file_path'], cmd['mode'], cmd.get('session') or None,
+                                      lock_type=lock_type)
+            range_index.track(entry.handle, cmd['file_path'], process=lock_type == 'posix')
+            cmd['fd'] = entry.handle
+            cmd['lock_type'] = lock_type
+            return cmd
         except Exception as e:
-            kwargs['result'] = 'failed'
-            kwargs['reason'] = str(e)
-            return json.dumps(kwargs)
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+            return cmd
+
+    def _apply_range_spec(cmd, apply):
+        """
+        Run apply(offset, length) over the ranges of cmd['range_spec'] and
+        report counts plus only the failing ranges, at most
+        range_spec['max_failures'] (default 100) of them
+        """
+        spec = cmd['range_spec']
+        limit = int(spec.get('max_failures', 100))
+        passed = failed = 0
+        failures = []
+        for offset, length in expand_range_spec(spec):
+            try:
+                apply(offset, length)
+                passed += 1
+            except Exception as e:
+                failed += 1
+                if len(failures) < limit:
+                    failures.append({'offset':offset, 'length':length, 'reason':str(e)})
+        cmd['passed'] = passed
+        cmd['failed'] = failed
+        cmd['failures'] = failures
 
     def lock_file(cmd):
         try:
-            fh = records[int(str(cmd['fd']))]
-            write_log(str(fh))
-            if fh.closed:
-                raise Exception('Invalied FD')
-            if 'lock_list' in cmd:
-                passed=failed=0
-                for lock in cmd['lock_list']:
-                    try:
-                        _lockFilePosix(cmd['fd'],
-                                       op=cmd['op'],
-                                       length=lock['length'],
-                                       offset=lock['offset'])
-                        lock['status'] = 'success'
-                        passed += 1
-                    except Exception as e:
-                        failed += 1
-                        lock['status'] = 'failed'
-                        lock['reason'] = str(e)
-                cmd['passed'] = passed
-                cmd['failed'] = failed
-            else:
-                _lockFilePosix(int(cmd['fd']),
-                               op=int(cmd['op']),
-                               length=int(cmd['length']),
-                               offset=int(cmd['offset']))
-                cmd['result'] = 'success'
-            return json.dumps(cmd)
+            with _entry(int(str(cmd['fd']))) as entry:
+                op = int(cmd['op'])
+                if 'range_spec' in cmd:
+                    _apply_range_spec(cmd, lambda offset, length: _grant(entry, op, offset, length))
+                elif 'lock_list' in cmd:
+                    passed=failed=0
+                    for lock in cmd['lock_list']:
+                        try:
+                            overlaps = _grant(entry, op, lock['offset'], lock['length'])
+                            if overlaps:
+                                lock['conflicts'] = overlaps
+                            lock['status'] = 'success'
+                            passed += 1
+                        except Exception as e:
+                            failed += 1
+                            lock['status'] = 'failed'
+                            lock['reason'] = str(e)
+                    cmd['passed'] = passed
+                    cmd['failed'] = failed
+                else:
+                    overlaps = _grant(entry, op, int(cmd['offset']), int(cmd['length']))
+                    if overlaps:
+                        cmd['conflicts'] = overlaps
+                    cmd['result'] = 'success'
+            return cmd
         except Exception as e:
             cmd['result'] = 'failed'
             cmd['reason'] = str(e)
-            return json.dumps(cmd)
+            return cmd
 
     def unlock_file(cmd):
         try:
-            fh=records[int(cmd['fd'])]
-            write_log(str(fh))
-            if fh.closed:
-                raise Exception('Invalid FD')
-            if 'lock_list' in cmd:
-                passed = failed = 0
-                for lock in cmd['lock_list']:
-                    try:
-                        _unlockFilePosix(cmd['fd'],
+            handle = int(cmd['fd'])
+            with _entry(handle) as entry:
+                fd, unlock_range = entry.fd, lock_calls[entry.lock_type][1]
+                if 'range_spec' in cmd:
+                    def apply(offset, length):
+                        unlock_range(fd, length=length, offset=offset)
+                        range_index.remove(handle, offset, length)
+                    _apply_range_spec(cmd, apply)
+                elif 'lock_list' in cmd:
+                    passed = failed = 0
+                    for lock in cmd['lock_list']:
+                        try:
+                            unlock_range(fd,
                                          length=lock['length'],
                                          offset=lock['offset'])
-                        lock['status']='success'
-                        passed += 1
-                    except Exception as e:
-                        failed += 1
-                        lock['status']='failed'
-                        lock['reason']=str(e)
-                cmd['passed']=passed
-                cmd['failed']=failed
-            else:
-                _unlockFilePosix(int(cmd['fd']),
+                            range_index.remove(handle, lock['offset'], lock['length'])
+                            lock['status']='success'
+                            passed += 1
+                        except Exception as e:
+                            failed += 1
+                            lock['status']='failed'
+                            lock['reason']=str(e)
+                    cmd['passed']=passed
+                    cmd['failed']=failed
+                else:
+                    unlock_range(fd,
                                  length=int(cmd['length']),
                                  offset=int(cmd['offset']))
-                cmd['result']='success'
-            return json.dumps(cmd)
+                    range_index.remove(handle, cmd['offset'], cmd['length'])
+                    cmd['result']='success'
+            waitq.notify()
+            return cmd
         except Exception as e:
-            return json.dumps({'cmd':cmd, 'result':'failed', 'reason':str(e)})
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+            return cmd
 
-    def close_file(**kwargs):
+    def close_file(cmd):
         try:
-            fd=int(kwargs['fd'])
-            if fd in records:
-                fh=records.pop(fd)
-                fh.close()
-                kwargs['result']='success'
-                return json.dumps(kwargs)
+            handle=int(cmd['fd'])
+            if handle in fd_table:
+                with timed_syscall():
+                    fd_table.close(handle)
+                cmd['result']='success'
+                return cmd
             else:
-                kwargs['result']='failed'
-                kwargs['reason']='Bad Fd'
-                return json.dumps(kwargs)
+                cmd['result']='failed'
+                cmd['reason']='Bad Fd'
+                return cmd
         except Exception as e:
-            kwargs['result'] = 'failed'
-            kwargs['reason'] = str(e)
-            return json.dumps(kwargs)
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+            return cmd
+
+    def close_session(cmd):
+        """
+        Close every handle opened with this 'session', e.g. when a test ends
+        or crashed without cleaning up
+        """
+        try:
+            with timed_syscall():
+                closed = fd_table.close_session(cmd['session'])
+            cmd['closed'] = len(closed)
+            cmd['result'] = 'success'
+        except Exception as e:
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+        return cmd
+
+    def list_sessions(cmd):
+        cmd['sessions'] = fd_table.session_info()
+        cmd['result'] = 'success'
+        return cmd
+
+    @contextmanager
+    def _entry(handle):
+        # the handle's fd stays open until the op is done, even when another
+        # thread closes the handle meanwhile
+        try:
+            entry = fd_table.get(handle)
+        except KeyError:
+            raise Exception('Bad Fd')
+        try:
+            write_log(entry.path, logging.DEBUG)
+            yield entry
+        finally:
+            fd_table.release(entry)
+
+    def _index_path(cmd):
+        if cmd.get('file_path'):
+            return cmd['file_path']
+        path = range_index.path_of(int(cmd['fd']))
+        if path is None:
+            raise Exception('Bad Fd')
+        return path
+
+    def list_locks(cmd):
+        """
+        Ranges granted through this server on a file, by 'file_path' or 'fd'
+        """
+        try:
+            cmd['locks'] = range_index.holders(_index_path(cmd))
+            cmd['result'] = 'success'
+        except Exception as e:
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+        return cmd
+
+    def test_lock(cmd):
+        """
+        Check a range against the index without calling into the kernel.
+        With 'fd' given, ranges held by that fd itself never conflict.
+        """
+        try:
+            fd = int(cmd['fd']) if 'fd' in cmd else None
+            mode = lock_mode.get(int(cmd.get('op', 6)), EXCLUSIVE)
+            conflicts = range_index.conflicts(_index_path(cmd), cmd.get('offset', 0),
+                                              cmd.get('length', 0), mode, fd=fd)
+            cmd['conflicts'] = conflicts
+            cmd['conflict'] = bool(conflicts)
+            cmd['result'] = 'success'
+        except Exception as e:
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+        return cmd
+
+    def get_lock(cmd):
+        """
+        Ask the kernel (F_OFD_GETLK) whether 'fd' could lock a range with
+        'op'. Unlike test_lock this sees every lock on the file, including
+        those of other hosts and processes. Works for posix and ofd handles,
+        a posix handle also conflicts with locks of this server itself.
+        """
+        try:
+            with _entry(int(cmd['fd'])) as entry:
+                holder = _getLockOfd(entry.fd, int(cmd.get('op', 6)),
+                                     cmd.get('offset', 0), cmd.get('length', 0))
+                cmd['conflict'] = holder is not None
+                if holder is not None:
+                    l_type, l_start, l_len, l_pid = holder
+                    cmd['holder'] = {'mode': EXCLUSIVE if l_type == fcntl.F_WRLCK else SHARED,
+                                     'offset': l_start, 'length': l_len, 'pid': l_pid}
+            cmd['result'] = 'success'
+        except Exception as e:
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+        return cmd
+
+    def _try_waiter(waiter):
+        try:
+            with _entry(waiter.fd) as entry:
+                _grant(entry, waiter.op | fcntl.LOCK_NB, waiter.offset, waiter.length)
+        except LockBusy:
+            # held through this server, the unlock or close notifies the queue
+            return False
+
+    waitq = WaitQueue(_try_waiter, lambda offset, length: (range_start(offset, length),
+                                                           range_end(offset, length)))
+
+    def _wait_result(cmd, status):
+        cmd.update(status)
+        if status['state'] == 'granted':
+            cmd['result'] = 'success'
+        elif status['state'] == 'waiting':
+            cmd['result'] = 'waiting'
+        else:
+            cmd['result'] = 'failed'
+        return cmd
+
+    def lock_wait(cmd):
+        """
+        Queue a lock request and return a ticket instead of blocking or spinning
+
+        Args (in cmd):
+            fd, op, offset, length :: as for lock_file, ops 1/2 and 5/6 behave alike
+            wait (float) :: seconds the request may stay queued, default 60
+            poll (float) :: seconds to long poll before answering, default 0
+        """
+        try:
+            fd = int(cmd['fd'])
+            path = range_index.path_of(fd)
+            if fd not in fd_table or path is None:
+                raise Exception('Bad Fd')
+            waiter = waitq.enqueue(fd, path, int(cmd['op']) & ~fcntl.LOCK_NB,
+                                   int(cmd.get('offset', 0)), int(cmd.get('length', 0)),
+                                   float(cmd.get('wait', 60)))
+            return _wait_result(cmd, waitq.wait(waiter.ticket, float(cmd.get('poll', 0))))
+        except Exception as e:
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+            return cmd
+
+    def wait_status(cmd):
+        """
+        Long poll a lock_wait ticket for up to 'poll' seconds
+        """
+        try:
+            return _wait_result(cmd, waitq.wait(cmd['ticket'], float(cmd.get('poll', 0))))
+        except Exception as e:
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+            return cmd
+
+    def wait_cancel(cmd):
+        try:
+            return _wait_result(cmd, waitq.cancel(cmd['ticket']))
+        except Exception as e:
+            cmd['result'] = 'failed'
+            cmd['reason'] = str(e)
+            return cmd
+
+    def wait_stats(cmd):
+        cmd['stats'] = waitq.stats()
+        cmd['result'] = 'success'
+        return cmd
 
     op_map = {'open_file':open_file, 'lock_file':lock_file, 'unlock_file':unlock_file, 'close_file':close_file,
-              'mount':mount_nfs, 'unmount':unmount_nfs}
-    app = Flask(__name__)
+              'mount':mount_nfs, 'unmount':unmount_nfs, 'mount_batch':mount_batch, 'list_mounts':list_mounts,
+              'list_locks':list_locks, 'test_lock':test_lock,
+              'get_lock':get_lock, 'lock_wait':lock_wait, 'wait_status':wait_status, 'wait_cancel':wait_cancel,
+              'wait_stats':wait_stats, 'close_session':close_session, 'list_sessions':list_sessions}
 
-    @app.route("/fileop")
-    def fileop():
+    # worker processes acting as separate lock owners, see lock_owner_pool.py
+    owner_pool = None
+
+    def _owned(para):
+        return owner_pool is not None and para.get('owner') not in (None, '')
+
+    # answered from the server's own tables without touching a file
+    memory_ops = ('list_locks', 'test_lock', 'list_sessions', 'list_mounts', 'wait_cancel', 'wait_stats')
+
+    def is_blocking(name, para):
+        """
+        Tell whether a command can park its thread for a long time, so that
+        the async engine knows to move it off the event loop: everything
+        that touches the filesystem (open/close and even non-blocking lockf
+        wait on a slow NFS server, mount subprocesses), long polls of the
+        wait queue and anything routed to an owner worker.
+        """
+        if _owned(para):
+            return True
+        if name in ('lock_wait', 'wait_status'):
+            try:
+                return float(para.get('poll', 0)) > 0
+            except (TypeError, ValueError):
+                return False
+        return name not in memory_ops
+
+    metrics = Registry()
+    op_total = metrics.add(Counter('lockserver_ops_total', 'Commands run, by op_map command',
+                                   ('cmd',)))
+    op_results = metrics.add(Counter('lockserver_op_results_total',
+                                     'Command outcomes, a lock_list with any failed range counts as failed',
+                                     ('cmd', 'result')))
+    op_seconds = metrics.add(Histogram('lockserver_op_seconds',
+                                       'Time per command spent in kernel calls (syscall) and around them (handling)',
+                                       ('cmd', 'phase')))
+    batch_size = metrics.add(Histogram('lockserver_multi_cmd_batch_size', 'Commands per /multi_cmd batch',
+                                       buckets=SIZE_BUCKETS))
+    metrics.add(Gauge('lockserver_open_fds', 'Files currently open through open_file',
+                      lambda: len(fd_table)))
+    metrics.add(Gauge('lockserver_sessions', 'Client sessions holding or recently holding handles',
+                      lambda: len(fd_table.sessions)))
+    metrics.add(Gauge('lockserver_lock_waiters', 'Requests waiting in the lock wait queue',
+                      lambda: sum(len(q) for q in list(waitq.queues.values()))))
+
+    # structured trace of every command when started with --trace
+    trace_writer = None
+    batch_ids = itertools.count(1)
+
+    def trace(name, request, result, start, elapsed, client, batch=None):
+        try:
+            trace_writer.write('{"ts": %r, "dur": %r, "client": %s, "cmd": %s, "para": %s, "result": %s%s}'%(
+                start, elapsed, json.dumps(client), json.dumps(name), request, json.dumps(result),
+                ', "batch": %s'%json.dumps(batch) if batch else ''))
+        except Exception as e:
+            write_log('trace failed: %s'%e, logging.ERROR)
+
+    def batch_tag(data):
+        """
+        Trace tag of a /multi_cmd batch, its commands are recorded with
+        the tag and their index so lock_replay.py can send them as one batch
+        """
+        if trace_writer is None:
+            return None
+        return {'id': next(batch_ids), 'parallel': data.get('parallel') or False}
+
+    def run_op(name, para, client=None, batch=None):
+        """
+        Run one op_map command and record its metrics. With --owners a
+        command carrying 'owner' runs in that owner's worker process.
+        client ('ip:port') and batch ({'id', 'parallel', 'index'}) only go
+        to the trace. A command sent with 'timing' gets its server side
+        duration back as 'dur', in seconds as in the trace.
+        """
+        func = op_map[name]
+        timing = para.pop('timing', None)
+        # ops fill in their results in place, keep the request as sent
+        request = json.dumps(para) if trace_writer is not None else None
+        syscall_start()
+        start = time.time()
+        if _owned(para):
+            reply = owner_pool.call(para['owner'], {'cmd':name, 'para':para})
+            para.update(reply['para'])
+            # the worker's kernel time, this thread only waited on the pipe
+            syscall_add(reply['syscall'])
+            result = para
+        else:
+            result = func(para)
+        elapsed = time.time() - start
+        kernel = syscall_total()
+        op_total.inc(name)
+        failed = result.get('result') == 'failed' or result.get('failed')
+        op_results.inc(name, 'failed' if failed else 'success')
+        op_seconds.observe(kernel, name, 'syscall')
+        op_seconds.observe(max(elapsed - kernel, 0), name, 'handling')
+        if request is not None:
+            trace(name, request, result, start, elapsed, client, batch)
+        if timing:
+            result['dur'] = elapsed
+        return result
+
+    def start_owner_pool(size, threads, session_idle=0):
+        """
+        Fork the owner workers, must run before the server starts any thread
+        """
+        global owner_pool
+
+        def init(index):
+            global owner_pool
+            owner_pool = None
+            log_writer.path = '%s.owner%d'%(log_writer.path, index)
+            if session_idle:
+                fd_table.start_reaper(session_idle, log=write_log)
+
+        def dispatch(req):
+            result = run_op(req['cmd'], req['para'])
+            return {'para': result, 'syscall': syscall_total()}
+
+        owner_pool = OwnerPool(size, dispatch,
+                               init=init, finish=lambda index: log_writer.close(),
+                               threads=threads).start()
+        return owner_pool
+
+    def render_metrics():
+        return metrics.render()
+
+    def handle_fileop(args, client=None):
+        """
+        Run one /fileop request
+
+        Args:
+            args (dict) :: query string parameters, 'cmd' selects the op
+            client (str) :: 'ip:port' of the caller, for the trace
+
+        Return:
+            response body (str)
+        """
         try:
-            args=request.args.to_dict()
             write_log(args)
-            result=op_map[args['cmd']](args)
-            write_log(str(result))
-            return str(result)
+            result=json.dumps(run_op(args['cmd'], args, client))
+            write_log(result)
+            return result
         except Exception as e:
-            write_log('FATAL ERROR:'+str(e))
+            write_log('FATAL ERROR:'+str(e), logging.ERROR)
             return str(e)
 
+    def run_entries(entries, done=None, client=None, batch=None):
+        """
+        Run (index, entry) pairs in order. With a done callback every entry
+        is reported through done(index) and a failing entry is recorded in
+        its 'para' instead of aborting the rest.
+        """
+        for index, entry in entries:
+            write_log(entry)
+            tag = dict(batch, index=index) if batch else None
+            if done is None:
+                result=run_op(entry['cmd'], entry['para'], client, tag)
+            else:
+                try:
+                    result=run_op(entry['cmd'], entry['para'], client, tag)
+                except Exception as e:
+                    result=entry['para']
+                    result['result'] = 'failed'
+                    result['reason'] = str(e)
+                done(index)
+            write_log(result)
+
+    multi_pool = None
+    multi_pool_size = 64
+    multi_pool_lock = threading.Lock()
+
+    def get_multi_pool():
+        global multi_pool
+        with multi_pool_lock:
+            if multi_pool is None:
+                multi_pool = ThreadPoolExecutor(max_workers=multi_pool_size)
+        return multi_pool
+
+    def order_key(index, entry):
+        """
+        Entries sharing a key must run in request order: ops on one fd,
+        opens of one path and mounts of one mount point
+        """
+        para = entry['para']
+        if entry['cmd'] == 'open_file':
+            return ('path', para.get('file_path'))
+        if entry['cmd'] in ('mount', 'unmount'):
+            return ('mount', _mount_para(para, 'mount_path', 'mountPath'))
+        if 'fd' in para:
+            return ('fd', str(para['fd']))
+        if entry['cmd'] == 'close_session':
+            return ('session', para.get('session'))
+        return ('entry', index)
+
+    def run_parallel(cmds, lanes, done=None, client=None, batch=None):
+        """
+        Spread the batch over at most 'lanes' pool threads. Every ordering
+        key is pinned to one lane and each lane runs its entries in request
+        order, results still land in each entry's 'para'.
+        """
+        lane_of = {}
+        lane_entries = [[] for _ in range(min(lanes, len(cmds)) or 1)]
+        for index, entry in enumerate(cmds):
+            key = order_key(index, entry)
+            if key not in lane_of:
+                lane_of[key] = len(lane_of) % len(lane_entries)
+            lane_entries[lane_of[key]].append((index, entry))
+        pool = get_multi_pool()
+        futures = [pool.submit(run_entries, entries, done, client, batch) for entries in lane_entries if entries]
+        if done is None:
+            for future in futures:
+                future.result()
+        return futures
+
+    def handle_multi_cmd(data, client=None):
+        """
+        Run one /multi_cmd batch, results are written back into each
+        entry's 'para'
+
+        Args:
+            data (dict) :: {'cmds': [{'cmd':..., 'para':{...}}, ...],
+                            'parallel': False | True | max threads for this batch}
+
+        Return:
+            data (dict)
+        """
+        parallel = data.get('parallel')
+        batch = batch_tag(data)
+        batch_size.observe(len(data.get('cmds')))
+        if parallel and len(data.get('cmds')) > 1:
+            lanes = multi_pool_size if parallel is True else int(parallel)
+            run_parallel(data.get('cmds'), lanes, client=client, batch=batch)
+        else:
+            run_entries(enumerate(data.get('cmds')), client=client, batch=batch)
+        return data
+
+    def iter_multi_cmd(data, client=None):
+        """
+        Streaming flavour of handle_multi_cmd, yields one NDJSON line
+        {'index':..., 'cmd':..., 'para':{...}} per command as soon as it
+        completes. Parallel batches yield in completion order, the index
+        gives the position in the request. Finished entries are dropped
+        from the request so the batch is never held twice. Closing the
+        generator early (the client went away) stops the batch once the
+        commands in progress are done.
+        """
+        cmds = data.get('cmds')
+        parallel = data.get('parallel')
+        batch = batch_tag(data)
+        batch_size.observe(len(cmds))
+
+        def line(index):
+            entry = cmds[index]
+            cmds[index] = None
+            return json.dumps({'index':index, 'cmd':entry['cmd'], 'para':entry['para']}) + '\n'
+
+        if parallel and len(cmds) > 1:
+            lanes = multi_pool_size if parallel is True else int(parallel)
+            finished = queue.Queue()
+            stop = threading.Event()
+
+            def done(index):
+                finished.put(index)
+                if stop.is_set():
+                    # ends the lane, nobody reads the rest
+                    raise Exception('stream closed')
+            futures = run_parallel(cmds, lanes, done, client, batch)
+            try:
+                for _ in range(len(cmds)):
+                    yield line(finished.get())
+            finally:
+                stop.set()
+            for future in futures:
+                future.result()
+        else:
+            for index in range(len(cmds)):
+                run_entries([(index, cmds[index])], lambda index: None, client, batch)
+                yield line(index)
+
+    def handle_request(req, client=None):
+        """
+        Run one request of the framed TCP protocol
+
+        Args:
+            req (dict) :: {'cmd':..., 'para':{...}} or {'cmd':'multi_cmd', 'cmds':[...]}
+
+        Return:
+            result dict, sent back as is
+        """
+        try:
+            if req['cmd'] == 'multi_cmd':
+                return handle_multi_cmd(req, client)
+            para = req.get('para') or {}
+            write_log(req)
+            result = run_op(req['cmd'], para, client)
+            write_log(result)
+            return result
+        except Exception as e:
+            write_log('FATAL ERROR:'+str(e), logging.ERROR)
+            return {'result':'failed', 'reason':str(e)}
+
+    app = Flask(__name__)
+
+    def peer():
+        return '%s:%s'%(request.remote_addr, request.environ.get('REMOTE_PORT'))
+
+    @app.route("/fileop")
+    def fileop():
+        return handle_fileop(request.args.to_dict(), peer())
+
+    @app.route("/metrics")
+    def metrics_route():
+        return Response(render_metrics(), content_type=metrics.content_type)
+
     @app.route("/multi_cmd", methods=['POST'])
     def multi_cmd():
         try:
             data=request.get_json()
-            for entry in data.get('cmds'):
-                write_log(entry)
-                result=op_map[entry['cmd']](entry['para'])
-                write_log(str(result))
+            if data.get('stream'):
+                return Response(iter_multi_cmd(data, peer()), mimetype='application/x-ndjson')
+            data=handle_multi_cmd(data, peer())
             return app.response_class(response=json.dumps(data),
                                       status=200,
                                       mimetype='application/json')
         except Exception as e:
-            write_log("FATAL ERROR:" + str(e))
+            write_log("FATAL ERROR:" + str(e), logging.ERROR)
             return str(e)
 
 if __name__=='__main__':
-    ip='0.0.0.0'
-    if len(sys.argv) > 1:
-        ip=sys.argv[1]
+    parser = argparse.ArgumentParser(description='File lock server')
+    parser.add_argument('ip', nargs='?', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=4240)
+    parser.add_argument('--mode', choices=['flask', 'async'], default='flask',
+                        help='flask: single threaded werkzeug server, speaks HTTP/1.0 and '
+                             'closes every connection; async: asyncio engine with HTTP/1.1 '
+                             'keep-alive, blocking ops run on a thread pool')
+    parser.add_argument('--workers', type=int, default=64,
+                        help='thread pool size for blocking ops in async and tcp mode '
+                             'and for parallel /multi_cmd batches')
+    parser.add_argument('--tcp-port', type=int, default=0,
+                        help='also serve the framed TCP protocol on this port (clients '
+                             'default to 4241), off by default')
+    parser.add_argument('--session-idle', type=float, default=0,
+                        help='close the handles of client sessions idle for this many seconds, '
+                             '0 keeps them until close_file or close_session')
+    parser.add_argument('--lock-type', choices=sorted(lock_calls), default='posix',
+                        help='lock type of handles opened without \'lock_type\': posix (lockf, '
+                             'one owner per process) or ofd (Linux open file description locks, '
+                             'one owner per handle)')
+    parser.add_argument('--refuse-posix-overlap', action='store_true',
+                        help='refuse a posix lock overlapping a range another posix handle of '
+                             'this server holds (EAGAIN, EDEADLK for ops 1/2) instead of letting '
+                             'the kernel merge them; lock_file reports such ranges as '
+                             '\'conflicts\' otherwise. lock_wait needs it to queue posix waiters')
+    parser.add_argument('--mount-workers', type=int, default=16,
+                        help='concurrent mount commands of a mount_batch')
+    parser.add_argument('--owners', type=int, default=0,
+                        help='fork this many worker processes, each a separate lock owner. '
+                             'Requests with an \'owner\' id run in worker owner %% N, '
+                             'others in the server process')
+    parser.add_argument('--owner-threads', type=int, default=16,
+                        help='requests each owner worker runs concurrently')
+    parser.add_argument('--trace', help='write every command with its timing, client and result '
+                                        'to this NDJSON file, replay it with lock_replay.py')
+    parser.add_argument('--log-file', default=Log_file)
+    parser.add_argument('--log-level', default='INFO',
+                        help='DEBUG also logs the file object behind every lock/unlock')
+    parser.add_argument('--log-max-bytes', type=int, default=100*1024*1024,
+                        help='rotate the log past this size, 0 disables rotation')
+    parser.add_argument('--log-backups', type=int, default=5)
+    options = parser.parse_args()
+    log_writer.path = options.log_file
+    log_writer.set_level(options.log_level)
+    log_writer.max_bytes = options.log_max_bytes
+    log_writer.backup_count = options.log_backups
+    multi_pool_size = options.workers
+    default_lock_type = options.lock_type
+    refuse_posix_overlap = options.refuse_posix_overlap
+    mount_workers = options.mount_workers
+    # exit through sys.exit so atexit drains the log queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if options.owners:
+        start_owner_pool(options.owners, options.owner_threads, options.session_idle)
+    if options.trace:
+        # after the owner fork, routed commands are traced once, here
+        trace_writer = TraceWriter(options.trace)
     write_log("start server\n")
-    app.run(host=ip, port=4240, debug=False, threaded=False)
-
-
-
-
+    mount_table.watch()
+    if options.session_idle:
+        fd_table.start_reaper(options.session_idle, log=write_log)
+    if options.tcp_port:
+        from lock_protocol import FrameServer
+        frame_server = FrameServer((options.ip, options.tcp_port), handle_request, is_blocking,
+                                   workers=options.workers, log=write_log)
+        frame_server.start()
+    if options.mode == 'async':
+        from lock_async_server import AsyncLockServer
+        server = AsyncLockServer(handle_fileop, handle_multi_cmd, is_blocking,
+                                 workers=options.workers, log=write_log,
+                                 metrics=render_metrics, multi_cmd_stream=iter_multi_cmd)
+        server.serve_forever(options.ip, options.port)
+    else:
+        app.run(host=options.ip, port=options.port, debug=False, threaded=False)
@@ -1,39 +1,192 @@
 __author__ = 'Raviteja'
 
 import json
+import uuid
 import requests
 import logging
+import threading
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
 
 class pyLock(object):
     """
     @version : 1.0
     @date : 05-10-2019
+
+    Args:
+        server_address (str) :: 'ip:port' of the lock server
+        pool_size (int) :: keep-alive connections kept per server
+        retries (int) :: connection attempts retried before giving up
+        backoff_factor (float) :: sleep between retries, backoff_factor * 2^(n-1) seconds
+        transport (str) :: 'http' for /fileop and /multi_cmd, 'tcp' for the
+                           framed protocol of lock_protocol.py
+        tcp_port (int) :: framed protocol port of the server, used with
+                          transport='tcp'; the server must be started with
+                          --tcp-port
+        session_id (str) :: session owning the files this object opens, a
+                            random one by default. close_session() closes
+                            all of them, the server may also reap the
+                            session when it stays idle (--session-idle)
+        owner (str|int) :: lock owner id, with a server started with --owners
+                           every request of this object runs in that owner's
+                           worker process, so objects with different owners
+                           contend like separate processes on the host
+        timeout (float) :: seconds a request may take when the call gives no
+                           timeout, 300 (500 for batches) by default
+
+    All pyLock objects created with the same pool settings share one
+    requests.Session, so connections are reused across objects and threads.
+    Only a server started with --mode async keeps them open: the default
+    flask mode answers HTTP/1.0 and closes every connection, its single
+    thread would otherwise belong to whichever client holds a connection.
+    With transport='tcp' they share one pipelined socket per server.
     """
-    def __init__(self, server_address):
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+    _connections = {}
+    _connections_lock = threading.Lock()
+
+    def __init__(self, server_address, pool_size=16, retries=3, backoff_factor=0.1,
+                 transport='http', tcp_port=4241, session_id=None, owner=None, timeout=None):
+        if transport not in ('http', 'tcp'):
+            raise ValueError('Invalid transport: %s'%transport)
         self.server_address = server_address
         self.logger = logging.getLogger(__name__)
+        self.session = self.get_session(pool_size, retries, backoff_factor)
+        self.transport = transport
+        self.tcp_port = tcp_port
+        self.session_id = session_id or uuid.uuid4().hex
+        self.owner = owner
+        self.timeout = timeout
+
+    @classmethod
+    def get_session(cls, pool_size=16, retries=3, backoff_factor=0.1):
+        """
+        Get the process wide keep-alive session for these pool settings,
+        connections are only kept by servers in --mode async
+
+        Only connection errors are retried: once a request reached the
+        server it may already have opened or locked something, so reads
+        and responses are never replayed.
+        """
+        key = (pool_size, retries, backoff_factor)
+        with cls._sessions_lock:
+            session = cls._sessions.get(key)
+            if session is None:
+                retry = Retry(total=retries, connect=retries, read=0, status=0,
+                              backoff_factor=backoff_factor, raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=64, pool_maxsize=pool_size,
+                                      max_retries=retry, pool_block=True)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                cls._sessions[key] = session
+        return session
+
+    def get_connection(self):
+        """
+        Get the shared framed protocol connection to this server,
+        reconnecting when the previous one was lost
+        """
+        from lock_protocol import LockConnection
+        key = (self.server_address.split(':')[0], self.tcp_port)
+        with self._connections_lock:
+            conn = self._connections.get(key)
+            if conn is None or conn.closed:
+                conn = LockConnection(key[0], key[1])
+                self._connections[key] = conn
+        return conn
+
+    def submit(self, cmd, **kwargs):
+        """
+        Send one command over the tcp transport without waiting for it
+
+        Return:
+            Future resolving to the result dict
+
+        Example:
+            futures = [lock.submit('lock_file', fd=fd, op=6, offset=i, length=1) for i in range(500)]
+            results = [f.result() for f in futures]
+        """
+        if self.transport != 'tcp':
+            raise Exception('submit needs transport=tcp')
+        if self.owner is not None:
+            kwargs.setdefault('owner', self.owner)
+        return self.get_connection().submit({'cmd':cmd, 'para':kwargs})
 
     def excute_py_cmd(self, cmd, **kwargs):
+        if self.transport == 'tcp':
+            t_out = kwargs.pop('timeout', self.timeout or 300)
+            if self.owner is not None:
+                kwargs.setdefault('owner', self.owner)
+            return self.get_connection().call({'cmd':cmd, 'para':kwargs}, t_out)
         params = {'cmd':cmd}
+        if self.owner is not None:
+            params['owner'] = self.owner
         if kwargs:
             params.update(kwargs)
         if 'timeout' in kwargs.keys():
             t_out = kwargs['timeout']
         else:
-            t_out = 300
-        resp = requests.get(url='http://%s/fileop'%(self.server_address),
-                            params=params,
-                            timeout=t_out).text
+            t_out = self.timeout or 300
+        resp = self.session.get(url='http://%s/fileop'%(self.server_address),
+                                params=params,
+                                timeout=t_out).text
         try:
             return json.loads(resp)
-        except json.JSONEncoder:
+        except ValueError:
             return resp
 
-    def execute_py_multi_cmd(self, req_data, timeout=500):
-        resp=requests.post('http://%s/multi_cmd'%(self.server_address), json=req_data,
-                           timeout=timeout)
+    def with_owner(self, req_data):
+        """
+        Tag every command of a batch with this object's owner
+        """
+        if self.owner is not None:
+            for entry in req_data['cmds']:
+                entry['para'].setdefault('owner', self.owner)
+        return req_data
+
+    def execute_py_multi_cmd(self, req_data, timeout=None):
+        timeout = timeout or self.timeout or 500
+        req_data = self.with_owner(req_data)
+        if self.transport == 'tcp':
+            request = dict(req_data, cmd='multi_cmd')
+            return self.get_connection().call(request, timeout)
+        resp=self.session.post('http://%s/multi_cmd'%(self.server_address), json=req_data,
+                               timeout=timeout)
         return resp.json()
 
+    def iter_multi_cmd(self, req_data, timeout=500):
+        """
+        Send a batch in streaming mode and yield one result per command as
+        the server completes it, instead of waiting for the whole batch.
+        Always goes over HTTP.
+
+        Args:
+            req_data (dict) :: batch as built by open_cmds/lock_cmds/unlock_cmds/close_cmds
+            timeout (int) :: seconds to wait for the next result line
+
+        Return:
+            generator of {'index', 'cmd', 'para'}, index is the position in
+            req_data['cmds'], parallel batches arrive in completion order
+
+        Example:
+            for res in lock.iter_multi_cmd(lock.lock_cmds(fds, ranges, 6)):
+                if res['para']['failed']:
+                    print(res['para']['fd'])
+        """
+        resp = self.session.post('http://%s/multi_cmd'%(self.server_address),
+                                 json=dict(self.with_owner(req_data), stream=True),
+                                 timeout=timeout, stream=True)
+        try:
+            for line in resp.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            resp.close()
+
     def mount_nfs(self, mountIp, mountPath, exportPath,
                   mountVers, minorversion, timeo, retry):
         resp = self.excute_py_cmd('mount', mount_ip=mountIp, export_path=exportPath, mount_path=mountPath,
@@ -47,8 +200,58 @@ class pyLock(object):
         resp = self.excute_py_cmd('unmount', mount_path=mountPath)
         return resp
 
-    def open_file(self, filePath, mode, get_fd=True):
-        resp = self.excute_py_cmd('open_file', file_path=filePath, mode=mode)
+    @staticmethod
+    def mount_spec(mountIp, mountPath, exportPath, mountVers=None, minorversion=None,
+                   timeo=None, retry=None):
+        """
+        One item of multi_mount
+        """
+        spec = {'mount_ip':mountIp, 'export_path':exportPath, 'mount_path':mountPath,
+                'mount_vers':mountVers, 'minorversion':minorversion, 'timeo':timeo, 'retry':retry}
+        return dict((k, v) for k, v in spec.items() if v is not None)
+
+    def multi_mount(self, mounts, parallel=None, validate=True, timeout=600):
+        """
+        Mount many exports concurrently on the server, already mounted ones
+        are skipped
+
+        Args:
+            mounts (list) :: items built with mount_spec
+            parallel (int) :: concurrent mount commands, server default when None
+
+        Return:
+            the items with their 'result' (and 'reason'), 'cached' for skipped ones
+        """
+        para = {'mounts':mounts}
+        if parallel:
+            para['parallel'] = parallel
+        resp = self.execute_py_multi_cmd({'cmds':[{'cmd':'mount_batch', 'para':para}]}, timeout)
+        para = resp['cmds'][0]['para']
+        if validate:
+            assert para['result'] == 'success' and para['failed'] == 0, \
+                [m for m in para.get('mounts', []) if m.get('result') == 'failed'] or para
+        return para['mounts']
+
+    def multi_unmount(self, mountPaths, parallel=None, validate=True, timeout=600):
+        return self.multi_mount([{'cmd':'unmount', 'mount_path':path} for path in mountPaths],
+                                parallel, validate, timeout)
+
+    def list_mounts(self):
+        """
+        NFS mounts of the server host, from its cached mount table
+        """
+        return self.excute_py_cmd('list_mounts')['mounts']
+
+    def open_file(self, filePath, mode, get_fd=True, lock_type=None):
+        """
+        lock_type :: 'posix' (lockf, every handle of the server is one owner)
+                     or 'ofd' (Linux open file description locks, every
+                     handle is its own owner), the server default when None
+        """
+        para = {'file_path':filePath, 'mode':mode, 'session':self.session_id}
+        if lock_type:
+            para['lock_type'] = lock_type
+        resp = self.excute_py_cmd('open_file', **para)
         if get_fd:
             return resp['fd']
         return resp
@@ -59,7 +262,34 @@ class pyLock(object):
             assert resp['result']=='success'
         return resp
 
-    def get_res_from_cmds(self, cmds):
+    def lock_file_wait(self, fd, op, offset, length, wait=60, poll=10, validate=True):
+        """
+        Lock when available: the request waits in the server's queue for up
+        to 'wait' seconds and this call long polls it every 'poll' seconds,
+        instead of spinning with LOCK_NB. Long polls hold a server thread,
+        use them against --mode async or transport='tcp'.
+
+        Return:
+            final ticket status with 'state', 'waited' and 'attempts'
+        """
+        poll = min(poll, wait)
+        resp = self.excute_py_cmd('lock_wait', fd=fd, op=op, offset=offset, length=length,
+                                  wait=wait, poll=poll, timeout=poll + 60)
+        while type(resp) is dict and resp.get('result') == 'waiting':
+            resp = self.excute_py_cmd('wait_status', ticket=resp['ticket'], poll=poll,
+                                      timeout=poll + 60)
+        if validate:
+            assert resp['result'] == 'success', resp
+        return resp
+
+    def wait_stats(self):
+        """
+        Queue length, longest current wait and grant wait times of the server's wait queue
+        """
+        return self.excute_py_cmd('wait_stats')['stats']
+
+    @staticmethod
+    def get_res_from_cmds(cmds):
         res=[]
         failed=[]
         for cmd in cmds:
@@ -69,11 +299,91 @@ class pyLock(object):
                 res.append(cmd['para'])
         return res, failed
 
-    def multi_open(self, mode, file_paths, verify, timeout):
+    @staticmethod
+    def open_cmds(mode, file_paths, parallel=False, session=None, lock_type=None):
         cmds = {'cmds':[]}
+        if parallel:
+            cmds['parallel'] = parallel
         for path in file_paths:
-            cmds['cmds'].append({'cmd':'open_file',
-                                 'para':{'file_path':path, 'mode':mode}})
+            para = {'file_path':path, 'mode':mode}
+            if session:
+                para['session'] = session
+            if lock_type:
+                para['lock_type'] = lock_type
+            cmds['cmds'].append({'cmd':'open_file', 'para':para})
+        return cmds
+
+    @staticmethod
+    def range_spec(length, count, start=0, stride=None, seed=None, max_failures=100):
+        """
+        Compact description of 'count' ranges of 'length' bytes, 'stride'
+        bytes apart from 'start', expanded lazily by the server. With a
+        seed the server visits them in a shuffled, reproducible order.
+        Pass it as 'ranges' to multi_lock/multi_unlock: the reply holds
+        passed/failed counts and only the failing ranges ('failures').
+        """
+        spec = {'start':start, 'length':length, 'count':count,
+                'stride':length if stride is None else stride, 'max_failures':max_failures}
+        if seed is not None:
+            spec['seed'] = seed
+        return spec
+
+    @staticmethod
+    def _ranges_para(ranges):
+        if isinstance(ranges, dict):
+            return {'range_spec':ranges}
+        lock_list = []
+        for offset, length in ranges:
+            lock_list.append({'offset':offset, 'length':length})
+        return {'lock_list':lock_list}
+
+    @staticmethod
+    def lock_cmds(fd_list, ranges, op, parallel=False):
+        """
+        ranges :: list of (offset, length), or a range_spec() dict
+        """
+        cmds = {'cmds': []}
+        if parallel:
+            cmds['parallel'] = parallel
+        ranges_para = pyLock._ranges_para(ranges)
+        for fd in fd_list:
+            para = {'fd':fd, 'op':op}
+            para.update(ranges_para)
+            cmds['cmds'].append({'cmd':'lock_file', 'para':para})
+        return cmds
+
+    @staticmethod
+    def unlock_cmds(fd_list, ranges, parallel=False):
+        """
+        ranges :: list of (offset, length), or a range_spec() dict
+        """
+        cmds = {'cmds': []}
+        if parallel:
+            cmds['parallel'] = parallel
+        ranges_para = pyLock._ranges_para(ranges)
+        for fd in fd_list:
+            para = {'fd': fd}
+            para.update(ranges_para)
+            cmds['cmds'].append({'cmd': 'unlock_file', 'para': para})
+        return cmds
+
+    @staticmethod
+    def close_cmds(fd_list, parallel=False):
+        cmds = {'cmds': []}
+        if parallel:
+            cmds['parallel'] = parallel
+        for fd in fd_list:
+            cmds['cmds'].append({'cmd':'close_file',
+                                 'para':{'fd':fd}})
+        return cmds
+
+    def multi_open(self, mode, file_paths, verify, timeout, parallel=False, lock_type=None):
+        """
+        parallel :: True or max server threads, lets the server run the batch
+                    on a worker pool, opens of one path stay in order
+        lock_type :: as for open_file
+        """
+        cmds = self.open_cmds(mode, file_paths, parallel, self.session_id, lock_type)
         if timeout:
             resp = self.execute_py_multi_cmd(cmds, timeout)
         else:
@@ -84,14 +394,8 @@ class pyLock(object):
                 raise Exception('Some open failed :: %s'%(failed))
             return {'success':results, 'failed':failed}
 
-    def multi_lock(self, fd_list, ranges, op, validate, timeout=500):
-        cmds = {'cmds': []}
-        lock_list = []
-        for offset, length in ranges:
-            lock_list.append({'offset':offset, 'length':length})
-        for fd in fd_list:
-            cmds['cmds'].append({'cmd':'lock_file',
-                                 'para':{'fd':fd, 'op':op, 'lock_list':lock_list}})
+    def multi_lock(self, fd_list, ranges, op, validate, timeout=500, parallel=False):
+        cmds = self.lock_cmds(fd_list, ranges, op, parallel)
         if timeout:
             resp = self.execute_py_multi_cmd(cmds, timeout)
         else:
@@ -107,29 +411,72 @@ class pyLock(object):
             assert resp['result'] == 'success'
         return resp
 
-    def multi_unlock(self, fd_list, ranges, validate=True):
-        cmds = {'cmds': []}
-        lock_list = []
-        for offset, length in ranges:
-            lock_list.append({'offset': offset, 'length': length})
-        for fd in fd_list:
-            cmds['cmds'].append({'cmd': 'unlock_file',
-                                 'para': {'fd': fd, 'lock_list': lock_list}})
+    def multi_unlock(self, fd_list, ranges, validate=True, parallel=False):
+        cmds = self.unlock_cmds(fd_list, ranges, parallel)
         resp = self.execute_py_multi_cmd(cmds)
         if validate:
             for cmd in resp['cmds']:
                 assert cmd['para']['failed'] == 0
         return resp
 
+    def list_locks(self, filePath=None, fd=None):
+        """
+        Ranges granted by the server on a file, looked up by path or by one of its fds
+
+        Return:
+            list of {'fd', 'offset', 'length', 'mode'}
+        """
+        para = {'file_path':filePath} if filePath else {'fd':fd}
+        resp = self.excute_py_cmd('list_locks', **para)
+        assert resp['result'] == 'success', resp
+        return resp['locks']
+
+    def test_lock(self, op, offset, length, filePath=None, fd=None):
+        """
+        Ask the server whether a lock would conflict with ranges it granted,
+        without taking it. With fd given, that fd's own ranges are ignored.
+
+        Return:
+            list of conflicting {'fd', 'offset', 'length', 'mode'}, empty when free
+        """
+        para = {'op':op, 'offset':offset, 'length':length}
+        if filePath:
+            para['file_path'] = filePath
+        if fd is not None:
+            para['fd'] = fd
+        resp = self.excute_py_cmd('test_lock', **para)
+        assert resp['result'] == 'success', resp
+        return resp['conflicts']
+
+    def get_lock(self, fd, op, offset, length):
+        """
+        Ask the server's kernel (F_OFD_GETLK) whether fd could lock the range
+
+        Return:
+            None if it could, else the conflicting {'mode', 'offset', 'length', 'pid'},
+            pid is -1 when an ofd lock holds it
+        """
+        resp = self.excute_py_cmd('get_lock', fd=fd, op=op, offset=offset, length=length)
+        assert resp['result'] == 'success', resp
+        return resp.get('holder')
+
     def close_file(self, fd):
         resp = self.excute_py_cmd('close_file', fd=fd)
         assert resp['result'] == 'success'
 
-    def multi_close(self, fd_list):
-        cmds = {'cmds': []}
-        for fd in fd_list:
-            cmds['cmds'].append({'cmd':'close_file',
-                                 'para':{'fd':fd}})
+    def close_session(self):
+        """
+        Close every file this session still has open on the server
+
+        Return:
+            number of files closed
+        """
+        resp = self.excute_py_cmd('close_session', session=self.session_id)
+        assert resp['result'] == 'success', resp
+        return resp['closed']
+
+    def multi_close(self, fd_list, parallel=False):
+        cmds = self.close_cmds(fd_list, parallel)
         resp = self.execute_py_multi_cmd(cmds)
         for cmd in resp['cmds']:
             assert cmd['para']['result'] == 'success'
@@ -0,0 +1,364 @@
+"""
+asyncio client for the file lock server
+
+AsyncPyLock has the surface of pyLock with coroutine methods. All clients
+created on one AsyncLockPool share its keep-alive HTTP connections (or one
+pipelined framed-protocol socket per server with transport='tcp') and its
+bound on in-flight requests, so one process can keep thousands of lock ops
+in flight across many lock servers.
+
+Requires python 3.
+
+Example:
+    async def main():
+        pool = AsyncLockPool(max_in_flight=5000)
+        locks = [AsyncPyLock(address, pool) for address in servers]
+        fds = await asyncio.gather(*[l.open_file('/mnt/nfs/a', 'a+') for l in locks])
+        await asyncio.gather(*[l.lock_file(fd, 6, 0, 10, validate=False)
+                               for l, fd in zip(locks, fds)])
+        await pool.close()
+"""
+
+import json
+import uuid
+import asyncio
+import logging
+import itertools
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from File_lock_remote import pyLock
+from lock_protocol import HEADER, MAX_FRAME, DEFAULT_CODEC, pack_frame, decode
+
+
+class _HttpConnection(object):
+    """
+    One keep-alive HTTP/1.1 connection, one request at a time
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def request(self, method, target, host, body=None, content_type=None):
+        head = ['%s %s HTTP/1.1'%(method, target), 'Host: %s'%host, 'Connection: keep-alive']
+        if body is not None:
+            head.append('Content-Type: %s'%content_type)
+            head.append('Content-Length: %d'%len(body))
+        self.writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if body is not None:
+            self.writer.write(body)
+        await self.writer.drain()
+        return await self._read_response()
+
+    async def _read_response(self):
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split(' ', 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    await self.reader.readuntil(b'\r\n')
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            # no length: the body runs until the server closes
+            body = await self.reader.read()
+            self.reusable = False
+        if headers.get('connection', '').lower() == 'close':
+            self.reusable = False
+        return status, body
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+
+class _FrameConnection(object):
+    """
+    Pipelined framed protocol connection, see lock_protocol.py
+    """
+    def __init__(self, reader, writer, codec):
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.closed = False
+        self.task = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def open(cls, host, port, codec):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, codec)
+
+    async def _read_loop(self):
+        error = EOFError('connection closed')
+        try:
+            while True:
+                length, req_id, codec = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+                if length > MAX_FRAME:
+                    raise ValueError('frame too large: %d bytes'%length)
+                obj = decode(await self.reader.readexactly(length), codec)
+                future = self.pending.pop(req_id, None)
+                if future is not None and not future.done():
+                    future.set_result(obj)
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            error = e
+        self.closed = True
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+    async def call(self, request):
+        if self.closed:
+            raise EOFError('connection closed')
+        req_id = next(self.ids) & 0xffffffff
+        future = asyncio.get_event_loop().create_future()
+        self.pending[req_id] = future
+        self.writer.write(pack_frame(req_id, request, self.codec))
+        try:
+            await self.writer.drain()
+            return await future
+        finally:
+            self.pending.pop(req_id, None)
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+        self.writer.close()
+
+
+class AsyncLockPool(object):
+    """
+    Connections and concurrency limit shared by AsyncPyLock clients
+
+    Args:
+        max_connections (int) :: keep-alive HTTP connections per server
+        max_in_flight (int) :: requests in flight over all servers
+        codec (int) :: framed protocol codec, see lock_protocol.py
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_connections=32, max_in_flight=1000, codec=DEFAULT_CODEC):
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.codec = codec
+        self._in_flight = None
+        self._idle = {}
+        self._slots = {}
+        self._frames = {}
+        self._frame_locks = {}
+
+    @property
+    def in_flight(self):
+        # created on first use so the pool binds to the running loop
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        return self._in_flight
+
+    async def http(self, address, method, target, body=None, content_type=None):
+        """
+        Send one HTTP request over a pooled connection
+
+        Return:
+            (status, body bytes)
+        """
+        host, _, port = address.partition(':')
+        if address not in self._slots:
+            self._slots[address] = asyncio.Semaphore(self.max_connections)
+            self._idle[address] = []
+        async with self.in_flight:
+            async with self._slots[address]:
+                idle = self._idle[address]
+                conn = idle.pop() if idle else await _HttpConnection.open(host, int(port or 80))
+                try:
+                    result = await conn.request(method, target, address, body, content_type)
+                except BaseException:
+                    conn.close()
+                    raise
+                if conn.reusable:
+                    idle.append(conn)
+                else:
+                    conn.close()
+                return result
+
+    async def frame(self, host, port, request):
+        """
+        Send one request over the shared framed protocol connection of a server
+        """
+        key = (host, port)
+        if key not in self._frame_locks:
+            self._frame_locks[key] = asyncio.Lock()
+        async with self.in_flight:
+            conn = self._frames.get(key)
+            if conn is None or conn.closed:
+                async with self._frame_locks[key]:
+                    conn = self._frames.get(key)
+                    if conn is None or conn.closed:
+                        conn = await _FrameConnection.open(host, port, self.codec)
+                        self._frames[key] = conn
+            return await conn.call(request)
+
+    async def close(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                conn.close()
+        self._idle.clear()
+        for conn in self._frames.values():
+            conn.close()
+        self._frames.clear()
+
+
+class AsyncPyLock(object):
+    """
+    asyncio version of pyLock
+
+    Args:
+        server_address (str) :: 'ip:port' of the lock server
+        pool (AsyncLockPool) :: shared pool, a private one is made when omitted
+        transport (str) :: 'http' or 'tcp', as for pyLock
+        tcp_port (int) :: framed protocol port of the server
+        session_id (str) :: session owning the opened files, as for pyLock
+        owner (str|int) :: lock owner id, as for pyLock
+    """
+    def __init__(self, server_address, pool=None, transport='http', tcp_port=4241, session_id=None,
+                 owner=None):
+        if transport not in ('http', 'tcp'):
+            raise ValueError('Invalid transport: %s'%transport)
+        self.server_address = server_address
+        self.pool = pool or AsyncLockPool()
+        self.transport = transport
+        self.tcp_port = tcp_port
+        self.session_id = session_id or uuid.uuid4().hex
+        self.owner = owner
+        self.logger = logging.getLogger(__name__)
+
+    async def excute_py_cmd(self, cmd, **kwargs):
+        t_out = kwargs.get('timeout', 300)
+        if self.owner is not None:
+            kwargs.setdefault('owner', self.owner)
+        if self.transport == 'tcp':
+            kwargs.pop('timeout', None)
+            request = {'cmd':cmd, 'para':kwargs}
+            host = self.server_address.split(':')[0]
+            return await asyncio.wait_for(self.pool.frame(host, self.tcp_port, request), t_out)
+        params = {'cmd':cmd}
+        params.update(kwargs)
+        status, body = await asyncio.wait_for(
+            self.pool.http(self.server_address, 'GET', '/fileop?' + urlencode(params)), t_out)
+        resp = body.decode('utf-8')
+        try:
+            return json.loads(resp)
+        except ValueError:
+            return resp
+
+    async def execute_py_multi_cmd(self, req_data, timeout=500):
+        req_data = pyLock.with_owner(self, req_data)
+        if self.transport == 'tcp':
+            request = dict(req_data, cmd='multi_cmd')
+            host = self.server_address.split(':')[0]
+            return await asyncio.wait_for(self.pool.frame(host, self.tcp_port, request), timeout)
+        status, body = await asyncio.wait_for(
+            self.pool.http(self.server_address, 'POST', '/multi_cmd',
+                           json.dumps(req_data).encode('utf-8'), 'application/json'), timeout)
+        return json.loads(body.decode('utf-8'))
+
+    async def mount_nfs(self, mountIp, mountPath, exportPath,
+                        mountVers, minorversion, timeo, retry):
+        resp = await self.excute_py_cmd('mount', mount_ip=mountIp, export_path=exportPath, mount_path=mountPath,
+                                        mount_vers=mountVers, minorversion=minorversion, timeo=timeo, retry=retry)
+        if type(resp) is dict:
+            assert resp['result'] == 'success'
+        else:
+            raise Exception(resp)
+
+    async def unmount_nfs(self, mountPath):
+        return await self.excute_py_cmd('unmount', mount_path=mountPath)
+
+    async def open_file(self, filePath, mode, get_fd=True, lock_type=None):
+        para = {'file_path':filePath, 'mode':mode, 'session':self.session_id}
+        if lock_type:
+            para['lock_type'] = lock_type
+        resp = await self.excute_py_cmd('open_file', **para)
+        if get_fd:
+            return resp['fd']
+        return resp
+
+    async def lock_file(self, fd, op, offset, length, validate=True):
+        resp = await self.excute_py_cmd('lock_file', fd=fd, op=op, offset=offset, length=length)
+        if validate:
+            assert resp['result'] == 'success'
+        return resp
+
+    async def unlock_file(self, fd, offset=0, length=0, validate=True):
+        resp = await self.excute_py_cmd('unlock_file', fd=fd, offset=offset, length=length)
+        if validate:
+            assert resp['result'] == 'success'
+        return resp
+
+    async def get_lock(self, fd, op, offset, length):
+        resp = await self.excute_py_cmd('get_lock', fd=fd, op=op, offset=offset, length=length)
+        assert resp['result'] == 'success', resp
+        return resp.get('holder')
+
+    async def close_file(self, fd):
+        resp = await self.excute_py_cmd('close_file', fd=fd)
+        assert resp['result'] == 'success'
+
+    async def close_session(self):
+        resp = await self.excute_py_cmd('close_session', session=self.session_id)
+        assert resp['result'] == 'success', resp
+        return resp['closed']
+
+    async def multi_open(self, mode, file_paths, verify, timeout, parallel=False, lock_type=None):
+        resp = await self.execute_py_multi_cmd(pyLock.open_cmds(mode, file_paths, parallel,
+                                                                self.session_id, lock_type),
+                                               timeout or 500)
+        results, failed = pyLock.get_res_from_cmds(resp['cmds'])
+        if verify:
+            if len(results) != len(file_paths) or failed != []:
+                raise Exception('Some open failed :: %s'%(failed))
+        return {'success':results, 'failed':failed}
+
+    async def multi_lock(self, fd_list, ranges, op, validate, timeout=500, parallel=False):
+        resp = await self.execute_py_multi_cmd(pyLock.lock_cmds(fd_list, ranges, op, parallel),
+                                               timeout or 500)
+        if validate:
+            for cmd in resp['cmds']:
+                assert cmd['para']['failed'] == 0
+        return resp
+
+    async def multi_unlock(self, fd_list, ranges, validate=True, parallel=False):
+        resp = await self.execute_py_multi_cmd(pyLock.unlock_cmds(fd_list, ranges, parallel))
+        if validate:
+            for cmd in resp['cmds']:
+                assert cmd['para']['failed'] == 0
+        return resp
+
+    async def multi_close(self, fd_list, parallel=False):
+        resp = await self.execute_py_multi_cmd(pyLock.close_cmds(fd_list, parallel))
+        for cmd in resp['cmds']:
+            assert cmd['para']['result'] == 'success'
+        return resp['cmds']
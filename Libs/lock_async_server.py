@@ -0,0 +1,252 @@
+"""
+asyncio engine for the file lock server
+
+Serves the same /fileop and /multi_cmd contract as the Flask app in
+File_Lock_Server_linux.py, but keeps many client connections alive at once.
+Requests that may block (anything touching the filesystem, which on NFS can
+stall on the server, mount/umount subprocesses, batches) run on a thread
+pool so the event loop keeps answering index and queue queries while other
+clients wait on a lock or a slow mount.
+
+Requires python 3.
+"""
+
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.parse import urlsplit, parse_qsl
+except ImportError:
+    from urlparse import urlsplit, parse_qsl
+
+
+class AsyncLockServer(object):
+    """
+    Minimal keep-alive HTTP/1.1 server on top of asyncio streams
+
+    Args:
+        fileop (callable) :: fileop(args, client) -> str, handles GET /fileop,
+                             client is the caller's 'ip:port'
+        multi_cmd (callable) :: multi_cmd(data, client) -> dict, handles POST /multi_cmd
+        is_blocking (callable) :: is_blocking(cmd, para) -> bool, True moves
+                                  a /fileop request onto the thread pool
+        workers (int) :: thread pool size for blocking requests
+        log (callable) :: log(msg), defaults to no logging
+        metrics (callable) :: metrics() -> str, serves GET /metrics when given
+        multi_cmd_stream (callable) :: multi_cmd_stream(data, client) -> iterator of str,
+                                       answers /multi_cmd batches sent with
+                                       'stream' as a chunked NDJSON stream
+
+    Example:
+        server = AsyncLockServer(handle_fileop, handle_multi_cmd, is_blocking)
+        server.serve_forever('0.0.0.0', 4240)
+    """
+    max_header_size = 65536
+
+    def __init__(self, fileop, multi_cmd, is_blocking, workers=64, log=None, metrics=None,
+                 multi_cmd_stream=None):
+        self.fileop = fileop
+        self.multi_cmd = multi_cmd
+        self.is_blocking = is_blocking
+        self.workers = workers
+        self.log = log or (lambda msg: None)
+        self.executor = None
+        self.metrics = metrics
+        self.multi_cmd_stream = multi_cmd_stream
+        self.routes = {('GET', '/fileop'): self._fileop,
+                       ('POST', '/multi_cmd'): self._multi_cmd}
+        if metrics is not None:
+            self.routes[('GET', '/metrics')] = self._metrics
+
+    async def _fileop(self, query, body, client):
+        args = dict(parse_qsl(query, keep_blank_values=True))
+        if self.is_blocking(args.get('cmd'), args):
+            loop = asyncio.get_event_loop()
+            result = await loop.run_in_executor(self.executor, self.fileop, args, client)
+        else:
+            result = self.fileop(args, client)
+        return 200, 'text/html; charset=utf-8', result
+
+    async def _metrics(self, query, body, client):
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', self.metrics()
+
+    async def _multi_cmd(self, query, body, client):
+        loop = asyncio.get_event_loop()
+        try:
+            data = json.loads(body.decode('utf-8'))
+            if data.get('stream') and self.multi_cmd_stream is not None:
+                return 200, 'application/x-ndjson', self._stream(self.multi_cmd_stream(data, client))
+            # a batch can hold any mix of ops, always keep it off the loop
+            data = await loop.run_in_executor(self.executor, self.multi_cmd, data, client)
+            return 200, 'application/json', json.dumps(data)
+        except Exception as e:
+            self.log('FATAL ERROR:' + str(e))
+            return 200, 'text/html; charset=utf-8', str(e)
+
+    async def _stream(self, lines, max_chunk=1000):
+        """
+        Drive a blocking line iterator from one pool thread, which hands
+        the lines to the loop, and yield whatever lines are ready as one
+        chunk, so a fast batch does not pay one wake-up per line. Closing
+        this generator stops the iterator after its current line and
+        closes it.
+        """
+        loop = asyncio.get_event_loop()
+        ready = asyncio.Queue()
+        end = object()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for line in lines:
+                    loop.call_soon_threadsafe(ready.put_nowait, line)
+                    if stop.is_set():
+                        break
+            except Exception as e:
+                self.log('FATAL ERROR:' + str(e))
+            finally:
+                if hasattr(lines, 'close'):
+                    lines.close()
+                if not stop.is_set():
+                    loop.call_soon_threadsafe(ready.put_nowait, end)
+
+        loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                chunk = [await ready.get()]
+                while chunk[-1] is not end and len(chunk) < max_chunk:
+                    try:
+                        chunk.append(ready.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+                finished = chunk[-1] is end
+                if finished:
+                    chunk.pop()
+                if chunk:
+                    yield ''.join(chunk)
+                if finished:
+                    break
+        finally:
+            stop.set()
+
+    async def _write_chunks(self, chunks, writer, check=1.0):
+        """
+        Send an async iterator of str as a chunked body. The client going
+        away, seen as a failed write or drain or, while no chunk is ready,
+        as the transport closing, closes the iterator so the batch behind
+        it stops. EOF on the client's side is not a disconnect, a client
+        may half-close after sending its request.
+        """
+        pending = None
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(chunks.__anext__())
+                done, _ = await asyncio.wait([pending], timeout=check)
+                if not done:
+                    if writer.is_closing():
+                        raise ConnectionResetError('client closed the stream')
+                    continue
+                try:
+                    chunk = pending.result()
+                except StopAsyncIteration:
+                    pending = None
+                    break
+                pending = None
+                data = chunk.encode('utf-8')
+                writer.write(b'%x\r\n' % len(data) + data + b'\r\n')
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+        finally:
+            if pending is not None:
+                pending.cancel()
+                try:
+                    await pending
+                except (asyncio.CancelledError, Exception):
+                    pass
+            await chunks.aclose()
+
+    async def _read_request(self, reader):
+        """
+        Read one request from the stream
+
+        Return:
+            (method, target, version, headers, body) or None on EOF
+        """
+        head = await reader.readuntil(b'\r\n\r\n')
+        if len(head) > self.max_header_size:
+            raise ValueError('request header too large')
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        body = b''
+        length = int(headers.get('content-length', 0))
+        if length:
+            body = await reader.readexactly(length)
+        return method, target, version, headers, body
+
+    def _keep_alive(self, version, headers):
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        client = '%s:%s'%peer[:2] if peer else None
+        try:
+            while True:
+                try:
+                    method, target, version, headers, body = await self._read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                url = urlsplit(target)
+                route = self.routes.get((method, url.path))
+                if route is None:
+                    status, ctype, payload = 404, 'text/html; charset=utf-8', 'Not Found'
+                else:
+                    status, ctype, payload = await route(url.query, body, client)
+                keep_alive = self._keep_alive(version, headers)
+                if isinstance(payload, str):
+                    data = payload.encode('utf-8')
+                    length = 'Content-Length: %d'%len(data)
+                else:
+                    length = 'Transfer-Encoding: chunked'
+                writer.write(('HTTP/1.1 %d %s\r\n'
+                              'Content-Type: %s\r\n'
+                              '%s\r\n'
+                              'Connection: %s\r\n\r\n' % (status, 'OK' if status == 200 else 'Not Found',
+                                                          ctype, length,
+                                                          'keep-alive' if keep_alive else 'close')).encode('latin-1'))
+                if isinstance(payload, str):
+                    writer.write(data)
+                else:
+                    await self._write_chunks(payload, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except Exception as e:
+            self.log('FATAL ERROR:' + str(e))
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        self.log('async server listening on %s:%s' % (host, port))
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self, host='0.0.0.0', port=4240):
+        try:
+            asyncio.run(self.serve(host, port))
+        finally:
+            if self.executor:
+                self.executor.shutdown(wait=False)
@@ -0,0 +1,323 @@
+#!/usr/bin/python
+"""
+Load generator for File_Lock_Server_linux.py and pyLock
+
+Starts a lock server on this host against a tmpfs directory (or uses
+--server), then drives N client threads or processes, each on M files with
+K byte ranges per file, through a mix of open/lock/unlock/close over /fileop
+(one request per op) and /multi_cmd (one batch per phase). Prints throughput
+and latency percentiles and saves everything as JSON so runs can be compared
+across releases.
+
+Example:
+    python lock_bench.py --clients 16 --files 8 --ranges 64 --mode async --output run.json
+    python lock_bench.py --compare old.json run.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+from File_lock_remote import pyLock
+
+PHASES = ('open', 'lock', 'unlock', 'close')
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(latencies, elapsed, ops):
+    """
+    latencies in seconds per request, ops counts the lock operations they carried
+    """
+    return {'requests': len(latencies),
+            'ops': ops,
+            'ops_per_sec': ops / elapsed if elapsed else None,
+            'p50_ms': to_ms(percentile(latencies, 50)),
+            'p95_ms': to_ms(percentile(latencies, 95)),
+            'p99_ms': to_ms(percentile(latencies, 99)),
+            'max_ms': to_ms(max(latencies) if latencies else None)}
+
+
+def to_ms(value):
+    return round(value * 1000, 3) if value is not None else None
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(mode, workdir, workers):
+    """
+    Start a local lock server, return (process, http address, tcp port)
+    """
+    port = free_port()
+    tcp_port = free_port()
+    server = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'File_Lock_Server_linux.py')
+    cmd = [sys.executable, server, '127.0.0.1', '--port', str(port), '--tcp-port', str(tcp_port),
+           '--mode', mode, '--workers', str(workers),
+           '--log-file', os.path.join(workdir, 'server.log'), '--log-level', 'WARNING']
+    proc = subprocess.Popen(cmd, stdout=open(os.path.join(workdir, 'server.out'), 'w'),
+                            stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise Exception('lock server exited with %s, see %s'%(proc.returncode, workdir))
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return proc, '127.0.0.1:%d'%port, tcp_port
+        except socket.error:
+            time.sleep(0.1)
+    proc.kill()
+    raise Exception('lock server did not come up on port %d'%port)
+
+
+class ClientRun(object):
+    """
+    Workload of one client: open M files, lock/unlock K ranges on each, close
+    """
+    def __init__(self, client_id, options, address, tcp_port):
+        self.client_id = client_id
+        self.options = options
+        self.lock = pyLock(address, pool_size=options.clients, transport=options.transport,
+                           tcp_port=tcp_port)
+        self.paths = [os.path.join(options.dir, 'c%d_f%d'%(client_id, i)) for i in range(options.files)]
+        # clients lock disjoint ranges unless --contend makes them share files
+        if options.contend:
+            self.paths = [os.path.join(options.dir, 'shared_f%d'%i) for i in range(options.files)]
+        self.ranges = [(i * options.range_size, options.range_size) for i in range(options.ranges)]
+        self.latencies = dict((phase, []) for phase in PHASES)
+        self.ops = dict((phase, 0) for phase in PHASES)
+        # first start and last end of every phase, for per phase throughput
+        self.windows = {}
+        self.errors = 0
+
+    def _timed(self, phase, func, *args, **kwargs):
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.errors += 1
+            result = None
+        end = time.time()
+        self.latencies[phase].append(end - start)
+        window = self.windows.setdefault(phase, [start, end])
+        window[1] = end
+        return result
+
+    def run_fileop(self):
+        fds = []
+        for path in self.paths:
+            fd = self._timed('open', self.lock.open_file, path, 'a+')
+            self.ops['open'] += 1
+            if fd is not None:
+                fds.append(fd)
+        for phase, call in (('lock', self.lock.lock_file), ('unlock', self.lock.unlock_file)):
+            for fd in fds:
+                for offset, length in self.ranges:
+                    if phase == 'lock':
+                        self._timed(phase, call, fd, self.options.op, offset, length, validate=False)
+                    else:
+                        self._timed(phase, call, fd, offset, length, validate=False)
+                    self.ops[phase] += 1
+        for fd in fds:
+            self._timed('close', self.lock.close_file, fd)
+            self.ops['close'] += 1
+
+    def run_multi(self):
+        parallel = self.options.parallel
+        resp = self._timed('open', self.lock.multi_open, 'a+', self.paths, True, 500, parallel=parallel)
+        self.ops['open'] += len(self.paths)
+        fds = [r['fd'] for r in resp['success']] if resp else []
+        self._timed('lock', self.lock.multi_lock, fds, self.ranges, self.options.op, False, parallel=parallel)
+        self.ops['lock'] += len(fds) * len(self.ranges)
+        self._timed('unlock', self.lock.multi_unlock, fds, self.ranges, False, parallel=parallel)
+        self.ops['unlock'] += len(fds) * len(self.ranges)
+        self._timed('close', self.lock.multi_close, fds, parallel=parallel)
+        self.ops['close'] += len(fds)
+
+    def run(self):
+        for _ in range(self.options.iterations):
+            if self.options.api == 'multi':
+                self.run_multi()
+            else:
+                self.run_fileop()
+        return {'latencies': self.latencies, 'ops': self.ops, 'windows': self.windows,
+                'errors': self.errors}
+
+
+def _client_process(args):
+    client_id, options, address, tcp_port = args
+    return ClientRun(client_id, options, address, tcp_port).run()
+
+
+def run_clients(options, address, tcp_port):
+    results = []
+    start = time.time()
+    if options.processes:
+        pool = multiprocessing.Pool(options.clients)
+        try:
+            results = pool.map(_client_process, [(i, options, address, tcp_port)
+                                                 for i in range(options.clients)])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        lock = threading.Lock()
+
+        def worker(client_id):
+            result = ClientRun(client_id, options, address, tcp_port).run()
+            with lock:
+                results.append(result)
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return results, time.time() - start
+
+
+def report(options, results, elapsed):
+    phases = {}
+    total_ops = 0
+    all_latencies = []
+    for phase in PHASES:
+        latencies = [l for r in results for l in r['latencies'][phase]]
+        ops = sum(r['ops'][phase] for r in results)
+        windows = [r['windows'][phase] for r in results if phase in r['windows']]
+        window = max(w[1] for w in windows) - min(w[0] for w in windows) if windows else 0
+        total_ops += ops
+        all_latencies.extend(latencies)
+        phases[phase] = summarize(latencies, window, ops)
+    return {'date': datetime.now().isoformat(),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'config': dict((k, v) for k, v in vars(options).items() if k not in ('compare',)),
+            'elapsed_sec': round(elapsed, 3),
+            'errors': sum(r['errors'] for r in results),
+            'total': summarize(all_latencies, elapsed, total_ops),
+            'phases': phases}
+
+
+def print_report(result):
+    print('%-8s %10s %12s %10s %10s %10s %10s'%('phase', 'ops', 'ops/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    rows = [(phase, result['phases'][phase]) for phase in PHASES] + [('total', result['total'])]
+    for name, row in rows:
+        print('%-8s %10d %12.1f %10s %10s %10s %10s'%(name, row['ops'], row['ops_per_sec'] or 0,
+                                                      row['p50_ms'], row['p95_ms'], row['p99_ms'], row['max_ms']))
+    print('elapsed %.3fs, errors %d'%(result['elapsed_sec'], result['errors']))
+
+
+def compare(old_file, new_file, threshold):
+    """
+    Print per phase throughput and p99 changes, return False on a regression past threshold percent
+    """
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    ok = True
+    print('%-8s %14s %14s %9s %12s %12s %9s'%('phase', 'old ops/sec', 'new ops/sec', 'change', 'old p99', 'new p99', 'change'))
+    for phase in PHASES + ('total',):
+        o = old['total'] if phase == 'total' else old['phases'][phase]
+        n = new['total'] if phase == 'total' else new['phases'][phase]
+        tput = _change(o['ops_per_sec'], n['ops_per_sec'])
+        p99 = _change(o['p99_ms'], n['p99_ms'])
+        flag = ''
+        if (tput is not None and tput < -threshold) or (p99 is not None and p99 > threshold):
+            flag = '  REGRESSION'
+            ok = False
+        print('%-8s %14.1f %14.1f %8s%% %12s %12s %8s%%%s'%(phase, o['ops_per_sec'] or 0, n['ops_per_sec'] or 0,
+                                                            _fmt(tput), o['p99_ms'], n['p99_ms'], _fmt(p99), flag))
+    return ok
+
+
+def _change(old, new):
+    if not old or new is None:
+        return None
+    return (new - old) * 100.0 / old
+
+
+def _fmt(value):
+    return '-' if value is None else '%+.1f'%value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='File lock server benchmark')
+    parser.add_argument('--server', help='ip:port of a running server, default starts one locally')
+    parser.add_argument('--tcp-port', type=int, default=4241, help='tcp port of --server')
+    parser.add_argument('--mode', choices=['flask', 'async'], default='async',
+                        help='engine of the locally started server')
+    parser.add_argument('--workers', type=int, default=64, help='worker threads of the local server')
+    parser.add_argument('--dir', help='directory for the test files, default a fresh dir under /dev/shm')
+    parser.add_argument('--clients', type=int, default=8, help='N concurrent clients')
+    parser.add_argument('--processes', action='store_true', help='run clients as processes instead of threads')
+    parser.add_argument('--files', type=int, default=4, help='M files per client')
+    parser.add_argument('--ranges', type=int, default=32, help='K byte ranges per file')
+    parser.add_argument('--range-size', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=1)
+    parser.add_argument('--op', type=int, default=6, choices=[1, 2, 5, 6], help='lock op')
+    parser.add_argument('--api', choices=['fileop', 'multi'], default='fileop',
+                        help='fileop: one request per op, multi: one /multi_cmd batch per phase')
+    parser.add_argument('--parallel', type=int, default=0, help='parallel lanes for multi batches')
+    parser.add_argument('--transport', choices=['http', 'tcp'], default='http')
+    parser.add_argument('--contend', action='store_true', help='all clients share the same files')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved runs and exit')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent change flagged as a regression by --compare')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.compare:
+        return 0 if compare(options.compare[0], options.compare[1], options.threshold) else 1
+    own_dir = options.dir is None
+    if own_dir:
+        base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        options.dir = tempfile.mkdtemp(prefix='lock_bench_', dir=base)
+    proc = None
+    try:
+        if options.server:
+            address, tcp_port = options.server, options.tcp_port
+        else:
+            proc, address, tcp_port = start_server(options.mode, options.dir, options.workers)
+        results, elapsed = run_clients(options, address, tcp_port)
+        result = report(options, results, elapsed)
+        print_report(result)
+        if options.output:
+            with open(options.output, 'w') as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+        return 0 if result['errors'] == 0 else 1
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        if own_dir:
+            shutil.rmtree(options.dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
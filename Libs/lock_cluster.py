@@ -0,0 +1,271 @@
+"""
+Scatter-gather client for many lock servers
+
+One File_Lock_Server_linux.py runs per NFS client host. LockCluster sends the
+same call to every host concurrently, with a per-host timeout, and collects
+per-host results, failures and timing, e.g. to open one path everywhere, race
+for the same range from every host and see which hosts won. Every request is
+sent with the cluster timeout, so a hung host frees its worker when the
+timeout passes instead of holding it until the server answers.
+
+Example:
+    cluster = LockCluster(['10.0.0.1:4240', '10.0.0.2:4240', '10.0.0.3:4240'], timeout=20)
+    fds = cluster.open_file('/mnt/nfs/shared', 'a+')
+    race = cluster.lock_file(fds.values(), 6, 0, 100)
+    print(race.winners(), race.summary())
+    cluster.close_file(fds.values())
+"""
+
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from File_lock_remote import pyLock
+
+
+class HostResult(object):
+    """
+    Outcome of one call on one host
+
+    ok is False when the call raised, timed out or the server answered
+    'result': 'failed'
+    """
+    __slots__ = ('host', 'ok', 'value', 'error', 'elapsed')
+
+    def __init__(self, host, ok, value=None, error=None, elapsed=None):
+        self.host = host
+        self.ok = ok
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return 'HostResult(%s, ok=%s, elapsed=%s, error=%s)'%(self.host, self.ok, self.elapsed, self.error)
+
+
+class ClusterResult(object):
+    """
+    Per-host results of one scatter-gather call, in host order
+    """
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    def __getitem__(self, host):
+        return self.results[host]
+
+    def __iter__(self):
+        return iter(self.results.values())
+
+    def succeeded(self):
+        return [r.host for r in self if r.ok]
+
+    def failed(self):
+        return dict((r.host, r.error) for r in self if not r.ok)
+
+    def winners(self):
+        """
+        Hosts whose call succeeded, for a lock race the hosts that got the lock
+        """
+        return self.succeeded()
+
+    def values(self):
+        """
+        host -> value of every host that succeeded
+        """
+        return OrderedDict((r.host, r.value) for r in self if r.ok)
+
+    def summary(self):
+        times = [r.elapsed for r in self if r.elapsed is not None]
+        return {'hosts': len(self.results),
+                'succeeded': len(self.succeeded()),
+                'failed': len(self.results) - len(self.succeeded()),
+                'elapsed': self.elapsed,
+                'min_host': min(times) if times else None,
+                'max_host': max(times) if times else None,
+                'avg_host': sum(times) / len(times) if times else None}
+
+
+def _is_failure(value):
+    return isinstance(value, dict) and value.get('result') == 'failed'
+
+
+class LockCluster(object):
+    """
+    Args:
+        server_addresses (list) :: 'ip:port' of every lock server
+        timeout (float) :: per-host timeout of every call, in seconds, also the
+                           request timeout of every pyLock
+        workers (int) :: concurrent calls, one per host by default
+        lock_kwargs :: passed to every pyLock, e.g. transport='tcp'
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, server_addresses, timeout=60, workers=None, **lock_kwargs):
+        self.timeout = timeout
+        lock_kwargs.setdefault('timeout', timeout)
+        self.clients = OrderedDict((address, pyLock(address, **lock_kwargs))
+                                   for address in server_addresses)
+        self.executor = ThreadPoolExecutor(max_workers=workers or max(len(self.clients), 1))
+
+    @property
+    def hosts(self):
+        return list(self.clients)
+
+    def _call(self, host, func, args, started=None):
+        start = time.time()
+        if started is not None:
+            started[host] = start
+        try:
+            value = func(self.clients[host], *args)
+        except Exception as e:
+            return HostResult(host, False, error=str(e) or repr(e), elapsed=time.time() - start)
+        elapsed = time.time() - start
+        if _is_failure(value):
+            return HostResult(host, False, value, value.get('reason', 'failed'), elapsed)
+        return HostResult(host, True, value, elapsed=elapsed)
+
+    def scatter(self, func, per_host_args=None, timeout=None):
+        """
+        Run func(pyLock, *args) on every host concurrently
+
+        Args:
+            func (callable) :: func(client, *args)
+            per_host_args (dict) :: host -> args tuple, only these hosts are
+                                    called; all hosts with no args by default
+            timeout (float) :: per-host timeout, the cluster timeout by default,
+                               counted from when the host's call starts, not
+                               while it is queued for a worker; requests
+                               through the client give up after the cluster
+                               timeout, pass a longer one to func's calls
+                               when this is longer
+
+        Return:
+            ClusterResult
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if per_host_args is None:
+            per_host_args = OrderedDict((host, ()) for host in self.clients)
+        start = time.time()
+        started = {}
+        futures = OrderedDict((host, self.executor.submit(self._call, host, func, args, started))
+                              for host, args in per_host_args.items())
+        while True:
+            now = time.time()
+            # calls still running within their timeout or waiting for a worker
+            pending = [(host, future) for host, future in futures.items()
+                       if not future.done() and now - started.get(host, now) < timeout]
+            if not pending:
+                break
+            wake = [started[host] + timeout for host, _ in pending if host in started]
+            if len(wake) < len(pending):
+                # a queued call starts whenever any worker frees up, look again soon
+                wake.append(now + 0.05)
+            wait([future for _, future in pending], timeout=max(min(wake) - now, 0), return_when=FIRST_COMPLETED)
+        results = OrderedDict()
+        for host, future in futures.items():
+            if future.done():
+                results[host] = future.result()
+            else:
+                # the worker gives up when the request timeout of the client passes
+                future.cancel()
+                results[host] = HostResult(host, False, error='timeout after %ss'%timeout)
+        result = ClusterResult(results, time.time() - start)
+        if result.failed():
+            self.logger.debug('cluster call failed on %s'%result.failed())
+        return result
+
+    def _per_host(self, host_values, *args):
+        """
+        host_values is host -> value (fd) or a ClusterResult of them
+        """
+        if isinstance(host_values, ClusterResult):
+            host_values = host_values.values()
+        return OrderedDict((host, (value,) + args) for host, value in host_values.items())
+
+    def _cmd(self, cmd, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        def call(client, *args):
+            return client.excute_py_cmd(cmd, **kwargs)
+        return call
+
+    def open_file(self, filePath, mode):
+        """
+        Open the same path on every host
+
+        Return:
+            ClusterResult, value is the fd on each host
+        """
+        def call(client):
+            resp = client.excute_py_cmd('open_file', file_path=filePath, mode=mode,
+                                        session=client.session_id, timeout=self.timeout)
+            if 'fd' not in resp:
+                raise Exception(resp.get('reason', resp))
+            return resp['fd']
+        return self.scatter(call)
+
+    def lock_file(self, fds, op, offset, length):
+        """
+        Lock the same range on every host at once
+
+        Args:
+            fds :: host -> fd, or the ClusterResult of open_file
+
+        Return:
+            ClusterResult, winners() are the hosts that got the lock
+        """
+        def call(client, fd):
+            return client.excute_py_cmd('lock_file', fd=fd, op=op, offset=offset, length=length,
+                                        timeout=self.timeout)
+        return self.scatter(call, self._per_host(fds))
+
+    def unlock_file(self, fds, offset=0, length=0):
+        def call(client, fd):
+            return client.excute_py_cmd('unlock_file', fd=fd, offset=offset, length=length,
+                                        timeout=self.timeout)
+        return self.scatter(call, self._per_host(fds))
+
+    def close_file(self, fds):
+        def call(client, fd):
+            return client.excute_py_cmd('close_file', fd=fd, timeout=self.timeout)
+        return self.scatter(call, self._per_host(fds))
+
+    def multi_lock(self, fds, ranges, op):
+        """
+        Lock many ranges on every host, fds is host -> list of fds
+
+        Return:
+            ClusterResult, value is the /multi_cmd reply, ok only when no range failed
+        """
+        def call(client, fd_list):
+            resp = client.execute_py_multi_cmd(client.lock_cmds(fd_list, ranges, op), self.timeout)
+            failed = sum(cmd['para'].get('failed', 0) for cmd in resp['cmds'])
+            if failed:
+                return {'result':'failed', 'reason':'%d ranges failed'%failed, 'cmds':resp['cmds']}
+            return resp
+        return self.scatter(call, self._per_host(fds))
+
+    def multi_unlock(self, fds, ranges):
+        def call(client, fd_list):
+            return client.execute_py_multi_cmd(client.unlock_cmds(fd_list, ranges), self.timeout)
+        return self.scatter(call, self._per_host(fds))
+
+    def mount_nfs(self, mountIp, mountPath, exportPath, mountVers=None, minorversion=None,
+                  timeo=None, retry=None):
+        return self.scatter(self._cmd('mount', mount_ip=mountIp, export_path=exportPath,
+                                      mount_path=mountPath, mount_vers=mountVers,
+                                      minorversion=minorversion, timeo=timeo, retry=retry))
+
+    def unmount_nfs(self, mountPath):
+        return self.scatter(self._cmd('unmount', mount_path=mountPath))
+
+    def close_session(self):
+        """
+        Close everything this cluster client opened on every host
+        """
+        return self.scatter(lambda client: client.close_session())
+
+    def close(self):
+        self.executor.shutdown(wait=False)
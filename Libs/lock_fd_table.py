@@ -0,0 +1,262 @@
+"""
+Descriptor table of the lock server
+
+open_file hands out handles instead of kernel fds. A handle packs a slot of
+this table with the slot's generation, so once a handle is closed it stays
+invalid even when the kernel reuses the fd or the slot is taken by a later
+open. Every entry holds a raw os.open descriptor and belongs to the client
+session that opened it, which lets the server close everything of a session
+in one call and reap sessions that went quiet, e.g. after a test crashed.
+get() pins an entry until release(): closing its handle invalidates the
+handle at once but defers os.close until the last user is done, so the
+kernel cannot hand the fd number to another open under a running op.
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+SLOT_BITS = 24
+SLOT_MASK = (1 << SLOT_BITS) - 1
+
+# open() mode strings -> os.open flags
+_MODE_FLAGS = {'r': os.O_RDONLY,
+               'r+': os.O_RDWR,
+               'w': os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+               'w+': os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+               'a': os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+               'a+': os.O_RDWR | os.O_CREAT | os.O_APPEND,
+               'x': os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+               'x+': os.O_RDWR | os.O_CREAT | os.O_EXCL}
+
+
+def mode_flags(mode):
+    """
+    Translate an open() mode such as 'a+' or 'rb' into os.open flags
+    """
+    key = str(mode).replace('b', '').replace('t', '')
+    if key not in _MODE_FLAGS:
+        raise ValueError('Invalid mode: %s'%mode)
+    return _MODE_FLAGS[key] | getattr(os, 'O_CLOEXEC', 0)
+
+
+class StaleHandle(Exception):
+    pass
+
+
+class FdEntry(object):
+    __slots__ = ('handle', 'fd', 'path', 'mode', 'session', 'lock_type', 'opened', 'pins', 'closed')
+
+    def __init__(self, handle, fd, path, mode, session, lock_type='posix'):
+        self.handle = handle
+        self.fd = fd
+        self.path = path
+        self.mode = mode
+        self.session = session
+        self.lock_type = lock_type
+        self.opened = time.time()
+        self.pins = 0
+        self.closed = False
+
+
+class FdTable(object):
+    """
+    Args:
+        on_close (callable) :: on_close(entry), called after an entry's fd
+                               was closed, whatever closed it
+
+    Example:
+        table = FdTable()
+        entry = table.open('/mnt/nfs/a', 'a+', session='7f3a')
+        with table.pinned(entry.handle) as pinned:
+            fcntl.lockf(pinned.fd, fcntl.LOCK_EX, 10, 0)
+        table.close_session('7f3a')
+    """
+    def __init__(self, on_close=None):
+        self.on_close = on_close
+        self.lock = threading.Lock()
+        # slot 0 is never used so that no handle is 0
+        self.slots = [None]
+        self.generations = [0]
+        self.free = []
+        self.sessions = {}
+        self.last_seen = {}
+        self.count = 0
+        self.reaper = None
+
+    def __len__(self):
+        return self.count
+
+    def _touch(self, session):
+        if session in self.sessions:
+            self.last_seen[session] = time.time()
+
+    def open(self, path, mode, session=None, perm=0o666, lock_type='posix'):
+        fd = os.open(path, mode_flags(mode), perm)
+        with self.lock:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = len(self.slots)
+                if slot > SLOT_MASK:
+                    os.close(fd)
+                    raise Exception('Too many open handles')
+                self.slots.append(None)
+                self.generations.append(0)
+            generation = self.generations[slot]
+            entry = FdEntry((generation << SLOT_BITS) | slot, fd, path, mode, session, lock_type)
+            self.slots[slot] = entry
+            self.count += 1
+            if session is not None:
+                self.sessions.setdefault(session, set()).add(entry.handle)
+                self._touch(session)
+        return entry
+
+    def _lookup(self, handle):
+        handle = int(handle)
+        slot = handle & SLOT_MASK
+        entry = self.slots[slot] if 0 <= slot < len(self.slots) else None
+        if entry is None or entry.handle != handle:
+            if slot < len(self.generations) and handle >> SLOT_BITS < self.generations[slot]:
+                raise StaleHandle('Stale Fd %s'%handle)
+            raise KeyError(handle)
+        return entry
+
+    def get(self, handle):
+        """
+        Return:
+            FdEntry of a live handle, counts as activity of its session.
+            The entry is pinned, its fd stays open until release(entry)
+
+        Raise:
+            StaleHandle for a handle that was closed, KeyError for one never issued
+        """
+        with self.lock:
+            entry = self._lookup(handle)
+            entry.pins += 1
+            self._touch(entry.session)
+        return entry
+
+    def release(self, entry):
+        """
+        Unpin an entry from get(), closes its fd when the handle was closed
+        while it was pinned
+        """
+        with self.lock:
+            entry.pins -= 1
+            deferred = entry.closed and entry.pins == 0
+        if deferred:
+            self._close(entry)
+
+    @contextmanager
+    def pinned(self, handle):
+        entry = self.get(handle)
+        try:
+            yield entry
+        finally:
+            self.release(entry)
+
+    def __contains__(self, handle):
+        try:
+            self._lookup(handle)
+            return True
+        except (KeyError, StaleHandle, ValueError):
+            return False
+
+    def _pop(self, handle):
+        with self.lock:
+            entry = self._lookup(handle)
+            entry.closed = True
+            slot = handle & SLOT_MASK
+            self.slots[slot] = None
+            self.generations[slot] = (self.generations[slot] + 1) & 0x1fffffff
+            self.free.append(slot)
+            self.count -= 1
+            handles = self.sessions.get(entry.session)
+            if handles is not None:
+                handles.discard(entry.handle)
+                if not handles:
+                    # every pyLock has its own session, forget it with its last handle
+                    del self.sessions[entry.session]
+                    self.last_seen.pop(entry.session, None)
+            # release() closes it once the last user unpins it
+            pinned = entry.pins > 0
+        return entry, pinned
+
+    def _close(self, entry):
+        try:
+            os.close(entry.fd)
+        finally:
+            if self.on_close is not None:
+                self.on_close(entry)
+
+    def close(self, handle):
+        """
+        Invalidate the handle, its fd is closed now or by the release() of
+        its last user
+        """
+        entry, pinned = self._pop(int(handle))
+        if not pinned:
+            self._close(entry)
+        return entry
+
+    def close_session(self, session):
+        """
+        Close every handle of a session and forget the session
+
+        Return:
+            list of the closed FdEntry
+        """
+        with self.lock:
+            handles = list(self.sessions.pop(session, ()))
+            self.last_seen.pop(session, None)
+        closed = []
+        for handle in handles:
+            try:
+                closed.append(self.close(handle))
+            except (KeyError, StaleHandle, OSError):
+                pass
+        return closed
+
+    def idle_sessions(self, idle):
+        now = time.time()
+        with self.lock:
+            return [s for s, seen in self.last_seen.items() if now - seen > idle]
+
+    def reap(self, idle):
+        """
+        Close the sessions with no activity for more than 'idle' seconds
+
+        Return:
+            {session: number of handles closed}
+        """
+        return dict((session, len(self.close_session(session)))
+                    for session in self.idle_sessions(idle))
+
+    def start_reaper(self, idle, interval=None, log=None):
+        """
+        Reap idle sessions from a daemon thread every 'interval' seconds
+        """
+        interval = interval or min(max(idle / 4.0, 1), 30)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    reaped = self.reap(idle)
+                    if reaped and log is not None:
+                        log('reaped idle sessions %s'%reaped)
+                except Exception as e:
+                    if log is not None:
+                        log('session reaper: %s'%e)
+        self.reaper = threading.Thread(target=run, name='fd-table-reaper')
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def session_info(self):
+        now = time.time()
+        with self.lock:
+            return [{'session': s, 'handles': len(self.sessions.get(s, ())),
+                     'idle': round(now - self.last_seen.get(s, now), 3)}
+                    for s in sorted(self.sessions)]
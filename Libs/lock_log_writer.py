@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class LogWriter(object):
+    """
+    Queue backed log writer, callers only pay for formatting the message
+    and a queue put, a background thread batches records to the file
+
+    Args:
+        path (str) :: log file path
+        level (int|str) :: records below this level are dropped before queueing
+        flush_size (int) :: flush after this many buffered records
+        flush_interval (float) :: flush at least every flush_interval seconds
+        max_bytes (int) :: rotate when the file grows past max_bytes, 0 disables
+        backup_count (int) :: number of rotated files kept (path.1 .. path.N)
+        queue_size (int) :: records buffered before new ones are dropped
+
+    Example:
+        writer = LogWriter('/opt/data/log/app.log', level='DEBUG')
+        writer.write('start server')
+        writer.close()
+    """
+    time_format = '[%d-%m-%y%H:%M:%S:%f]'
+
+    def __init__(self, path, level=logging.INFO, flush_size=512, flush_interval=1.0,
+                 max_bytes=100*1024*1024, backup_count=5, queue_size=200000):
+        self.path = path
+        self.level = logging.INFO
+        self.set_level(level)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stream = None
+        self._closed = False
+
+    def set_level(self, level):
+        if not isinstance(level, int):
+            level = logging.getLevelName(str(level).upper())
+            if not isinstance(level, int):
+                raise ValueError('Invalid log level: %s'%level)
+        self.level = level
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def write(self, log, level=logging.INFO):
+        """
+        Queue one record, the message is turned into a string right away
+        since callers keep mutating the dicts they log
+        """
+        if level < self.level or self._closed:
+            return
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((time.time(), str(log)))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name='LogWriter')
+                thread.daemon = True
+                thread.start()
+                atexit.register(self.close)
+                self._thread = thread
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._stream = open(self.path, 'a')
+
+    def _rotate(self):
+        self._stream.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = '%s.%d'%(self.path, i)
+                if os.path.exists(src):
+                    os.rename(src, '%s.%d'%(self.path, i + 1))
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def format(self, stamp, msg):
+        return datetime.fromtimestamp(stamp).strftime(self.time_format) + msg + '\n'
+
+    def _flush(self, batch):
+        if self._stream is None:
+            self._open()
+        lines = []
+        for stamp, msg in batch:
+            lines.append(self.format(stamp, msg))
+        if self.dropped:
+            lines.append(self.format(time.time(), 'log queue full, dropped %d records'%self.dropped))
+            self.dropped = 0
+        self._stream.write(''.join(lines))
+        self._stream.flush()
+        if self.max_bytes and self._stream.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _run(self):
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                record = self._queue.get(timeout=max(deadline - time.time(), 0.01))
+            except queue.Empty:
+                record = False
+            stop = record is None
+            if record:
+                batch.append(record)
+                # drain whatever is already queued without waiting again
+                while len(batch) < self.flush_size:
+                    try:
+                        record = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is None:
+                        stop = True
+                        break
+                    batch.append(record)
+            if batch and (stop or len(batch) >= self.flush_size or time.time() >= deadline):
+                try:
+                    self._flush(batch)
+                except Exception as e:
+                    sys.stderr.write('LogWriter: %s\n'%e)
+                batch = []
+            if time.time() >= deadline:
+                deadline = time.time() + self.flush_interval
+            if stop:
+                break
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def close(self, timeout=10):
+        """
+        Stop accepting records and wait until everything queued is on disk
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+
+class TraceWriter(LogWriter):
+    """
+    LogWriter for structured traces: every record is one JSON object per
+    line, written as is, notes of the writer itself become {"ts", "note"}
+    """
+    def __init__(self, path, **kwargs):
+        kwargs.setdefault('max_bytes', 0)
+        LogWriter.__init__(self, path, **kwargs)
+
+    def format(self, stamp, msg):
+        if msg.startswith('{'):
+            return msg + '\n'
+        return json.dumps({'ts': stamp, 'note': msg}) + '\n'
@@ -0,0 +1,168 @@
+"""
+Counters, gauges and histograms for the lock server, rendered in the
+Prometheus text exposition format by Registry.render()
+"""
+
+import time
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+_local = threading.local()
+
+
+def syscall_start():
+    """
+    Reset the kernel time accumulated by this thread, call before an op
+    """
+    _local.syscall = 0.0
+
+
+def syscall_add(seconds):
+    _local.syscall = getattr(_local, 'syscall', 0.0) + seconds
+
+
+def syscall_total():
+    return getattr(_local, 'syscall', 0.0)
+
+
+class timed_syscall(object):
+    """
+    Context manager adding the time spent inside it to this thread's kernel time
+
+    Example:
+        with timed_syscall():
+            fcntl.lockf(fd, op, length, offset)
+    """
+    __slots__ = ('start',)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        syscall_add(time.time() - self.start)
+        return False
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}'%','.join('%s="%s"'%(n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                           for n, v in zip(names, values))
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def header(self):
+        return ['# HELP %s %s'%(self.name, self.help), '# TYPE %s %s'%(self.name, self.kind)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels, **kwargs):
+        amount = kwargs.get('amount', 1)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for labels in sorted(self.values):
+                lines.append('%s%s %s'%(self.name, _labels(self.labels, labels), _number(self.values[labels])))
+        return lines
+
+
+class Gauge(Metric):
+    """
+    Gauge read from a callback at scrape time
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, func):
+        Metric.__init__(self, name, help)
+        self.func = func
+
+    def render(self):
+        return self.header() + ['%s %s'%(self.name, _number(self.func()))]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = self.header()
+        names = self.labels + ('le',)
+        with self.lock:
+            for labels in sorted(self.values):
+                counts, total, count = self.values[labels]
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d'%(self.name, _labels(names, labels + (_number(bound),)),
+                                                   cumulative))
+                lines.append('%s_sum%s %s'%(self.name, _labels(self.labels, labels), repr(total)))
+                lines.append('%s_count%s %d'%(self.name, _labels(self.labels, labels), count))
+        return lines
+
+
+class Registry(object):
+    """
+    Example:
+        registry = Registry()
+        ops = registry.add(Counter('lockserver_ops_total', 'Ops run', ('cmd',)))
+        ops.inc('lock_file')
+        text = registry.render()
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
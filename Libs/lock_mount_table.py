@@ -0,0 +1,162 @@
+"""
+Cached view of the mount table
+
+MountTable parses /proc/self/mountinfo and keeps it indexed by mount point.
+A watcher thread polls the file for POLLPRI, which the kernel raises on
+every mount table change, and marks the cache stale, so lookups only
+re-read the file after something was mounted or unmounted. Without the
+watcher the cache is re-read once it is older than max_age seconds.
+"""
+
+import os
+import re
+import time
+import select
+import threading
+
+MOUNTINFO = '/proc/self/mountinfo'
+
+_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+
+def _unescape(field):
+    # mountinfo escapes space, tab, newline and backslash as \ooo
+    return _ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountEntry(object):
+    __slots__ = ('mount_point', 'source', 'fstype', 'options', 'super_options')
+
+    def __init__(self, mount_point, source, fstype, options, super_options):
+        self.mount_point = mount_point
+        self.source = source
+        self.fstype = fstype
+        self.options = options
+        self.super_options = super_options
+
+    def option(self, name):
+        """
+        Value of a mount option such as 'vers', from the per-mount or the
+        superblock options, None when not set
+        """
+        for opts in (self.super_options, self.options):
+            for opt in opts.split(','):
+                key, _, value = opt.partition('=')
+                if key == name:
+                    return value
+        return None
+
+    def to_dict(self):
+        return {'mount_path': self.mount_point, 'source': self.source, 'fstype': self.fstype,
+                'options': self.options, 'super_options': self.super_options}
+
+
+def parse_mountinfo(text):
+    """
+    Return:
+        {mount point: MountEntry}, the last entry wins for stacked mounts
+    """
+    mounts = {}
+    for line in text.splitlines():
+        fields = line.split(' ')
+        try:
+            sep = fields.index('-', 6)
+        except ValueError:
+            continue
+        entry = MountEntry(_unescape(fields[4]), _unescape(fields[sep + 2]),
+                           fields[sep + 1], fields[5], fields[sep + 3] if len(fields) > sep + 3 else '')
+        mounts[entry.mount_point] = entry
+    return mounts
+
+
+class MountTable(object):
+    """
+    Args:
+        path (str) :: mountinfo file
+        max_age (float) :: seconds a snapshot is trusted when not watching
+
+    Example:
+        table = MountTable()
+        table.watch()
+        entry = table.get('/mnt/nfs1')
+        if entry and entry.source == '10.0.0.5:/export1':
+            pass
+    """
+    def __init__(self, path=MOUNTINFO, max_age=2.0):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.mounts = {}
+        self.loaded = 0
+        self.stale = True
+        self.watcher = None
+        self.reloads = 0
+
+    def invalidate(self):
+        self.stale = True
+
+    def _fresh(self):
+        if self.stale:
+            return False
+        return self.watcher is not None or time.time() - self.loaded < self.max_age
+
+    def snapshot(self):
+        """
+        Return:
+            {mount point: MountEntry}, re-read only when the table changed
+        """
+        if self._fresh():
+            return self.mounts
+        with self.lock:
+            if not self._fresh():
+                # clear first: a change during the read marks it stale again
+                self.stale = False
+                with open(self.path) as f:
+                    self.mounts = parse_mountinfo(f.read())
+                self.loaded = time.time()
+                self.reloads += 1
+        return self.mounts
+
+    def get(self, mount_point, resolve=True):
+        """
+        Entry mounted at mount_point, None when nothing is
+
+        The path is matched as written first, realpath() runs only when that
+        misses since it stats every component and blocks on a hung NFS
+        mount. resolve=False never touches the filesystem.
+        """
+        mounts = self.snapshot()
+        entry = mounts.get(os.path.normpath(os.path.abspath(mount_point)))
+        if entry is None and resolve:
+            # mountinfo lists resolved paths, a mount point reached through a
+            # symlink must resolve the same way to be found
+            entry = mounts.get(os.path.realpath(mount_point))
+        return entry
+
+    def watch(self):
+        """
+        Start the thread that marks the cache stale on mount table changes,
+        returns False where poll() on the file is not available
+        """
+        if self.watcher is not None:
+            return True
+        if not hasattr(select, 'poll'):
+            return False
+        f = open(self.path)
+        poller = select.poll()
+        poller.register(f.fileno(), select.POLLPRI | select.POLLERR)
+
+        def run():
+            while True:
+                events = poller.poll()
+                if events:
+                    # rewind and read so the next change is signalled again
+                    f.seek(0)
+                    f.read()
+                    self.stale = True
+        # consume the initial state
+        f.read()
+        self.watcher = threading.Thread(target=run, name='mount-table-watch')
+        self.watcher.daemon = True
+        self.watcher.start()
+        return True
@@ -0,0 +1,177 @@
+"""
+Worker processes acting as separate lock owners
+
+POSIX record locks belong to a process, so everything one server process
+locks is a single owner for the kernel and the NFS server. OwnerPool forks
+a fixed number of workers, each with its own descriptor table and locks,
+and routes every request by the owner id the client picked: requests of
+one owner always reach the same worker, requests of different workers
+contend for real.
+
+Workers are forked, the server must create the pool before it starts any
+thread (log writer, servers, thread pools) and after its ops are set up.
+"""
+
+import os
+import zlib
+import signal
+import threading
+import itertools
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def owner_slot(owner, size):
+    """
+    Worker index of an owner id, numeric ids map directly, others are hashed
+    """
+    try:
+        return int(owner) % size
+    except (TypeError, ValueError):
+        return zlib.crc32(str(owner).encode('utf-8')) % size
+
+
+def _worker_main(index, conn, inherited, dispatch, init, finish, threads):
+    # the parent handles ctrl-c and terminates the workers on exit
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # parent ends of the pipes forked along, so EOF means the parent is gone
+    for other in inherited:
+        other.close()
+    if init is not None:
+        init(index)
+    send_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=threads)
+
+    def run(req_id, request):
+        try:
+            reply = (req_id, True, dispatch(request))
+        except Exception as e:
+            reply = (req_id, False, str(e))
+        with send_lock:
+            conn.send(reply)
+
+    try:
+        while True:
+            try:
+                req_id, request = conn.recv()
+            except (EOFError, OSError):
+                break
+            executor.submit(run, req_id, request)
+    finally:
+        executor.shutdown(wait=False)
+        if finish is not None:
+            finish(index)
+
+
+class _Worker(object):
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.error = None
+        self.reader = threading.Thread(target=self._read, name='owner-%d-reader'%index)
+        self.reader.daemon = True
+
+    def _read(self):
+        while True:
+            try:
+                req_id, ok, value = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self.pending.pop(req_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(Exception(value))
+        self.error = 'owner worker %d exited'%self.index
+        for req_id in list(self.pending):
+            future = self.pending.pop(req_id, None)
+            if future is not None:
+                future.set_exception(Exception(self.error))
+
+    def submit(self, request):
+        future = Future()
+        if self.error:
+            future.set_exception(Exception(self.error))
+            return future
+        req_id = next(self.ids)
+        self.pending[req_id] = future
+        try:
+            with self.send_lock:
+                self.conn.send((req_id, request))
+        except Exception as e:
+            self.pending.pop(req_id, None)
+            future.set_exception(e)
+        # the reader may have drained pending between the check and the send
+        if self.error and not future.done():
+            self.pending.pop(req_id, None)
+            future.set_exception(Exception(self.error))
+        return future
+
+
+class OwnerPool(object):
+    """
+    Args:
+        size (int) :: number of worker processes, i.e. lock owners
+        dispatch (callable) :: dispatch(request) -> result, run in the worker
+        init (callable) :: init(index), run once in each worker after the fork
+        finish (callable) :: finish(index), run in a worker before it exits
+        threads (int) :: requests a worker runs concurrently, blocking
+                         locks of one owner do not stall its other requests
+
+    Example:
+        pool = OwnerPool(8, lambda req: run_op(req['cmd'], req['para']))
+        pool.start()
+        result = pool.call('client-3', {'cmd':'open_file', 'para':{...}})
+    """
+    def __init__(self, size, dispatch, init=None, finish=None, threads=16):
+        if size < 1:
+            raise ValueError('Invalid owner pool size: %s'%size)
+        self.size = size
+        self.dispatch = dispatch
+        self.init = init
+        self.finish = finish
+        self.threads = threads
+        self.workers = []
+
+    def start(self):
+        context = multiprocessing.get_context('fork')
+        for index in range(self.size):
+            parent_conn, child_conn = context.Pipe()
+            inherited = [worker.conn for worker in self.workers] + [parent_conn]
+            process = context.Process(target=_worker_main, name='lock-owner-%d'%index,
+                                      args=(index, child_conn, inherited, self.dispatch,
+                                            self.init, self.finish, self.threads))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self.workers.append(_Worker(index, process, parent_conn))
+        for worker in self.workers:
+            worker.reader.start()
+        return self
+
+    def submit(self, owner, request):
+        """
+        Return:
+            Future of the worker's result for this owner
+        """
+        return self.workers[owner_slot(owner, self.size)].submit(request)
+
+    def call(self, owner, request, timeout=None):
+        return self.submit(owner, request).result(timeout)
+
+    def pids(self):
+        return [worker.process.pid for worker in self.workers]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.conn.close()
+        for worker in self.workers:
+            worker.process.join(5)
+            if worker.process.is_alive():
+                os.kill(worker.process.pid, signal.SIGKILL)
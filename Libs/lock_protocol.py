@@ -0,0 +1,254 @@
+"""
+Framed TCP protocol for the file lock server
+
+Every frame is a 9 byte header followed by the payload:
+
+    length (uint32) | request id (uint32) | codec (uint8) | payload
+
+The payload is a request {'cmd': 'lock_file', 'para': {...}} (or
+{'cmd': 'multi_cmd', 'cmds': [...]}) and the reply carries the same request
+id, so a client can keep many requests in flight on one socket and the server
+may answer them out of order. Payloads use msgpack when it is installed and
+compact JSON otherwise, the reply always uses the codec of the request.
+"""
+
+import json
+import socket
+import struct
+import itertools
+import threading
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = struct.Struct('!IIB')
+MAX_FRAME = 64 * 1024 * 1024
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+DEFAULT_CODEC = CODEC_MSGPACK if msgpack else CODEC_JSON
+
+
+def encode(obj, codec=CODEC_JSON):
+    if codec == CODEC_MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def decode(payload, codec=CODEC_JSON):
+    if codec == CODEC_MSGPACK:
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload.decode('utf-8'))
+
+
+def pack_frame(req_id, obj, codec=CODEC_JSON):
+    payload = encode(obj, codec)
+    return HEADER.pack(len(payload), req_id, codec) + payload
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    got = 0
+    while got < size:
+        n = sock.recv_into(view[got:], size - got)
+        if n == 0:
+            raise EOFError('connection closed')
+        got += n
+    return bytes(buf)
+
+
+def read_frame(sock):
+    """
+    Read one frame from a blocking socket
+
+    Return:
+        (req_id, codec, obj)
+    """
+    length, req_id, codec = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    if length > MAX_FRAME:
+        raise ValueError('frame too large: %d bytes'%length)
+    return req_id, codec, decode(_recv_exactly(sock, length), codec)
+
+
+class _FrameHandler(socketserver.BaseRequestHandler):
+    """
+    One thread per connection reads frames. Non-blocking requests run
+    inline on that thread, blocking ones go to the shared pool and answer
+    whenever they finish.
+    """
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+
+    def _reply(self, req_id, codec, obj):
+        frame = pack_frame(req_id, obj, codec)
+        with self.send_lock:
+            self.request.sendall(frame)
+
+    def _run(self, req_id, codec, req):
+        try:
+            result = self.server.dispatch(req, '%s:%s'%self.client_address[:2])
+        except Exception as e:
+            result = {'result': 'failed', 'reason': str(e)}
+        try:
+            self._reply(req_id, codec, result)
+        except socket.error as e:
+            self.server.log('reply %d dropped: %s'%(req_id, e))
+
+    def handle(self):
+        while True:
+            try:
+                req_id, codec, req = read_frame(self.request)
+            except (EOFError, socket.error):
+                break
+            except Exception as e:
+                self.server.log('FATAL ERROR:bad frame: %s'%e)
+                break
+            if self.server.is_blocking(req.get('cmd'), req.get('para') or {}) or req.get('cmd') == 'multi_cmd':
+                self.server.executor.submit(self._run, req_id, codec, req)
+            else:
+                self._run(req_id, codec, req)
+
+
+class FrameServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    TCP server for the framed protocol
+
+    Args:
+        address (tuple) :: (ip, port) to listen on
+        dispatch (callable) :: dispatch(request, client) -> dict, client is
+                               the caller's 'ip:port'
+        is_blocking (callable) :: is_blocking(cmd, para) -> bool
+        workers (int) :: pool size for blocking requests
+        log (callable) :: log(msg)
+
+    Example:
+        server = FrameServer(('0.0.0.0', 4241), handle_request, is_blocking)
+        server.start()
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, dispatch, is_blocking, workers=64, log=None):
+        socketserver.TCPServer.__init__(self, address, _FrameHandler)
+        self.dispatch = dispatch
+        self.is_blocking = is_blocking
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.log = log or (lambda msg: None)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='FrameServer')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class LockConnection(object):
+    """
+    Client side of the framed protocol, safe to share between threads
+
+    Args:
+        host (str) :: lock server ip
+        port (int) :: framed protocol port of the lock server
+        codec (int) :: CODEC_JSON or CODEC_MSGPACK, msgpack when installed by default
+        timeout (int) :: connect timeout in seconds
+
+    Example:
+        conn = LockConnection('10.0.0.5', 4241)
+        futures = [conn.submit({'cmd':'lock_file', 'para':{'fd':fd, 'op':6, 'offset':i, 'length':1}})
+                   for i in range(500)]
+        results = [f.result() for f in futures]
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, host, port, codec=DEFAULT_CODEC, timeout=30):
+        self.host = host
+        self.port = port
+        self.codec = codec
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.closed = False
+        self.reader = threading.Thread(target=self._read_loop, name='LockConnection')
+        self.reader.daemon = True
+        self.reader.start()
+
+    @staticmethod
+    def _claim(future):
+        # False when call() timed out and cancelled it, setting a result
+        # on a cancelled future raises and would take the reader down
+        return future is not None and future.set_running_or_notify_cancel()
+
+    def _read_loop(self):
+        error = None
+        try:
+            while True:
+                req_id, codec, obj = read_frame(self.sock)
+                future = self.pending.pop(req_id, None)
+                if self._claim(future):
+                    future.set_result(obj)
+        except Exception as e:
+            error = e
+        self.closed = True
+        if not isinstance(error, EOFError):
+            self.logger.warning('connection to %s:%s lost: %s'%(self.host, self.port, error))
+        for req_id in list(self.pending):
+            future = self.pending.pop(req_id, None)
+            if self._claim(future):
+                future.set_exception(EOFError('connection to %s:%s lost'%(self.host, self.port)))
+
+    def submit(self, request):
+        """
+        Send one request without waiting for the answer
+
+        Return:
+            Future resolving to the reply dict
+        """
+        return self._send(request)[1]
+
+    def _send(self, request):
+        if self.closed:
+            raise EOFError('connection to %s:%s is closed'%(self.host, self.port))
+        future = Future()
+        req_id = next(self.ids) & 0xffffffff
+        self.pending[req_id] = future
+        frame = pack_frame(req_id, request, self.codec)
+        try:
+            with self.send_lock:
+                self.sock.sendall(frame)
+        except Exception:
+            self.pending.pop(req_id, None)
+            raise
+        if self.closed and self._claim(self.pending.pop(req_id, None)):
+            # the reader went away before it could see this request
+            future.set_exception(EOFError('connection to %s:%s lost'%(self.host, self.port)))
+        return req_id, future
+
+    def call(self, request, timeout=None):
+        req_id, future = self._send(request)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # nobody waits for the reply any more, drop it when it comes
+            self.pending.pop(req_id, None)
+            future.cancel()
+            raise
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
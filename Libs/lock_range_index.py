@@ -0,0 +1,294 @@
+"""
+In-memory index of the byte-range locks granted by the lock server
+
+Every open fd is tracked with the file it points to. For each file and fd
+the index keeps a sorted list of disjoint ranges with their mode, updated
+with the same split/merge rules lockf applies to one lock owner. Conflict
+tests and holder listings are answered from the index with bisect, without
+probing the kernel.
+
+Ranges are kept per fd. lockf (posix) locks belong to the process though:
+fds tracked as process owned share one owner, so unlocking through one of
+them releases the range for all of them and closing any fd of a file drops
+every process owned range on it, as the kernel does. A posix lock that
+overlaps another fd's range is merged by the kernel; the server reports the
+overlap, or with --refuse-posix-overlap refuses it (LockBusy) so every
+range keeps one fd.
+"""
+
+import os
+import errno
+import bisect
+import random
+import threading
+
+# length 0 locks up to the end of the file and beyond
+EOF_END = 2 ** 63
+SHARED = 'sh'
+EXCLUSIVE = 'ex'
+
+
+class LockBusy(IOError):
+    """
+    Another fd of this server holds a conflicting range, raised before the
+    kernel is asked since it cannot tell two posix fds of a process apart
+    """
+    def __init__(self, conflicts, blocking=False):
+        holders = ', '.join('fd %s'%c['fd'] for c in conflicts)
+        if blocking:
+            # waiting on ourselves would never end
+            IOError.__init__(self, errno.EDEADLK, 'Resource deadlock avoided, held by %s'%holders)
+        else:
+            IOError.__init__(self, errno.EAGAIN, 'Resource temporarily unavailable, held by %s'%holders)
+        self.conflicts = conflicts
+
+
+def range_end(offset, length):
+    length = int(length)
+    if length == 0:
+        return EOF_END
+    if length < 0:
+        # lockf allows negative lengths, the range then ends at offset
+        return int(offset)
+    return int(offset) + length
+
+
+def range_start(offset, length):
+    length = int(length)
+    if length < 0:
+        return max(int(offset) + length, 0)
+    return int(offset)
+
+
+def _next_prime(n):
+    n = max(n, 2)
+    while any(n % d == 0 for d in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+
+def _shuffled(count, seed):
+    """
+    Visit range(count) in a reproducible shuffled order without building
+    it: i -> (a*i + b) mod p is a permutation of a prime p >= count (p <
+    2*count), the values past count are skipped
+    """
+    p = _next_prime(count)
+    rng = random.Random(seed)
+    a = rng.randrange(1, p)
+    b = rng.randrange(p)
+    for i in range(p):
+        value = (a * i + b) % p
+        if value < count:
+            yield value
+
+
+def expand_range_spec(spec):
+    """
+    Lazily expand a compact range spec into (offset, length) pairs, in
+    constant memory also when shuffled
+
+    Args:
+        spec (dict) :: {'start': first offset, default 0,
+                        'stride': distance between range starts, default length,
+                        'length': length of every range,
+                        'count': number of ranges,
+                        'seed': optional, visit the ranges in a shuffled order}
+
+    Example:
+        list(expand_range_spec({'start': 0, 'stride': 10, 'length': 2, 'count': 3}))
+        [(0, 2), (10, 2), (20, 2)]
+    """
+    start = int(spec.get('start', 0))
+    length = int(spec['length'])
+    stride = int(spec.get('stride', length))
+    count = int(spec['count'])
+    if spec.get('seed') is not None:
+        order = _shuffled(count, spec['seed'])
+    else:
+        order = range(count)
+    for i in order:
+        yield start + i * stride, length
+
+
+class OwnerRanges(object):
+    """
+    Disjoint, sorted ranges held by one fd on one file
+    """
+    __slots__ = ('starts', 'ends', 'modes')
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.modes = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _cut(self, start, end):
+        """
+        Remove [start, end) and return the index where it was
+        """
+        i = bisect.bisect_right(self.ends, start)
+        j = i
+        keep_starts, keep_ends, keep_modes = [], [], []
+        while j < len(self.starts) and self.starts[j] < end:
+            if self.starts[j] < start:
+                keep_starts.append(self.starts[j])
+                keep_ends.append(start)
+                keep_modes.append(self.modes[j])
+            if self.ends[j] > end:
+                keep_starts.append(end)
+                keep_ends.append(self.ends[j])
+                keep_modes.append(self.modes[j])
+            j += 1
+        self.starts[i:j] = keep_starts
+        self.ends[i:j] = keep_ends
+        self.modes[i:j] = keep_modes
+        if keep_starts and keep_starts[0] < start:
+            i += 1
+        return i
+
+    def add(self, start, end, mode):
+        i = self._cut(start, end)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.modes.insert(i, mode)
+        # merge with touching neighbours of the same mode
+        if i + 1 < len(self.starts) and self.starts[i + 1] == end and self.modes[i + 1] == mode:
+            self.ends[i] = self.ends.pop(i + 1)
+            self.starts.pop(i + 1)
+            self.modes.pop(i + 1)
+        if i > 0 and self.ends[i - 1] == start and self.modes[i - 1] == mode:
+            self.ends[i - 1] = self.ends.pop(i)
+            self.starts.pop(i)
+            self.modes.pop(i)
+
+    def remove(self, start, end):
+        self._cut(start, end)
+
+    def overlapping(self, start, end):
+        i = bisect.bisect_right(self.ends, start)
+        while i < len(self.starts) and self.starts[i] < end:
+            yield self.starts[i], self.ends[i], self.modes[i]
+            i += 1
+
+
+def _describe(fd, start, end, mode):
+    return {'fd': fd, 'offset': start, 'length': 0 if end == EOF_END else end - start, 'mode': mode}
+
+
+class RangeIndex(object):
+    """
+    Granted byte-range locks of every tracked fd, grouped per file
+
+    Example:
+        index = RangeIndex()
+        index.track(5, '/mnt/nfs/a', process=True)
+        index.add(5, 0, 100, EXCLUSIVE)
+        index.conflicts('/mnt/nfs/a', 50, 10, SHARED)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = {}
+        self.files = {}
+        # fds whose locks belong to the process (lockf) instead of the fd
+        self.process_owned = set()
+
+    @staticmethod
+    def file_key(path):
+        return os.path.realpath(path)
+
+    def track(self, fd, path, process=False):
+        """
+        Args:
+            process (bool) :: the fd's locks are process owned (lockf)
+        """
+        with self.lock:
+            self.paths[fd] = self.file_key(path)
+            if process:
+                self.process_owned.add(fd)
+
+    def _same_owner(self, fd, owners):
+        # fds of owners that share the lock owner of fd, fd included
+        if fd not in self.process_owned:
+            return [fd] if fd in owners else []
+        return [owner for owner in owners if owner in self.process_owned]
+
+    def untrack(self, fd):
+        """
+        Forget fd and every range it held. Closing any fd of a file also
+        releases the process owned locks on it, whichever fd set them.
+        """
+        with self.lock:
+            path = self.paths.pop(fd, None)
+            self.process_owned.discard(fd)
+            owners = self.files.get(path)
+            if owners is not None:
+                owners.pop(fd, None)
+                for owner in [o for o in owners if o in self.process_owned]:
+                    del owners[owner]
+                if not owners:
+                    del self.files[path]
+
+    def add(self, fd, offset, length, mode):
+        with self.lock:
+            path = self.paths.get(fd)
+            if path is None:
+                return
+            owners = self.files.setdefault(path, {})
+            ranges = owners.get(fd)
+            if ranges is None:
+                ranges = owners[fd] = OwnerRanges()
+            ranges.add(range_start(offset, length), range_end(offset, length), mode)
+
+    def remove(self, fd, offset, length):
+        """
+        Unlock a range of fd, for a process owned fd of every such fd
+        """
+        with self.lock:
+            owners = self.files.get(self.paths.get(fd))
+            if not owners:
+                return
+            for owner in self._same_owner(fd, owners):
+                ranges = owners[owner]
+                ranges.remove(range_start(offset, length), range_end(offset, length))
+                if not ranges:
+                    del owners[owner]
+
+    def path_of(self, fd):
+        return self.paths.get(fd)
+
+    def holders(self, path):
+        """
+        Return:
+            list of {'fd', 'offset', 'length', 'mode'}, length 0 means up to EOF
+        """
+        with self.lock:
+            owners = self.files.get(self.file_key(path), {})
+            result = []
+            for fd in sorted(owners):
+                ranges = owners[fd]
+                for start, end, mode in zip(ranges.starts, ranges.ends, ranges.modes):
+                    result.append(_describe(fd, start, end, mode))
+            return result
+
+    def conflicts(self, path, offset, length, mode, fd=None):
+        """
+        Granted ranges of other fds that would block a lock of this mode
+
+        Return:
+            list of {'fd', 'offset', 'length', 'mode'}
+        """
+        start = range_start(offset, length)
+        end = range_end(offset, length)
+        with self.lock:
+            owners = self.files.get(self.file_key(path), {})
+            result = []
+            for owner in sorted(owners):
+                if owner == fd:
+                    continue
+                for r_start, r_end, r_mode in owners[owner].overlapping(start, end):
+                    if mode == EXCLUSIVE or r_mode == EXCLUSIVE:
+                        result.append(_describe(owner, r_start, r_end, r_mode))
+            return result
@@ -0,0 +1,413 @@
+#!/usr/bin/python
+"""
+Replay a lock server trace through pyLock
+
+File_Lock_Server_linux.py --trace records every command with its start
+time, server side duration, client, parameters and result as NDJSON. This
+tool sends the same commands again to a local or remote server, one thread
+per recorded pyLock session so each session's order is kept even where
+threads shared a keep-alive connection, either at the recorded pace
+(--speed 1, or faster with --speed 10) or as fast as possible (--speed 0).
+Commands recorded from one /multi_cmd batch are sent again as one batch,
+parallel or not as recorded. Handles, wait tickets and sessions of the
+recording are mapped to the ones the new server hands out, paths can be
+moved with --path-map.
+
+The report compares every command's server side duration and outcome with
+the recording and lists where they diverged; the round trip measured here,
+network included, is reported next to it.
+
+Example:
+    python File_Lock_Server_linux.py --trace /tmp/storm.ndjson
+    python lock_replay.py /tmp/storm.ndjson --server 127.0.0.1:4240 --speed 0 \\
+        --path-map /mnt/nfs=/mnt/nfs_test --output replay.json
+"""
+
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+from collections import OrderedDict
+
+from File_lock_remote import pyLock
+from lock_bench import percentile, to_ms
+
+# keys holding paths, rewritten by --path-map
+PATH_KEYS = ('file_path', 'mount_path', 'mountPath')
+# changing the host's mounts is only replayed with --mounts
+MOUNT_CMDS = ('mount', 'unmount', 'mount_batch')
+
+
+def load_trace(paths):
+    """
+    Return:
+        trace records of all files sorted by start time, writer notes dropped
+    """
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if 'cmd' in record:
+                    records.append(record)
+    records.sort(key=lambda r: r['ts'])
+    return records
+
+
+def outcome(result):
+    """
+    Short comparable outcome of a command result
+    """
+    if not isinstance(result, dict):
+        return 'error'
+    if isinstance(result.get('failed'), int) and 'passed' in result:
+        return 'failed=%d'%result['failed']
+    if result.get('result'):
+        return str(result['result'])
+    if 'fd' in result:
+        return 'success'
+    return 'unknown'
+
+
+def session_of(record, fd_sessions, ticket_sessions):
+    """
+    Session a trace record belongs to: its own 'session', else the one that
+    opened its fd or asked for its ticket. Learns the fds and tickets the
+    record hands out into fd_sessions and ticket_sessions.
+
+    Return:
+        session id, None when it cannot be told
+    """
+    para = record.get('para') or {}
+    result = record.get('result')
+    session = para.get('session')
+    if not session and 'fd' in para:
+        session = fd_sessions.get(str(para['fd']))
+    if not session and 'ticket' in para:
+        session = ticket_sessions.get(str(para['ticket']))
+    if session and isinstance(result, dict):
+        if record['cmd'] == 'open_file' and 'fd' in result:
+            fd_sessions[str(result['fd'])] = session
+        if 'ticket' in result:
+            ticket_sessions[str(result['ticket'])] = session
+    return session
+
+
+def plan_streams(records):
+    """
+    Split trace records into replay streams, one per session, records of no
+    known session stay with their connection. A stream is a list of units,
+    the index of one command or the indexes of one recorded batch in batch
+    order.
+
+    Return:
+        OrderedDict of ('session', id) or ('client', 'ip:port') -> units
+    """
+    fd_sessions = {}
+    ticket_sessions = {}
+    batches = {}
+    streams = OrderedDict()
+    for index, record in enumerate(records):
+        session = session_of(record, fd_sessions, ticket_sessions)
+        batch = record.get('batch')
+        if batch:
+            # batch ids restart with the server, the connection tells them apart
+            key = (record.get('client'), batch['id'])
+            if key in batches:
+                batches[key].append(index)
+                continue
+            unit = batches[key] = [index]
+        else:
+            unit = [index]
+        stream = ('session', session) if session else ('client', record.get('client'))
+        streams.setdefault(stream, []).append(unit)
+    for unit in batches.values():
+        unit.sort(key=lambda index: records[index]['batch']['index'])
+    return streams
+
+
+class Replayer(object):
+    """
+    Args:
+        records (list) :: trace records, see load_trace
+        address (str) :: 'ip:port' of the server to replay against
+        speed (float) :: 1 keeps the recorded pace, 2 twice as fast, 0 no waiting
+        path_map (list) :: (old prefix, new prefix) pairs
+        transport (str), tcp_port (int) :: as for pyLock
+        timeout (float) :: per command timeout
+    """
+    def __init__(self, records, address, speed=1.0, path_map=(), transport='http', tcp_port=4241,
+                 timeout=60):
+        self.records = records
+        self.address = address
+        self.speed = speed
+        self.path_map = list(path_map)
+        self.transport = transport
+        self.tcp_port = tcp_port
+        self.timeout = timeout
+        self.fd_map = {}
+        self.ticket_map = {}
+        self.session_map = {}
+        self.mapped = threading.Condition()
+        self.results = [None] * len(records)
+
+    def _path(self, path):
+        for old, new in self.path_map:
+            if path.startswith(old):
+                return new + path[len(old):]
+        return path
+
+    def _lookup(self, table, key, what):
+        """
+        Map a recorded id, waiting a little when another client is about
+        to create it
+        """
+        deadline = time.time() + self.timeout
+        with self.mapped:
+            while str(key) not in table:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise KeyError('unmapped %s %s'%(what, key))
+                self.mapped.wait(remaining)
+            return table[str(key)]
+
+    def translate(self, record):
+        para = dict(record['para'])
+        para.pop('cmd', None)
+        para.pop('timeout', None)
+        if 'fd' in para and record['cmd'] != 'open_file':
+            para['fd'] = self._lookup(self.fd_map, para['fd'], 'fd')
+        if 'ticket' in para:
+            para['ticket'] = self._lookup(self.ticket_map, para['ticket'], 'ticket')
+        if para.get('session'):
+            with self.mapped:
+                para['session'] = self.session_map.setdefault(para['session'], uuid.uuid4().hex)
+        for key in PATH_KEYS:
+            if isinstance(para.get(key), str):
+                para[key] = self._path(para[key])
+        if para.get('mounts'):
+            para['mounts'] = [dict(item) for item in para['mounts']]
+        for item in para.get('mounts') or ():
+            for key in PATH_KEYS:
+                if isinstance(item.get(key), str):
+                    item[key] = self._path(item[key])
+        return para
+
+    def learn(self, record, result):
+        recorded = record.get('result') or {}
+        if not isinstance(result, dict):
+            return
+        with self.mapped:
+            if record['cmd'] == 'open_file' and 'fd' in recorded and 'fd' in result:
+                self.fd_map[str(recorded['fd'])] = result['fd']
+            if 'ticket' in recorded and 'ticket' in result:
+                self.ticket_map[str(recorded['ticket'])] = result['ticket']
+            self.mapped.notify_all()
+
+    def send(self, client, cmd, para):
+        # 'timing' has the server return its own duration of the command
+        para = dict(para, timing=1)
+        simple = all(not isinstance(v, (dict, list)) for v in para.values())
+        if simple or self.transport == 'tcp':
+            return client.excute_py_cmd(cmd, timeout=self.timeout, **para)
+        # lists and dicts do not fit in a query string, send a one command batch
+        resp = client.execute_py_multi_cmd({'cmds':[{'cmd':cmd, 'para':para}]}, self.timeout)
+        return resp['cmds'][0]['para']
+
+    def send_batch(self, client, unit):
+        """
+        Send the records of one recorded batch as one /multi_cmd batch
+
+        Return:
+            result of every command, in unit order
+        """
+        batch = self.records[unit[0]]['batch']
+        cmds = [{'cmd':self.records[index]['cmd'], 'para':dict(self.translate(self.records[index]), timing=1)}
+                for index in unit]
+        resp = client.execute_py_multi_cmd({'cmds':cmds, 'parallel':batch.get('parallel') or False},
+                                           self.timeout)
+        return [entry['para'] for entry in resp['cmds']]
+
+    def _run_stream(self, units, t0, start):
+        client = pyLock(self.address, transport=self.transport, tcp_port=self.tcp_port)
+        for unit in units:
+            first = self.records[unit[0]]
+            lag = 0.0
+            if self.speed:
+                due = start + (first['ts'] - t0) / self.speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = -delay
+            begin = time.time()
+            try:
+                if first.get('batch'):
+                    results = self.send_batch(client, unit)
+                else:
+                    results = [self.send(client, first['cmd'], self.translate(first))]
+            except Exception as e:
+                results = [{'result': 'error', 'reason': str(e)}] * len(unit)
+            elapsed = time.time() - begin
+            for index, result in zip(unit, results):
+                record = self.records[index]
+                self.learn(record, result)
+                replied = isinstance(result, dict)
+                self.results[index] = {'index': index,
+                                       'client': record.get('client'),
+                                       'batch': (record.get('batch') or {}).get('id'),
+                                       'cmd': record['cmd'],
+                                       'at_s': round(record['ts'] - t0, 6),
+                                       'recorded_ms': to_ms(record.get('dur')),
+                                       'replay_ms': to_ms(result.get('dur')) if replied else None,
+                                       'rtt_ms': to_ms(elapsed),
+                                       'lag_ms': to_ms(lag),
+                                       'recorded': outcome(record.get('result')),
+                                       'replayed': outcome(result),
+                                       'reason': result.get('reason') if replied else None}
+
+    def run(self):
+        streams = plan_streams(self.records)
+        t0 = self.records[0]['ts'] if self.records else 0
+        start = time.time() + 0.05
+        threads = [threading.Thread(target=self._run_stream, args=(units, t0, start))
+                   for units in streams.values()]
+        begin = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # without pacing the streams do not wait for start
+        elapsed = time.time() - (start if self.speed else begin)
+        return elapsed
+
+    def cleanup(self):
+        """
+        Close whatever the replayed sessions left open
+        """
+        client = pyLock(self.address, transport=self.transport, tcp_port=self.tcp_port)
+        for session in self.session_map.values():
+            try:
+                client.excute_py_cmd('close_session', session=session, timeout=self.timeout)
+            except Exception:
+                pass
+
+
+def report(records, results, elapsed, threshold, min_ms, top):
+    span = records[-1]['ts'] + records[-1].get('dur', 0) - records[0]['ts'] if records else 0
+    per_cmd = OrderedDict()
+    for res in results:
+        per_cmd.setdefault(res['cmd'], []).append(res)
+    summary = OrderedDict()
+    for cmd, items in per_cmd.items():
+        recorded = [r['recorded_ms'] for r in items if r['recorded_ms'] is not None]
+        replayed = [r['replay_ms'] for r in items if r['replay_ms'] is not None]
+        rtt = [r['rtt_ms'] for r in items]
+        summary[cmd] = {'count': len(items),
+                        'recorded_p50_ms': percentile(recorded, 50),
+                        'recorded_p99_ms': percentile(recorded, 99),
+                        'replay_p50_ms': percentile(replayed, 50),
+                        'replay_p99_ms': percentile(replayed, 99),
+                        'rtt_p50_ms': percentile(rtt, 50),
+                        'outcome_mismatches': sum(1 for r in items if r['recorded'] != r['replayed'])}
+    # server side durations on both sides, a server without 'timing' gives none
+    slow = [r for r in results
+            if r['recorded_ms'] is not None and r['replay_ms'] is not None
+            and r['replay_ms'] - r['recorded_ms'] >= min_ms
+            and r['replay_ms'] >= threshold * max(r['recorded_ms'], 0.001)]
+    slow.sort(key=lambda r: r['replay_ms'] - r['recorded_ms'], reverse=True)
+    mismatches = [r for r in results if r['recorded'] != r['replayed']]
+    return {'commands': len(results),
+            'recorded_span_s': round(span, 3),
+            'replay_elapsed_s': round(elapsed, 3),
+            'max_lag_ms': max([r['lag_ms'] for r in results] or [0]),
+            'per_cmd': summary,
+            'slower': len(slow),
+            'top_slower': slow[:top],
+            'mismatches': len(mismatches),
+            'top_mismatches': mismatches[:top]}
+
+
+def print_report(result):
+    print('replayed %d commands in %.3fs, recorded span %.3fs, max schedule lag %.3fms'%(
+        result['commands'], result['replay_elapsed_s'], result['recorded_span_s'], result['max_lag_ms']))
+    print('%-14s %7s %12s %12s %12s %12s %12s %10s'%('cmd', 'count', 'rec p50 ms', 'rec p99 ms',
+                                                    'rep p50 ms', 'rep p99 ms', 'rtt p50 ms', 'mismatch'))
+    for cmd, s in result['per_cmd'].items():
+        print('%-14s %7d %12s %12s %12s %12s %12s %10d'%(cmd, s['count'], _fmt(s['recorded_p50_ms']),
+                                                         _fmt(s['recorded_p99_ms']), _fmt(s['replay_p50_ms']),
+                                                         _fmt(s['replay_p99_ms']), _fmt(s['rtt_p50_ms']),
+                                                         s['outcome_mismatches']))
+    if result['top_slower']:
+        print('\nslower than recorded (%d):'%result['slower'])
+        for r in result['top_slower']:
+            print('  #%-6d +%9.3fs %-12s %-22s recorded %9.3fms replay %9.3fms rtt %9.3fms'%(
+                r['index'], r['at_s'], r['cmd'], r['client'], r['recorded_ms'], r['replay_ms'], r['rtt_ms']))
+    if result['top_mismatches']:
+        print('\ndifferent outcome (%d):'%result['mismatches'])
+        for r in result['top_mismatches']:
+            print('  #%-6d +%9.3fs %-12s %-22s recorded %-10s replay %-10s %s'%(
+                r['index'], r['at_s'], r['cmd'], r['client'], r['recorded'], r['replayed'], r['reason'] or ''))
+
+
+def _fmt(value):
+    return '-' if value is None else '%.3f'%value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a lock server trace')
+    parser.add_argument('trace', nargs='+', help='trace files written with --trace')
+    parser.add_argument('--server', default='127.0.0.1:4240', help='ip:port of the server to replay against')
+    parser.add_argument('--transport', choices=['http', 'tcp'], default='http')
+    parser.add_argument('--tcp-port', type=int, default=4241)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='1 replays at the recorded pace, N N times faster, 0 as fast as possible')
+    parser.add_argument('--path-map', action='append', default=[], metavar='OLD=NEW',
+                        help='replace the path prefix OLD by NEW, repeatable')
+    parser.add_argument('--cmds', help='comma separated commands to replay, default all')
+    parser.add_argument('--mounts', action='store_true', help='also replay mount and unmount commands')
+    parser.add_argument('--limit', type=int, help='replay only the first N commands')
+    parser.add_argument('--timeout', type=float, default=60, help='per command timeout')
+    parser.add_argument('--threshold', type=float, default=3.0,
+                        help='report commands at least this many times slower than recorded')
+    parser.add_argument('--min-ms', type=float, default=1.0,
+                        help='and at least this many ms slower, hides network noise')
+    parser.add_argument('--top', type=int, default=20, help='divergent commands to list')
+    parser.add_argument('--no-cleanup', action='store_true',
+                        help='leave the replayed sessions open on the server')
+    parser.add_argument('--output', help='save the report and every command result as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    records = load_trace(options.trace)
+    if options.cmds:
+        wanted = set(options.cmds.split(','))
+        records = [r for r in records if r['cmd'] in wanted]
+    if not options.mounts:
+        records = [r for r in records if r['cmd'] not in MOUNT_CMDS]
+    if options.limit:
+        records = records[:options.limit]
+    path_map = [tuple(item.split('=', 1)) for item in options.path_map]
+    replayer = Replayer(records, options.server, options.speed, path_map, options.transport,
+                        options.tcp_port, options.timeout)
+    elapsed = replayer.run()
+    if not options.no_cleanup:
+        replayer.cleanup()
+    result = report(records, replayer.results, elapsed, options.threshold, options.min_ms, options.top)
+    print_report(result)
+    if options.output:
+        result['results'] = replayer.results
+        with open(options.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
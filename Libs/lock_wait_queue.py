@@ -0,0 +1,283 @@
+"""
+Server side queue of clients waiting for a byte-range lock
+
+Instead of blocking a server thread in lockf (ops 1/2) or spinning from the
+client with LOCK_NB (ops 5/6), a client enqueues a waiter and gets a ticket.
+One dispatcher thread retries the waiters with non-blocking locks, in FIFO
+order per file, whenever a range is released through this server. Only while
+a waiter is refused by the kernel (the holder may be on another NFS client)
+does it also retry on a backoff timer, otherwise it sleeps on its condition
+until a release, a new waiter or the next deadline.
+Clients long-poll the ticket until it is granted or its deadline passes.
+"""
+
+import time
+import errno
+import itertools
+import threading
+import logging
+
+WAITING = 'waiting'
+GRANTED = 'granted'
+EXPIRED = 'expired'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+
+class Waiter(object):
+    __slots__ = ('ticket', 'fd', 'path', 'op', 'offset', 'length', 'start', 'end',
+                 'deadline', 'enqueued', 'finished', 'state', 'reason', 'attempts')
+
+    def __init__(self, ticket, fd, path, op, offset, length, start, end, deadline):
+        self.ticket = ticket
+        self.fd = fd
+        self.path = path
+        self.op = op
+        self.offset = offset
+        self.length = length
+        self.start = start
+        self.end = end
+        self.deadline = deadline
+        self.enqueued = time.time()
+        self.finished = None
+        self.state = WAITING
+        self.reason = None
+        self.attempts = 0
+
+    def overlaps(self, other):
+        return self.start < other.end and other.start < self.end
+
+
+class WaitQueue(object):
+    """
+    Args:
+        try_lock (callable) :: try_lock(waiter), takes the lock without
+                               blocking; returns False when the range is held
+                               through this server (notify() announces its
+                               release), raises EAGAIN/EACCES when it is
+                               held elsewhere
+        range_of (callable) :: range_of(offset, length) -> (start, end)
+        min_interval (float) :: first retry delay when nothing got released
+        max_interval (float) :: retry delay cap, the delay doubles up to it
+        keep_finished (float) :: seconds a finished ticket stays pollable
+
+    Example:
+        waitq = WaitQueue(try_lock, range_of)
+        waiter = waitq.enqueue(fd, path, op=6, offset=0, length=10, timeout=30)
+        waitq.wait(waiter.ticket, 10)
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, try_lock, range_of, min_interval=0.01, max_interval=0.5, keep_finished=300):
+        self.try_lock = try_lock
+        self.range_of = range_of
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.keep_finished = keep_finished
+        self.cond = threading.Condition()
+        self.tickets = itertools.count(1)
+        self.waiters = {}
+        self.queues = {}
+        self.released = False
+        # a waiter was refused by the kernel in the last pass
+        self.polling = False
+        # waiter whose lock the dispatcher is trying without holding cond
+        self.attempting = None
+        self.thread = None
+        self.totals = {GRANTED: 0, EXPIRED: 0, CANCELLED: 0, FAILED: 0}
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='WaitQueue')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def enqueue(self, fd, path, op, offset, length, timeout):
+        """
+        Queue a waiter, timeout is the number of seconds it may wait in total
+        """
+        start, end = self.range_of(offset, length)
+        with self.cond:
+            waiter = Waiter(next(self.tickets), fd, path, op, offset, length, start, end,
+                            time.time() + float(timeout))
+            self.waiters[waiter.ticket] = waiter
+            self.queues.setdefault(path, []).append(waiter)
+            self.released = True
+            self._start()
+            self.cond.notify_all()
+        return waiter
+
+    def notify(self):
+        """
+        Something was unlocked or closed through this server, retry now
+        """
+        with self.cond:
+            self.released = True
+            self.cond.notify_all()
+
+    def _finish(self, waiter, state, reason=None):
+        waiter.state = state
+        waiter.reason = reason
+        waiter.finished = time.time()
+        self.totals[state] += 1
+        if state == GRANTED:
+            waited = waiter.finished - waiter.enqueued
+            self.wait_sum += waited
+            self.wait_max = max(self.wait_max, waited)
+        queue = self.queues.get(waiter.path)
+        if queue is not None:
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[waiter.path]
+
+    def _attempt(self, waiter):
+        waiter.attempts += 1
+        try:
+            return self.try_lock(waiter) is not False
+        except (IOError, OSError) as e:
+            # EAGAIN/EACCES mean somebody else holds it, anything else is final
+            if getattr(e, 'errno', None) in (errno.EAGAIN, errno.EACCES):
+                self.polling = True
+                return False
+            raise
+
+    def _pass(self):
+        """
+        One retry round over every waiting ticket, waiters behind an
+        overlapping waiter of the same file keep their turn. The lock
+        attempts run without holding cond, so a slow lockf does not stall
+        notify(), cancel() or drop_fd() for other files.
+        """
+        now = time.time()
+        with self.cond:
+            for ticket, waiter in list(self.waiters.items()):
+                if waiter.state == WAITING and now >= waiter.deadline:
+                    self._finish(waiter, EXPIRED, 'deadline passed')
+                elif waiter.finished and now - waiter.finished > self.keep_finished:
+                    del self.waiters[ticket]
+            snapshot = [list(queue) for queue in self.queues.values()]
+        self.polling = False
+        for queue in snapshot:
+            blocked = []
+            for waiter in queue:
+                if any(waiter.overlaps(b) for b in blocked):
+                    continue
+                with self.cond:
+                    if waiter.state != WAITING:
+                        continue
+                    self.attempting = waiter
+                try:
+                    granted = self._attempt(waiter)
+                    state, reason = (GRANTED, None) if granted else (None, None)
+                except Exception as e:
+                    state, reason = FAILED, str(e)
+                with self.cond:
+                    self.attempting = None
+                    if state is not None:
+                        self._finish(waiter, state, reason)
+                    self.cond.notify_all()
+                if state is None:
+                    blocked.append(waiter)
+
+    def _settle(self, waiter):
+        # cancel() and drop_fd() wait for an attempt in flight on the waiter,
+        # a lock granted after they returned would never be released
+        while self.attempting is waiter:
+            self.cond.wait()
+
+    def _timeout(self, interval):
+        """
+        Seconds the dispatcher may sleep: the backoff interval while the
+        kernel refuses a waiter, else until the next deadline or finished
+        ticket to drop, None (until notified) when there is nothing
+        """
+        if self.polling:
+            return interval
+        due = [w.deadline if w.state == WAITING else w.finished + self.keep_finished
+               for w in self.waiters.values()]
+        if not due:
+            return None
+        return max(min(due) - time.time(), self.min_interval)
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            with self.cond:
+                if not self.released:
+                    self.cond.wait(self._timeout(interval))
+                released = self.released
+                self.released = False
+            self._pass()
+            with self.cond:
+                self.cond.notify_all()
+            interval = self.min_interval if released else min(interval * 2, self.max_interval)
+
+    def status(self, ticket):
+        waiter = self.waiters.get(int(ticket))
+        if waiter is None:
+            return {'ticket': ticket, 'state': None, 'reason': 'Unknown ticket'}
+        result = {'ticket': waiter.ticket, 'state': waiter.state, 'fd': waiter.fd,
+                  'offset': waiter.offset, 'length': waiter.length,
+                  'attempts': waiter.attempts,
+                  'waited': (waiter.finished or time.time()) - waiter.enqueued}
+        if waiter.state == WAITING:
+            queue = self.queues.get(waiter.path, [])
+            result['position'] = queue.index(waiter) if waiter in queue else None
+            result['remaining'] = max(waiter.deadline - time.time(), 0)
+        if waiter.reason:
+            result['reason'] = waiter.reason
+        return result
+
+    def wait(self, ticket, timeout=0):
+        """
+        Long poll a ticket until it leaves the waiting state or timeout passes
+        """
+        end = time.time() + float(timeout)
+        with self.cond:
+            waiter = self.waiters.get(int(ticket))
+            while waiter is not None and waiter.state == WAITING:
+                remaining = min(end, waiter.deadline + self.max_interval) - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.status(ticket)
+
+    def cancel(self, ticket):
+        with self.cond:
+            waiter = self.waiters.get(int(ticket))
+            if waiter is not None:
+                self._settle(waiter)
+            if waiter is not None and waiter.state == WAITING:
+                self._finish(waiter, CANCELLED)
+                self.cond.notify_all()
+            return self.status(ticket)
+
+    def drop_fd(self, fd):
+        """
+        Fail every waiter of a closed fd
+        """
+        with self.cond:
+            while self.attempting is not None and self.attempting.fd == fd:
+                self._settle(self.attempting)
+            for waiter in list(self.waiters.values()):
+                if waiter.fd == fd and waiter.state == WAITING:
+                    self._finish(waiter, FAILED, 'fd closed')
+            self.released = True
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            now = time.time()
+            waiting = [w for q in self.queues.values() for w in q]
+            granted = self.totals[GRANTED]
+            return {'waiting': len(waiting),
+                    'files': len(self.queues),
+                    'longest_wait': max([now - w.enqueued for w in waiting] or [0]),
+                    'granted': granted,
+                    'expired': self.totals[EXPIRED],
+                    'cancelled': self.totals[CANCELLED],
+                    'failed': self.totals[FAILED],
+                    'avg_grant_wait': self.wait_sum / granted if granted else 0,
+                    'max_grant_wait': self.wait_max}
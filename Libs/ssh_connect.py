@@ -7,14 +7,47 @@ import re
 import socket
 import traceback
 import logging
+import io
 import os
+import codecs
+import select
+import collections
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
-class ssh_connect(object):
+from ssh_transfer import SFTPTransfer
+
+ANSI_ESCAPE = re.compile(r'\x1b\[(?:\d{1,2};)?\d{0,2}m')
+# bytes searched again for the end character when new echo data arrives
+OVERLAP = 256
+# characters of stderr a CmdStream keeps when no stderr sink is given
+MAX_STDERR = 1 << 20
+
+
+def _split_escape(data):
+    """
+    Hold back an escape sequence cut off at the end of a chunk, so it is
+    removed once the rest arrives
     """
+    pos = data.rfind(b'\x1b', max(len(data) - 8, 0))
+    if pos < 0 or b'm' in data[pos:]:
+        return data, b''
+    return data[:pos], data[pos:]
 
+
+class ssh_connect(object):
+    """
+    Args:
+        hostname, username, password, privateKey, port :: login details
+        pool (SSHTransportPool) :: transports to open shell and SFTP channels
+                                   on, e.g. ssh_pool.default_pool; by default
+                                   this object has its own transport
+        mode (str) :: how cmd() runs commands, 'shell' types them into the
+                      login() shell, 'exec' runs each on its own exec channel
+                      with real exit status and separate stderr, see runCommand()
     """
     logger = logging.getLogger(__name__)
-    def __init__(self, hostname, username, password=None, privateKey=None, port=22):
+    def __init__(self, hostname, username, password=None, privateKey=None, port=22, pool=None, mode='shell'):
         self.linesep = '\n'
         self.status = None
         self.hostname = hostname
@@ -25,6 +58,12 @@ class ssh_connect(object):
         self.waitstrDict = None
         self.transport = None
         self.channel = None
+        self.pool = pool
+        self.mode = mode
+        self.sessionLock = threading.Lock()
+        # exec channels of startCommand() still in use, close() ends them
+        self.execChannels = weakref.WeakSet()
+        self.channelLock = threading.Lock()
         # Thread local varialbes, different threads, independent variables
         self.localParam = threading.local()
 
@@ -39,17 +78,32 @@ class ssh_connect(object):
 
     def close(self):
         """
-        Disconnect the current connection
+        Disconnect the current connection and stop the commands running on
+        exec channels, a pooled transport stays open for other channels and
+        only the channels of this object are closed
         """
+        with self.channelLock:
+            channels = list(self.execChannels)
+        for channel in channels:
+            channel.close()
         if self.transport:
-            self.transport.close()
+            if self.pool:
+                if self.channel is not None:
+                    self.channel.close()
+            else:
+                self.transport.close()
             self.transport = None
             self.channel = None
 
     def createSFTPClient(self):
         """
-        create an SFT channel
+        create an SFT channel, on a pooled transport or the one login()
+        opened, a new connection is only made when neither is available
         """
+        if self.pool:
+            return self.pool.open_sftp(self)
+        if self.transport is not None and self.transport.is_active() and self.transport.is_authenticated():
+            return paramiko.SFTPClient.from_transport(self.transport)
         t = self.createClient()
         self.authentication(t)
         sftp = paramiko.SFTPClient.from_transport(t)
@@ -78,7 +132,7 @@ class ssh_connect(object):
                     raise Exception("start client error")
                 break
             except(socket.error, EOFError, paramiko.SSHException) as e:
-                self.logger.warn(e, 'host: %s:%s connection failed'%(self.hostname, self.port))
+                self.logger.warn('host: %s:%s connection failed: %s'%(self.hostname, self.port, e))
                 count += 1
                 sock.close()
                 time.sleep(3)
@@ -139,7 +193,7 @@ class ssh_connect(object):
             self.logger.warn('authentication timeout, ip:%s, user:%s, password:%s'%(self.hostname, self.username, self.password))
         if not transport.is_authenticated():
             error = transport.get_exception()
-            if error in None:
+            if error is None:
                 error = AuthenticationException('Authentication failed')
             raise error
 
@@ -182,58 +236,119 @@ class ssh_connect(object):
                 self.logger.debug('host:%s, send cmd:%s'%(self.hostname, cmd))
                 return True
             except socket.timeout as e:
-                self.logger.warn(e, 'execute cmd: %s timeout'%cmd,)
+                self.logger.warn('execute cmd: %s timeout: %s'%(cmd, e))
             nowTime = time.time()
         return False
 
-    def recv(self, waitstr="[>#]", nbytes=None, timeout=120, lastSendData=None):
+    def iter_recv(self, waitstr="[>#]", nbytes=32768, timeout=120, state=None, overlap=OVERLAP):
         """
-        Receive the command output after the command is sent
+        Yield the echo information chunk by chunk as it arrives, until the
+        end character is seen, the timeout passes or the channel closes
+
+        Only the new data and the last overlap bytes before it are searched
+        for waitstr, so the cost does not grow with the output size; the
+        output is not kept here.
 
         Args:
-            waitstr (str) :: echo information end character
-            nbytes (int) :: the maximum amount of echo information reveiced each time
-            timeout (int) :: the longest time to wait for the echo to be received
+            waitstr (str) :: echo information end character, a regular expression
+            nbytes (int) :: the maximum amount of echo information received each time
+            timeout (int) :: the longest time to wait for the end character
+            state (dict) :: gets isMatch, matchStr and bytes (received so far)
+            overlap (int) :: bytes of earlier data searched again, longer than
+                             any end character that may arrive split
 
         Return:
-              Result :: Returns the echo information after the command is executed. If the command fails to be sent
-                        or the echo information is not returned, the user returns again
-                        - You need to call the connect method to reestabilish the connection before issuing the command
-              isMatch :: whether to match the echo end symbol
-              matchStr :: matching echo end character
+            generator of str chunks, ANSI colour codes removed
         """
         if not self.isActive():
             raise Exception('connection has been closed')
-        isMatch = False
-        matchStr = None
-        recv = ""
-        nowTime = time.time()
-        endTime = nowTime + timeout
+        state = {} if state is None else state
+        state.update(isMatch=False, matchStr=None, bytes=0)
+        if not isinstance(waitstr, bytes):
+            waitstr = waitstr.encode('utf-8')
+        pattern = re.compile(waitstr)
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        # the searched window: the overlap kept from before plus the new data
+        window = bytearray()
+        held = b''
+        endTime = time.time() + timeout
         channel = self.channel
         warnmsg = ""
-        while nowTime < endTime:
-            strGet = ""
-            match = None
+        while time.time() < endTime:
             try:
-                strGet = channel.recv(nbytes)
+                data = channel.recv(nbytes)
             except socket.timeout:
                 if not warnmsg:
                     warnmsg = 'echo is not received'
                     self.logger.warn(warnmsg)
-            if strGet is not "":
-                recv += strGet
-                match = re.search(waitstr, recv)
-            if match:
-                isMatch = True
-                matchStr = match.group()
+                continue
+            if not data:
+                self.logger.debug('host:%s, channel closed while waiting for %s'%(self.hostname, waitstr))
                 break
-            nowTime = time.time()
-        self.logger.debug("DEVICE INFO:\n%s"%recv)
-        p = re.compile(r'\x1b\[(?:\d{1,2};)?\d{0,2}m')
-        recv = p.sub("", recv)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            state['bytes'] += len(data)
+            if len(window) > overlap:
+                del window[:-overlap]
+            window += data
+            match = pattern.search(window)
+            chunk, held = _split_escape(held + data)
+            if match:
+                state['isMatch'] = True
+                state['matchStr'] = match.group().decode('utf-8', 'replace')
+                chunk += held
+                held = b''
+            text = ANSI_ESCAPE.sub("", decoder.decode(chunk, final=bool(match)))
+            if text:
+                yield text
+            if match:
+                return
+        text = ANSI_ESCAPE.sub("", decoder.decode(held, final=True))
+        if text:
+            yield text
+
+    def recv(self, waitstr="[>#]", nbytes=32768, timeout=120, lastSendData=None, max_output=None,
+             on_chunk=None):
+        """
+        Receive the command output after the command is sent
+
+        Args:
+            waitstr (str) :: echo information end character
+            nbytes (int) :: the maximum amount of echo information reveiced each time
+            timeout (int) :: the longest time to wait for the echo to be received
+            max_output (int) :: characters of echo information kept, the oldest
+                                are dropped beyond it, unlimited by default
+            on_chunk (callable) :: on_chunk(str) for every chunk as it arrives
+
+        Return:
+              Result :: Returns the echo information after the command is executed. If the command fails to be sent
+                        or the echo information is not returned, the user returns again
+                        - You need to call the connect method to reestabilish the connection before issuing the command
+              isMatch :: whether to match the echo end symbol
+              matchStr :: matching echo end character
+        """
+        state = {}
+        chunks = collections.deque()
+        kept = 0
+        for chunk in self.iter_recv(waitstr, nbytes, timeout, state):
+            if on_chunk is not None:
+                on_chunk(chunk)
+            chunks.append(chunk)
+            kept += len(chunk)
+            while max_output is not None and kept > max_output:
+                dropped = chunks.popleft()
+                kept -= len(dropped)
+                if kept < max_output:
+                    chunks.appendleft(dropped[len(dropped) - (max_output - kept):])
+                    kept = max_output
+        recv = "".join(chunks)
+        if state['bytes'] > len(recv) and max_output is not None:
+            self.logger.debug('host:%s, kept the last %d of %d bytes of echo'%(self.hostname, len(recv), state['bytes']))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("DEVICE INFO:\n%s"%recv)
         if recv == "":
             recv = None
-        return recv, isMatch, matchStr
+        return recv, state['isMatch'], state['matchStr']
 
     def isActive(self):
         """
@@ -243,15 +358,27 @@ class ssh_connect(object):
             return not self.channel.closed
         return False
 
+    def openSession(self):
+        """
+        Open a session channel on the pooled transport, or on this object's
+        own transport which is connected first when needed
+        """
+        if self.pool:
+            channel = self.pool.open_channel(self)
+            self.transport = channel.get_transport()
+            return channel
+        with self.sessionLock:
+            if self.transport is None or not self.transport.is_active():
+                t = self.createClient()
+                self.transport = t
+            self.authentication(self.transport)
+            return self.transport.open_session()
+
     def login(self):
         """
         Landing device
         """
-        if self.transport is None or not self.transport.is_active():
-            t = self.createClient()
-            self.transport = t
-        self.authentication(self.transport)
-        channel = self.transport.open_session()
+        channel = self.openSession()
         channel.get_pty(width=200, height=200)
         channel.invoke_shell()
         channel.settimeout(10)
@@ -286,10 +413,12 @@ class ssh_connect(object):
         return result, isMatch, matchStr
 
     def cmd(self, cmdSpec):
+        if cmdSpec.get('mode', self.mode) == 'exec':
+            return self.runCommand(cmdSpec)
         defaultwaitstr = self.waitstrDict.get('normal', '[#|>]')
         result = {'rc':None, 'stderr':None, 'stdout':''}
         if "directory" in cmdSpec:
-            tmpresult, isMatch, matchStr = self.execCommand('cd'+cmdSpec['directory'], defaultwaitstr)
+            tmpresult, isMatch, matchStr = self.execCommand('cd '+cmdSpec['directory'], defaultwaitstr)
             if tmpresult is None:
                 result['stdout'] = None
                 return result
@@ -325,6 +454,50 @@ class ssh_connect(object):
             result['stdout'] = None
         return result
 
+    def _shellOutput(self, cmdSpec, state):
+        """
+        Yield the output of a command typed into the login() shell, line by
+        line as it arrives, without the command echo and the final prompt;
+        state gets isMatch and rc
+        """
+        defaultwaitstr = self.waitstrDict.get('normal', '[#|>]')
+        timeout = cmdSpec.get('timeout', 600)
+        waitstr = cmdSpec.get('waitstr', defaultwaitstr)
+        if "directory" in cmdSpec:
+            self.execCommand('cd '+cmdSpec['directory'], defaultwaitstr)
+        cmdstr = re.sub('^sh -c', "", " ".join(cmdSpec['command']))
+        if not self.send(cmdstr, timeout):
+            raise Exception('send cmd %s to %s failed'%(cmdstr, self.hostname))
+        finished = False
+        echo = True
+        pending = ''
+        try:
+            for chunk in self.iter_recv(waitstr+'|'+defaultwaitstr, timeout=timeout, state=state):
+                text = pending + chunk
+                if echo:
+                    if '\n' not in text:
+                        pending = text
+                        continue
+                    echo = False
+                    line, _, rest = text.partition('\n')
+                    if line.rstrip('\r') == cmdstr:
+                        text = rest
+                # the unterminated last line may be the prompt
+                cut = text.rfind('\n') + 1
+                pending = text[cut:]
+                if cut:
+                    yield text[:cut]
+            if pending and not state['isMatch']:
+                yield pending
+            finished = True
+        finally:
+            if not finished and self.isActive():
+                # the reader stopped early, interrupt the command and skip its output
+                self.channel.send('\x03')
+                for chunk in self.iter_recv(defaultwaitstr, timeout=10):
+                    pass
+        state['rc'] = self.__lastCmdStatus()
+
     def __lastCmdStatus(self):
         defaultwaitstr = self.waitstrDict.get('normal', '[#|>]')
         result = self.execCommand('echo $?', defaultwaitstr, timeout=3)[0]
@@ -336,6 +509,160 @@ class ssh_connect(object):
                     return int(l[ind+1])
         return None
 
+    def _iterChannel(self, channel, timeout, nbytes=32768, state=None):
+        """
+        Yield (isStderr, data) of an exec channel as the data arrives, stdout
+        and stderr are drained together so a full stderr window cannot stall
+        stdout; state gets rc, the exit status or None when timeout passed
+        first. The channel is closed at the end.
+        """
+        state = {} if state is None else state
+        state['rc'] = None
+        endTime = time.time() + timeout
+        try:
+            while True:
+                got = False
+                if channel.recv_ready():
+                    yield False, channel.recv(nbytes)
+                    got = True
+                if channel.recv_stderr_ready():
+                    yield True, channel.recv_stderr(nbytes)
+                    got = True
+                if got:
+                    continue
+                if channel.eof_received or channel.closed:
+                    break
+                remaining = endTime - time.time()
+                if remaining <= 0:
+                    return
+                # the channel's pipe is set on stdout, stderr and EOF
+                select.select([channel], [], [], min(remaining, 1))
+            channel.status_event.wait(max(endTime - time.time(), 0))
+            if channel.exit_status_ready():
+                state['rc'] = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    def _pumpChannel(self, channel, onStdout, onStderr, timeout, nbytes=32768):
+        """
+        Return:
+            exit status, None when timeout passed first (the channel is closed)
+        """
+        state = {}
+        for isStderr, data in self._iterChannel(channel, timeout, nbytes, state):
+            if isStderr:
+                onStderr(data)
+            else:
+                onStdout(data)
+        return state['rc']
+
+    def _commandString(self, cmdSpec):
+        cmdstr = re.sub('^sh -c', "", " ".join(cmdSpec['command'])).strip()
+        if "directory" in cmdSpec:
+            cmdstr = 'cd %s && %s'%(cmdSpec['directory'], cmdstr)
+        return cmdstr
+
+    def startCommand(self, cmdSpec, combineStderr=False):
+        """
+        Start a command on a new exec channel, the input entries of cmdSpec
+        are written to its stdin
+
+        Return:
+            the channel, read it with recv/recv_stderr until EOF
+        """
+        cmdstr = self._commandString(cmdSpec)
+        channel = self.openSession()
+        with self.channelLock:
+            self.execChannels.add(channel)
+        try:
+            if combineStderr:
+                channel.set_combine_stderr(True)
+            channel.exec_command(cmdstr)
+            self.logger.debug('host:%s, exec cmd:%s'%(self.hostname, cmdstr))
+            if cmdSpec.get('input'):
+                channel.sendall(''.join(line + self.linesep for line in cmdSpec['input'][::2]))
+            channel.shutdown_write()
+        except Exception:
+            channel.close()
+            raise
+        return channel
+
+    def runCommand(self, cmdSpec):
+        """
+        Run a command on an exec channel, without a pty or prompt matching
+
+        Args:
+            cmdSpec (dict) :: as for cmd(): command (list), directory, timeout;
+                              the even entries of input are written to stdin,
+                              the waitstr entries are not needed
+
+        Return:
+            {'rc', 'stdout', 'stderr'}, rc is the command's exit status or None
+            when it did not finish within timeout; stdout and stderr are both set
+        """
+        timeout = cmdSpec.get('timeout', 600)
+        stdout = []
+        stderr = []
+        channel = self.startCommand(cmdSpec)
+        rc = self._pumpChannel(channel, stdout.append, stderr.append, timeout)
+        if rc is None:
+            self.logger.warn('host:%s, cmd: %s timeout after %ss'%(self.hostname, self._commandString(cmdSpec), timeout))
+        return {'rc': rc,
+                'stdout': b''.join(stdout).decode('utf-8', 'replace'),
+                'stderr': b''.join(stderr).decode('utf-8', 'replace')}
+
+    def stream(self, cmdSpec, lines=False, stderr=None, binary=False):
+        """
+        Run a command and get its output as it arrives, in constant memory
+
+        In shell mode the command is typed into the login() shell: its echo
+        and the final prompt are dropped and rc comes from 'echo $?'. In exec
+        mode (cmdSpec['mode'] or the object's mode) stdout is streamed and
+        stderr goes to the stderr sink.
+
+        Args:
+            cmdSpec (dict) :: command, directory, timeout, mode, waitstr (shell),
+                              input (exec only)
+            lines (bool) :: yield whole lines instead of chunks
+            stderr :: exec mode: a callable, a file object or a path getting
+                      stderr; 'stdout' merges it into the stream; by default
+                      the last MAX_STDERR characters are kept in .stderr
+            binary (bool) :: exec mode: yield bytes as received
+
+        Return:
+            CmdStream, iterate it (or call write_to) and read .rc afterwards
+
+        Example:
+            ssh = ssh_connect('10.18.18.102', 'root', 'ravi@123', mode='exec')
+            out = ssh.stream({'command': ['tcpdump', '-nr', '/tmp/big.pcap']}, lines=True)
+            for line in out:
+                pass
+            print(out.rc)
+            rc = ssh.stream({'command': ['find', '/']}).write_to('/tmp/find.txt')
+        """
+        return CmdStream(self, cmdSpec, lines, stderr, binary)
+
+    def runCommands(self, cmdSpecs, workers=None):
+        """
+        Run several commands at once, each on its own exec channel of the
+        same connection
+
+        Args:
+            cmdSpecs (list) :: cmdSpec dicts, see runCommand()
+            workers (int) :: commands running at once, the pool's channels
+                             per transport by default
+
+        Return:
+            list of runCommand() results, in cmdSpecs order
+        """
+        if workers is None:
+            workers = self.pool.max_channels if self.pool else 8
+        executor = ThreadPoolExecutor(max_workers=max(min(workers, len(cmdSpecs)), 1))
+        try:
+            return list(executor.map(self.runCommand, cmdSpecs))
+        finally:
+            executor.shutdown(wait=False)
+
     def reconnect(self):
         """
         Reconnection
@@ -369,13 +696,15 @@ class ssh_connect(object):
             sftp.close()
         return True
 
-    def downloadFile(self, remote, local):
+    def downloadFile(self, remote, local, workers=4):
         """
-        Download all files in a file or folder
+        Download a file or a folder with all its subfolders, several files at
+        once, resuming partial downloads, see ssh_transfer.SFTPTransfer
 
         Args:
             remote(str) :: remote file path
             local(str) :: local file path
+            workers(int) :: files downloaded at once
 
         Return:
               True/False
@@ -384,23 +713,30 @@ class ssh_connect(object):
               ssh = ssh_connect("10.18.18.102", 'root', 'ravi@123')
               ssh.downloadFile("/home/file.sh", "D:/ftp/get/file.sh")
         """
-        sftp = self.createSFTPClient()
         try:
-            if os.path.isdir(local):
-                file_list = sftp.listdir(remote)
-                if len(file_list) != 0:
-                    for file in sftp.listdir(remote):
-                        self.localParam.rate=0
-                        sftp.get(os.path.join(remote+file), os.path.join(local+file), self.callback())
-                else:
-                    self.localParam.rate = 0
-                    sftp.get(remote, local, self.callback())
+            result = SFTPTransfer(self, workers=workers).download(remote, local)
         except Exception as e:
             self.logger.error('Download file exception : %s'% e)
             return False
-        finally:
-            sftp.close()
-        return True
+        if not result.ok:
+            self.logger.error('Download failed for : %s'% result.errors)
+        return result.ok
+
+    def uploadFile(self, local, remote, workers=4):
+        """
+        Upload a file or a folder with all its subfolders, see downloadFile()
+
+        Return:
+              True/False
+        """
+        try:
+            result = SFTPTransfer(self, workers=workers).upload(local, remote)
+        except Exception as e:
+            self.logger.error('Upload file exception : %s'% e)
+            return False
+        if not result.ok:
+            self.logger.error('Upload failed for : %s'% result.errors)
+        return result.ok
 
     def callback(self, sended, total):
         """
@@ -418,3 +754,156 @@ class ssh_connect(object):
         self.logger.info("file size: %dB, send: %dB, rate:%d"%(total, sended, i))
         if sended == total:
             self.logger.info('File transfer success')
+
+
+def _splitLines(chunks):
+    """
+    Regroup str or bytes chunks into lines, keeping the line ends
+    """
+    pending = None
+    for chunk in chunks:
+        pending = chunk if pending is None else pending + chunk
+        sep = b'\n' if isinstance(pending, bytes) else '\n'
+        start = 0
+        while True:
+            pos = pending.find(sep, start)
+            if pos < 0:
+                break
+            yield pending[start:pos + 1]
+            start = pos + 1
+        pending = pending[start:]
+    if pending:
+        yield pending
+
+
+class CmdStream(object):
+    """
+    Output of one command as it arrives, see ssh_connect.stream()
+
+    Iterating runs the command; rc, stderr, bytes and elapsed are set once
+    the output was read to the end. Stopping early closes an exec channel,
+    or interrupts the command in the login shell.
+    """
+    def __init__(self, conn, cmdSpec, lines=False, stderr=None, binary=False):
+        self.conn = conn
+        self.cmdSpec = cmdSpec
+        self.lines = lines
+        self.stderrSink = stderr
+        self.binary = binary
+        self.mode = cmdSpec.get('mode', conn.mode)
+        self.rc = None
+        self.stderr = None
+        self.bytes = 0
+        self.elapsed = None
+        self._iter = None
+
+    def __iter__(self):
+        if self._iter is None:
+            self._iter = self._run()
+        return self._iter
+
+    def close(self):
+        if self._iter is not None:
+            self._iter.close()
+
+    def _run(self):
+        start = time.time()
+        chunks = self._execChunks() if self.mode == 'exec' else self._shellChunks()
+        if self.lines:
+            chunks = _splitLines(chunks)
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            chunks.close()
+            self.elapsed = time.time() - start
+
+    def _shellChunks(self):
+        state = {}
+        for chunk in self.conn._shellOutput(self.cmdSpec, state):
+            self.bytes += len(chunk)
+            yield chunk
+        self.rc = state['rc']
+
+    def _stderrWriter(self):
+        """
+        Return:
+            (write(bytes), finish())
+        """
+        sink = self.stderrSink
+        decode = (lambda data: data) if self.binary else (lambda data: data.decode('utf-8', 'replace'))
+        if sink is None:
+            kept = bytearray()
+
+            def write(data):
+                kept.extend(data)
+                if len(kept) > 2 * MAX_STDERR:
+                    del kept[:-MAX_STDERR]
+
+            def finish():
+                self.stderr = decode(bytes(kept[-MAX_STDERR:]))
+            return write, finish
+        if isinstance(sink, str):
+            f = io.open(sink, 'wb')
+            return f.write, f.close
+        if callable(sink):
+            return (lambda data: sink(decode(data))), (lambda: None)
+        return (lambda data: sink.write(decode(data))), (lambda: None)
+
+    def _execChunks(self):
+        conn = self.conn
+        merge = self.stderrSink == 'stdout'
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        channel = conn.startCommand(self.cmdSpec, combineStderr=merge)
+        # opened once the channel exists, a failed start leaves no file open
+        try:
+            writeStderr, finishStderr = self._stderrWriter() if not merge else (None, None)
+        except Exception:
+            channel.close()
+            raise
+        state = {}
+        try:
+            for isStderr, data in conn._iterChannel(channel, self.cmdSpec.get('timeout', 600), state=state):
+                self.bytes += len(data)
+                if isStderr:
+                    writeStderr(data)
+                    continue
+                if not self.binary:
+                    data = decoder.decode(data)
+                if data:
+                    yield data
+            if not self.binary:
+                tail = decoder.decode(b'', final=True)
+                if tail:
+                    yield tail
+        finally:
+            channel.close()
+            if finishStderr is not None:
+                finishStderr()
+        self.rc = state['rc']
+        if self.rc is None:
+            conn.logger.warn('host:%s, cmd: %s timeout after %ss'%(conn.hostname, conn._commandString(self.cmdSpec),
+                                                               self.cmdSpec.get('timeout', 600)))
+
+    def write_to(self, target):
+        """
+        Write the whole output to a local path, a file object or a callable
+
+        Return:
+            rc of the command
+        """
+        if isinstance(target, str):
+            if self.binary:
+                f = io.open(target, 'wb')
+            else:
+                f = io.open(target, 'w', encoding='utf-8', newline='')
+            with f:
+                for chunk in self:
+                    f.write(chunk)
+        elif callable(target):
+            for chunk in self:
+                target(chunk)
+        else:
+            for chunk in self:
+                target.write(chunk)
+        return self.rc
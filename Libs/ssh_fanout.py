@@ -0,0 +1,285 @@
+"""
+Run one command on many hosts over SSH
+
+SSHFanout keeps one ssh_connect per host of an inventory and runs the same
+cmdSpec (the dict ssh_connect.cmd takes) on all of them from a bounded
+thread pool. Each host gets its own deadline, a dropped connection is
+re-established and the command retried, and results are yielded as the
+hosts finish, so a fleet-wide check takes about as long as its slowest host.
+With mode='exec' (per cmdSpec or as an ssh_connect default) commands run on
+exec channels and report their real exit status.
+
+Example:
+    fanout = SSHFanout(['10.0.0.1', '10.0.0.2', 'admin@10.0.0.3:2222'],
+                       username='root', password='ravi@123', workers=32)
+    for result in fanout.stream({'command': ['uname', '-r'], 'timeout': 30}):
+        print(result.host, result.rc, result.stdout)
+    print(fanout.run({'command': ['uptime'], 'mode': 'exec'}).summary())
+    fanout.close()
+"""
+
+import time
+import socket
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import paramiko
+
+from ssh_connect import ssh_connect
+
+# errors of a dropped or unreachable connection, worth a reconnect and retry;
+# not OSError as a whole, SFTP and runner file errors must not rerun a runner
+RETRY_ERRORS = (socket.timeout, ConnectionError, EOFError, paramiko.SSHException)
+
+
+class HostCmdResult(object):
+    """
+    Outcome of one command on one host
+
+    error is set when the host could not be reached or timed out, a command
+    that ran and failed only has a non zero rc
+    """
+    __slots__ = ('host', 'rc', 'stdout', 'stderr', 'error', 'elapsed', 'attempts')
+
+    def __init__(self, host, rc=None, stdout=None, stderr=None, error=None, elapsed=None, attempts=0):
+        self.host = host
+        self.rc = rc
+        self.stdout = stdout
+        self.stderr = stderr
+        self.error = error
+        self.elapsed = elapsed
+        self.attempts = attempts
+
+    @property
+    def ok(self):
+        return self.error is None and self.rc == 0
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'HostCmdResult(%s, rc=%s, elapsed=%s, error=%s)'%(self.host, self.rc, self.elapsed, self.error)
+
+
+class FanoutResult(object):
+    """
+    Per-host results of one fan-out, in inventory order
+    """
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    def __getitem__(self, host):
+        return self.results[host]
+
+    def __iter__(self):
+        return iter(self.results.values())
+
+    def succeeded(self):
+        return [r.host for r in self if r.ok]
+
+    def failed(self):
+        """
+        host -> error, or the rc of hosts where the command failed
+        """
+        return OrderedDict((r.host, r.error or 'rc=%s'%r.rc) for r in self if not r.ok)
+
+    def by_rc(self):
+        groups = OrderedDict()
+        for r in self:
+            groups.setdefault(r.rc, []).append(r.host)
+        return groups
+
+    def summary(self):
+        times = [r.elapsed for r in self if r.elapsed is not None]
+        return {'hosts': len(self.results),
+                'succeeded': len(self.succeeded()),
+                'failed': len(self.results) - len(self.succeeded()),
+                'unreachable': len([r for r in self if r.error is not None]),
+                'elapsed': self.elapsed,
+                'min_host': min(times) if times else None,
+                'max_host': max(times) if times else None,
+                'avg_host': sum(times) / len(times) if times else None}
+
+
+def parse_host(entry, defaults):
+    """
+    ssh_connect kwargs of one inventory entry
+
+    Args:
+        entry :: 'host', 'user@host', 'host:port', 'user@host:port' or a dict
+                 of ssh_connect arguments (hostname, username, password,
+                 privateKey, port), missing values come from defaults
+    """
+    if isinstance(entry, dict):
+        kwargs = dict(defaults)
+        kwargs.update(entry)
+        kwargs.pop('name', None)
+        return kwargs
+    kwargs = dict(defaults)
+    user, _, host = entry.rpartition('@')
+    if user:
+        kwargs['username'] = user
+    host, _, port = host.partition(':')
+    kwargs['hostname'] = host
+    if port:
+        kwargs['port'] = int(port)
+    return kwargs
+
+
+def host_name(entry):
+    if isinstance(entry, dict):
+        if 'name' in entry:
+            return entry['name']
+        if entry.get('port', 22) != 22:
+            return '%s:%s'%(entry['hostname'], entry['port'])
+        return entry['hostname']
+    return entry
+
+
+class SSHFanout(object):
+    """
+    Args:
+        inventory (list) :: hosts, see parse_host(); results are keyed by the
+                            entry string or the dict's 'name'/'hostname'
+        workers (int) :: hosts served at once
+        connect_timeout (float) :: seconds allowed for login on top of the
+                                   command timeout
+        retries (int) :: reconnect and rerun this often after a connection error
+        pool :: passed to every ssh_connect
+        defaults :: ssh_connect arguments of every host, e.g. username, password
+
+    Example:
+        fanout = SSHFanout([{'hostname': '10.0.0.1', 'password': 'a'}, '10.0.0.2'],
+                           username='root', password='ravi@123')
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, inventory, workers=32, connect_timeout=60, retries=1, pool=None, **defaults):
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.hosts = OrderedDict()
+        for entry in inventory:
+            self.hosts[host_name(entry)] = parse_host(entry, defaults)
+        if pool is not None:
+            for kwargs in self.hosts.values():
+                kwargs.setdefault('pool', pool)
+        self.conns = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(min(workers, len(self.hosts)), 1))
+
+    def connection(self, host):
+        with self.lock:
+            conn = self.conns.get(host)
+            if conn is None:
+                conn = self.conns[host] = ssh_connect(**self.hosts[host])
+        return conn
+
+    def _deadline(self, spec):
+        return spec.get('timeout', 600) + self.connect_timeout
+
+    def _run_host(self, host, spec, runner):
+        start = time.time()
+        conn = self.connection(host)
+        timed_out = []
+
+        def expire():
+            # unblocks the prompt wait of the worker thread and ends its exec
+            # channels, which closing a pooled connection alone leaves running
+            timed_out.append(True)
+            conn.close()
+        watchdog = threading.Timer(self._deadline(spec), expire)
+        watchdog.daemon = True
+        watchdog.start()
+        result = HostCmdResult(host)
+        # exec channels need no login shell
+        shell = spec.get('mode', conn.mode) != 'exec'
+        try:
+            while True:
+                result.attempts += 1
+                try:
+                    if shell and not conn.isActive():
+                        conn.reconnect()
+                    reply = runner(conn, spec)
+                    if timed_out:
+                        raise socket.timeout()
+                    if reply['rc'] is None:
+                        if shell and not conn.isActive():
+                            raise EOFError('connection to %s lost'%host)
+                        if not shell:
+                            result.error = 'timeout after %ss'%spec.get('timeout', 600)
+                    result.rc = reply['rc']
+                    result.stdout = reply['stdout']
+                    result.stderr = reply['stderr']
+                    break
+                except Exception as e:
+                    if timed_out:
+                        result.error = 'timeout after %ss'%self._deadline(spec)
+                        break
+                    if (result.attempts > self.retries or not isinstance(e, RETRY_ERRORS) or
+                            isinstance(e, paramiko.AuthenticationException)):
+                        result.error = str(e) or repr(e)
+                        break
+                    self.logger.warn('host %s: %s, reconnecting'%(host, e))
+                    conn.close()
+        finally:
+            watchdog.cancel()
+        result.elapsed = time.time() - start
+        return result
+
+    def submit(self, cmdSpec, hosts=None, runner=None):
+        """
+        Start cmdSpec on the hosts, all of them by default
+
+        Args:
+            runner (callable) :: runner(conn, cmdSpec) -> {'rc', 'stdout',
+                                 'stderr'}, ssh_connect.cmd by default
+
+        Return:
+            host -> Future of HostCmdResult
+        """
+        runner = runner or (lambda conn, spec: conn.cmd(spec))
+        hosts = list(self.hosts) if hosts is None else hosts
+        return OrderedDict((host, self.executor.submit(self._run_host, host, cmdSpec, runner))
+                           for host in hosts)
+
+    def stream(self, cmdSpec, hosts=None, runner=None):
+        """
+        Run cmdSpec on the hosts and yield each HostCmdResult as soon as the
+        host is done
+        """
+        futures = self.submit(cmdSpec, hosts, runner)
+        for future in as_completed(list(futures.values())):
+            yield future.result()
+
+    def run(self, cmdSpec, hosts=None, runner=None, callback=None):
+        """
+        Run cmdSpec on the hosts and wait for all of them
+
+        Args:
+            callback (callable) :: callback(HostCmdResult), called as hosts finish
+
+        Return:
+            FanoutResult
+        """
+        start = time.time()
+        results = {}
+        for result in self.stream(cmdSpec, hosts, runner):
+            results[result.host] = result
+            if callback is not None:
+                callback(result)
+        ordered = OrderedDict((host, results[host]) for host in self.hosts if host in results)
+        fanout = FanoutResult(ordered, time.time() - start)
+        if fanout.failed():
+            self.logger.debug('fan-out failed on %s'%fanout.failed())
+        return fanout
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self.lock:
+            conns = list(self.conns.values())
+            self.conns.clear()
+        for conn in conns:
+            conn.close()
@@ -0,0 +1,222 @@
+"""
+Process wide pool of authenticated SSH transports
+
+Connecting and authenticating is most of the cost of a short command or file
+transfer. SSHTransportPool keeps transports per (host, user, port) and opens
+new channels (shell, exec, SFTP) on them, with at most max_channels live
+channels per transport; when all transports of a host are full another one
+is connected. Transports are only shared by connections with the same
+password and private key, a connection never gets a transport that was
+authenticated with other credentials. Pooling is opt-in, pass the pool to
+ssh_connect. Pooled transports send keepalives and a reaper thread closes
+the ones that had no open channel for idle_timeout seconds.
+
+Example:
+    ssh = ssh_connect('10.18.18.102', 'root', 'ravi@123', pool=default_pool)
+    sftp = default_pool.open_sftp(ssh)
+    channel = default_pool.open_channel(ssh)
+    channel.exec_command('uptime')
+"""
+
+import time
+import hashlib
+import logging
+import threading
+
+import paramiko
+
+
+class PooledTransport(object):
+    __slots__ = ('transport', 'channels', 'pending', 'capacity', 'last_used')
+
+    def __init__(self, transport, capacity):
+        self.transport = transport
+        self.channels = []
+        # slots reserved by callers still opening their channel
+        self.pending = 0
+        self.capacity = capacity
+        self.last_used = time.time()
+
+    def live_channels(self):
+        self.channels = [ch for ch in self.channels if not ch.closed]
+        return len(self.channels)
+
+    def has_room(self):
+        return self.is_active() and self.live_channels() + self.pending < self.capacity
+
+    def is_active(self):
+        return self.transport.is_active() and self.transport.is_authenticated()
+
+
+class SSHTransportPool(object):
+    """
+    Args:
+        max_channels (int) :: live channels per transport, keep it below the
+                              server's MaxSessions (10 for OpenSSH)
+        keepalive (int) :: seconds between keepalive messages, 0 disables
+        idle_timeout (float) :: close transports without channels after this long
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_channels=8, keepalive=30, idle_timeout=300):
+        self.max_channels = max_channels
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.key_locks = {}
+        self.reaper = None
+        self.connects = 0
+
+    @staticmethod
+    def key(conn):
+        # the credentials are part of the key but only as a digest
+        credentials = hashlib.sha256()
+        for secret in (conn.password, conn.privateKey):
+            credentials.update(b'\0' + (b'' if secret is None else str(secret).encode('utf-8')))
+        return (conn.hostname, conn.username, conn.port, credentials.hexdigest())
+
+    def _start_reaper(self):
+        if self.reaper is not None:
+            return
+        self.reaper = threading.Thread(target=self._reap_loop, name='ssh-pool-reaper')
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(min(max(self.idle_timeout / 4.0, 1), 30))
+            try:
+                self.evict_idle()
+            except Exception as e:
+                self.logger.warn('ssh pool reaper: %s'%e)
+
+    def evict_idle(self, idle_timeout=None):
+        """
+        Close transports that are dead or had no live channel for idle_timeout seconds
+
+        Return:
+            number of transports closed
+        """
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.time()
+        evicted = []
+        with self.lock:
+            for key, pooled in list(self.hosts.items()):
+                keep = []
+                for entry in pooled:
+                    if not entry.is_active() or (entry.live_channels() == 0 and not entry.pending and
+                                                 now - entry.last_used >= idle_timeout):
+                        evicted.append(entry)
+                    else:
+                        keep.append(entry)
+                if keep:
+                    self.hosts[key] = keep
+                else:
+                    del self.hosts[key]
+        for entry in evicted:
+            entry.transport.close()
+        return len(evicted)
+
+    def _connect(self, conn):
+        transport = conn.createClient()
+        try:
+            conn.authentication(transport)
+        except Exception:
+            transport.close()
+            raise
+        if self.keepalive:
+            transport.set_keepalive(self.keepalive)
+        self.connects += 1
+        return PooledTransport(transport, self.max_channels)
+
+    def _reserve(self, conn):
+        """
+        Pick a transport with a free channel slot, connecting one when none
+        is left. The slot counts as pending until the caller adds its
+        channel or gives the slot back.
+        """
+        key = self.key(conn)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        # one handshake at a time per host, the others reuse its transport
+        with key_lock:
+            with self.lock:
+                for entry in self.hosts.get(key, ()):
+                    if entry.has_room():
+                        entry.pending += 1
+                        entry.last_used = time.time()
+                        return entry
+            entry = self._connect(conn)
+            entry.pending = 1
+            with self.lock:
+                self.hosts.setdefault(key, []).append(entry)
+        self._start_reaper()
+        return entry
+
+    def _open(self, conn, opener):
+        for attempt in range(2):
+            entry = self._reserve(conn)
+            try:
+                channel = opener(entry.transport)
+            except Exception as e:
+                with self.lock:
+                    entry.pending -= 1
+                    if isinstance(e, paramiko.ChannelException):
+                        # the server's session limit is lower than ours
+                        entry.capacity = max(entry.live_channels(), 1)
+                if not isinstance(e, (paramiko.SSHException, EOFError)):
+                    raise
+                # the transport died or refused the channel, try another one
+                self.logger.debug('open channel on %s:%s failed: %s'%(conn.hostname, conn.port, e))
+                continue
+            with self.lock:
+                entry.pending -= 1
+                entry.channels.append(channel)
+                entry.last_used = time.time()
+            return channel
+        raise paramiko.SSHException('no usable ssh transport to %s:%s'%(conn.hostname, conn.port))
+
+    def transport(self, conn):
+        """
+        A pooled transport of this host that had a free channel slot,
+        channels opened on it directly are not counted
+        """
+        entry = self._reserve(conn)
+        with self.lock:
+            entry.pending -= 1
+        return entry.transport
+
+    def open_channel(self, conn):
+        """
+        Open a session channel, then call invoke_shell/exec_command on it
+        """
+        return self._open(conn, lambda transport: transport.open_session())
+
+    def open_sftp(self, conn):
+        """
+        Open an SFTP client on a pooled transport, closing it frees its slot
+        """
+        sftp = []
+
+        def opener(transport):
+            sftp.append(paramiko.SFTPClient.from_transport(transport))
+            return sftp[-1].get_channel()
+        self._open(conn, opener)
+        return sftp[-1]
+
+    def stats(self):
+        with self.lock:
+            return dict(('%s@%s:%s'%(key[1], key[0], key[2]),
+                         [entry.live_channels() for entry in pooled])
+                        for key, pooled in self.hosts.items())
+
+    def close_all(self):
+        with self.lock:
+            pooled = [entry for entries in self.hosts.values() for entry in entries]
+            self.hosts.clear()
+        for entry in pooled:
+            entry.transport.close()
+
+
+default_pool = SSHTransportPool()
@@ -0,0 +1,302 @@
+"""
+Push a local directory to hosts, sending only files that changed
+
+DeltaSync hashes the local tree with sha256 once and keeps the digests in a
+manifest cache keyed by size and mtime, so later runs only rehash files that
+were touched. The remote side is hashed with one sha256sum command on an
+exec channel, and only new or changed files are sent: over the shared SFTP
+transport, or packed into one tar.gz when compress is set. dry_run gives the
+diff without changing anything.
+
+Example:
+    sync = DeltaSync('/opt/test_bundle', exclude=['*.pyc', '.git'])
+    ssh = ssh_connect('10.18.18.102', 'root', 'ravi@123')
+    print(sync.push(ssh, '/opt/test_bundle', dry_run=True))
+    result = sync.push(ssh, '/opt/test_bundle', delete=True)
+
+    # the same bundle to a fleet
+    fanout = SSHFanout(hosts, username='root', password='ravi@123')
+    fanout.run({'mode': 'exec', 'remote': '/opt/test_bundle'}, runner=sync.runner)
+"""
+
+import os
+import re
+import json
+import time
+import stat
+import fnmatch
+import hashlib
+import logging
+import tarfile
+import tempfile
+import threading
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from ssh_transfer import SFTPTransfer
+
+HASH_BLOCK = 1 << 20
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _unescape(name):
+    # sha256sum prefixes lines whose file name has a backslash or newline with '\',
+    # one left to right pass so an escaped backslash followed by 'n' stays as is
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), name)
+
+
+def parse_sha256sum(text):
+    """
+    Return:
+        {relative path: digest} of 'sha256sum' output for paths under '.'
+    """
+    digests = {}
+    for line in text.splitlines():
+        escaped = line.startswith('\\')
+        if escaped:
+            line = line[1:]
+        digest, sep, name = line.partition('  ')
+        if not sep:
+            continue
+        if escaped:
+            name = _unescape(name)
+        if name.startswith('./'):
+            name = name[2:]
+        digests[name] = digest
+    return digests
+
+
+class SyncPlan(object):
+    """
+    Difference between the local tree and one remote directory
+    """
+    def __init__(self, remote, added, changed, deleted, unchanged):
+        self.remote = remote
+        self.added = added
+        self.changed = changed
+        self.deleted = deleted
+        self.unchanged = unchanged
+        # set by push()
+        self.bytes = None
+        self.elapsed = None
+
+    @property
+    def upload(self):
+        return self.added + self.changed
+
+    def summary(self):
+        return {'remote': self.remote, 'added': len(self.added), 'changed': len(self.changed),
+                'deleted': len(self.deleted), 'unchanged': self.unchanged,
+                'bytes': self.bytes, 'elapsed': self.elapsed}
+
+    def __str__(self):
+        lines = ['%s: %d added, %d changed, %d deleted, %d unchanged'%(
+            self.remote, len(self.added), len(self.changed), len(self.deleted), self.unchanged)]
+        lines += ['+ %s'%rel for rel in self.added]
+        lines += ['~ %s'%rel for rel in self.changed]
+        lines += ['- %s'%rel for rel in self.deleted]
+        return '\n'.join(lines)
+
+
+class DeltaSync(object):
+    """
+    Args:
+        local (str) :: local directory to push
+        cache (str) :: manifest cache file, ~/.ssh_sync/<hash of local>.json
+                       by default, None disables the cache
+        exclude (list) :: fnmatch patterns of file or directory names to skip
+        compress (bool) :: send the changed files as one tar.gz, better for
+                           many small files or slow links; needs tar remotely
+        workers (int) :: files uploaded at once without compress
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, local, cache='', exclude=(), compress=False, workers=4):
+        self.local = os.path.abspath(local)
+        if cache == '':
+            key = hashlib.sha1(self.local.encode('utf-8')).hexdigest()
+            cache = os.path.join(os.path.expanduser('~'), '.ssh_sync', key + '.json')
+        self.cache = cache
+        self.exclude = list(exclude)
+        self.compress = compress
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.digests = None
+
+    def _excluded(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.exclude)
+
+    def _loadCache(self):
+        if not self.cache or not os.path.exists(self.cache):
+            return {}
+        try:
+            with open(self.cache) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            self.logger.warn('ignoring manifest cache %s: %s'%(self.cache, e))
+            return {}
+
+    def _saveCache(self, entries):
+        if not self.cache:
+            return
+        directory = os.path.dirname(self.cache)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '%s.%d'%(self.cache, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp, self.cache)
+
+    def manifest(self, refresh=False):
+        """
+        Local digests, files whose size and mtime match the cache are not
+        read again; computed once per DeltaSync unless refresh is set
+
+        Return:
+            {relative path: digest}
+        """
+        with self.lock:
+            if self.digests is not None and not refresh:
+                return self.digests
+            cached = self._loadCache()
+            entries = {}
+            hashed = 0
+            for root, dirnames, filenames in os.walk(self.local):
+                dirnames[:] = [name for name in dirnames if not self._excluded(name)]
+                rel_root = os.path.relpath(root, self.local)
+                rel_root = '' if rel_root == '.' else rel_root.replace(os.sep, '/')
+                for name in filenames:
+                    if self._excluded(name):
+                        continue
+                    path = os.path.join(root, name)
+                    st = os.stat(path)
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    rel = rel_root + '/' + name if rel_root else name
+                    entry = cached.get(rel)
+                    if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+                        entry = [st.st_size, st.st_mtime, file_digest(path)]
+                        hashed += 1
+                    entries[rel] = entry
+            if hashed or len(entries) != len(cached):
+                self._saveCache(entries)
+            self.logger.debug('manifest of %s: %d files, %d hashed'%(self.local, len(entries), hashed))
+            self.digests = dict((rel, entry[2]) for rel, entry in entries.items())
+            return self.digests
+
+    def remoteManifest(self, conn, remote, timeout=600):
+        """
+        Digests of the files under the remote directory, empty when it does
+        not exist
+
+        Return:
+            {relative path: digest}
+        """
+        command = ('if [ -d {0} ]; then cd {0} && find . -type f -print0 | xargs -0 -r sha256sum; fi'
+                   .format(quote(remote)))
+        result = conn.runCommand({'command': [command], 'timeout': timeout})
+        if result['rc'] != 0:
+            raise Exception('hashing %s on %s failed, rc %s: %s'%(remote, conn.hostname, result['rc'],
+                                                                  result['stderr'].strip()))
+        digests = parse_sha256sum(result['stdout'])
+        return dict((rel, digest) for rel, digest in digests.items()
+                    if not any(self._excluded(part) for part in rel.split('/')))
+
+    def diff(self, conn, remote, delete=False):
+        """
+        Return:
+            SyncPlan of the changes push() would make
+        """
+        local = self.manifest()
+        theirs = self.remoteManifest(conn, remote)
+        added = sorted(rel for rel in local if rel not in theirs)
+        changed = sorted(rel for rel in local if rel in theirs and theirs[rel] != local[rel])
+        deleted = sorted(rel for rel in theirs if rel not in local) if delete else []
+        return SyncPlan(remote, added, changed, deleted, len(local) - len(added) - len(changed))
+
+    def _localPath(self, rel):
+        return os.path.join(self.local, *rel.split('/'))
+
+    def _sendArchive(self, conn, remote, files):
+        fd, archive = tempfile.mkstemp(suffix='.tar.gz', prefix='ssh_sync_')
+        os.close(fd)
+        remote_archive = '%s/.ssh_sync.%d.%d.tar.gz'%(remote.rstrip('/'), os.getpid(), threading.current_thread().ident)
+        try:
+            with tarfile.open(archive, 'w:gz') as tar:
+                for rel in files:
+                    tar.add(self._localPath(rel), arcname=rel, recursive=False)
+            sent = SFTPTransfer(conn, skip_same=False, resume=False).upload(archive, remote_archive)
+            if not sent.ok:
+                raise Exception('sending archive failed: %s'%sent.errors)
+            result = conn.runCommand({'command': ['tar -xzf %s -C %s; rc=$?; rm -f %s; exit $rc'%(
+                quote(remote_archive), quote(remote), quote(remote_archive))]})
+            if result['rc'] != 0:
+                raise Exception('unpacking on %s failed: %s'%(conn.hostname, result['stderr'].strip()))
+            return os.path.getsize(archive)
+        finally:
+            os.remove(archive)
+
+    def _deleteRemote(self, conn, remote, files):
+        # in batches, to stay below the command line length limit
+        for start in range(0, len(files), 200):
+            batch = files[start:start + 200]
+            command = 'cd %s && rm -f -- %s'%(quote(remote), ' '.join(quote(rel) for rel in batch))
+            result = conn.runCommand({'command': [command]})
+            if result['rc'] != 0:
+                raise Exception('delete on %s failed: %s'%(conn.hostname, result['stderr'].strip()))
+
+    def push(self, conn, remote, delete=False, dry_run=False):
+        """
+        Make the remote directory match the local one
+
+        Args:
+            conn (ssh_connect) :: target host
+            remote (str) :: remote directory, created when missing
+            delete (bool) :: remove remote files that do not exist locally
+            dry_run (bool) :: only return the plan
+
+        Return:
+            SyncPlan, with bytes sent and elapsed set unless dry_run
+        """
+        start = time.time()
+        plan = self.diff(conn, remote, delete)
+        if dry_run:
+            return plan
+        sent = 0
+        upload = plan.upload
+        if upload:
+            result = conn.runCommand({'command': ['mkdir -p %s'%quote(remote)]})
+            if result['rc'] != 0:
+                raise Exception('mkdir %s on %s failed: %s'%(remote, conn.hostname, result['stderr'].strip()))
+        if upload and self.compress:
+            sent = self._sendArchive(conn, remote, upload)
+        elif upload:
+            transfer = SFTPTransfer(conn, workers=self.workers, skip_same=False, resume=False)
+            result = transfer.uploadFiles([(self._localPath(rel), rel) for rel in upload], remote)
+            if not result.ok:
+                raise Exception('upload to %s failed: %s'%(conn.hostname, result.errors))
+            sent = result.bytesDone
+        if plan.deleted:
+            self._deleteRemote(conn, remote, plan.deleted)
+        plan.bytes = sent
+        plan.elapsed = time.time() - start
+        self.logger.info('synced %s to %s:%s, %d files sent (%d bytes), %d deleted, %d unchanged in %.1fs'%(
+            self.local, conn.hostname, remote, len(upload), sent, len(plan.deleted), plan.unchanged, plan.elapsed))
+        return plan
+
+    def runner(self, conn, spec):
+        """
+        push() as an SSHFanout runner, spec gives remote and optionally
+        delete and dry_run; stdout is the plan
+        """
+        plan = self.push(conn, spec['remote'], spec.get('delete', False), spec.get('dry_run', False))
+        return {'rc': 0, 'stdout': str(plan), 'stderr': None}
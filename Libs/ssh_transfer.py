@@ -0,0 +1,455 @@
+"""
+Concurrent, resumable SFTP transfers of files and directory trees
+
+SFTPTransfer walks a remote (download) or local (upload) tree and moves its
+files from a few worker threads, each with its own SFTP channel on the
+connection's shared transport. Reads within a file are pipelined with
+prefetch and writes are pipelined without waiting for each ack. Files are
+written to '<name>.part' first and renamed when complete, so an interrupted
+transfer resumes from the size of the .part file. The source's size and mtime
+are kept next to it in '<name>.part.src', a .part of a source that changed
+since is started over. Destination files that already have the source's size
+and mtime are skipped. Progress is reported
+for the whole transfer, not per file.
+
+Example:
+    ssh = ssh_connect('10.18.18.102', 'root', 'ravi@123')
+    result = SFTPTransfer(ssh, workers=4).download('/var/crash', '/tmp/crash')
+    print(result.summary())
+    SFTPTransfer(ssh).upload('/tmp/bundle', '/opt/bundle')
+"""
+
+import os
+import stat
+import time
+import errno
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PART_SUFFIX = '.part'
+# sidecar of a .part file with the size and mtime of its source
+SOURCE_SUFFIX = '.src'
+BLOCK_SIZE = 32768
+
+
+class TransferResult(object):
+    """
+    Counters of a whole transfer, updated by the worker threads; errors is
+    path -> error of the files that failed
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.done = 0
+        self.skipped = 0
+        self.resumed = 0
+        self.bytesTotal = 0
+        self.bytesDone = 0
+        self.errors = {}
+        self.start = time.time()
+        self.end = None
+
+    def add(self, nbytes):
+        with self.lock:
+            self.bytesDone += nbytes
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def elapsed(self):
+        return (self.end or time.time()) - self.start
+
+    def summary(self):
+        elapsed = self.elapsed()
+        return {'files': self.files,
+                'transferred': self.done,
+                'skipped': self.skipped,
+                'resumed': self.resumed,
+                'failed': len(self.errors),
+                'bytes': self.bytesDone,
+                'bytes_total': self.bytesTotal,
+                'elapsed': elapsed,
+                'rate': self.bytesDone / elapsed if elapsed > 0 else None}
+
+
+def _same(size, mtime, other):
+    return other is not None and other[0] == size and int(other[1]) == int(mtime)
+
+
+def _sourceTag(size, mtime):
+    return '%d %d\n'%(size, int(mtime))
+
+
+def _readLocal(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _removeLocal(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class SFTPTransfer(object):
+    """
+    Args:
+        conn (ssh_connect) :: the connection, createSFTPClient() is called
+                              once per worker
+        workers (int) :: files transferred at once
+        resume (bool) :: continue from existing .part files
+        skip_same (bool) :: skip files whose destination has the same size and mtime
+        max_requests (int) :: outstanding read requests per file, on paramiko
+                              versions that support the limit
+        progress (callable) :: progress(TransferResult), called at most every
+                               interval seconds
+        interval (float) :: seconds between progress calls
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, conn, workers=4, resume=True, skip_same=True, max_requests=64, progress=None,
+                 interval=1.0):
+        self.conn = conn
+        self.workers = workers
+        self.resume = resume
+        self.skip_same = skip_same
+        self.max_requests = max_requests
+        self.progress = progress
+        self.interval = interval
+        self.local = threading.local()
+        self.clients = []
+        self.clientLock = threading.Lock()
+        self.lastReport = 0
+
+    def sftp(self):
+        """
+        The SFTP client of the calling worker thread
+        """
+        client = getattr(self.local, 'sftp', None)
+        if client is None:
+            client = self.local.sftp = self.conn.createSFTPClient()
+            with self.clientLock:
+                self.clients.append(client)
+        return client
+
+    def _closeClients(self):
+        with self.clientLock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            client.close()
+        self.local = threading.local()
+
+    def _report(self, stats, force=False):
+        if self.progress is None:
+            return
+        # workers report concurrently, one progress call at a time
+        with stats.lock:
+            now = time.time()
+            if force or now - self.lastReport >= self.interval:
+                self.lastReport = now
+                self.progress(stats)
+
+    def walkRemote(self, remote):
+        """
+        Return:
+            ([remote dirs], [(remote path, relative path, size, mtime)]),
+            a single file has the relative path ''
+        """
+        sftp = self.sftp()
+        attr = sftp.stat(remote)
+        if not stat.S_ISDIR(attr.st_mode):
+            return [], [(remote, '', attr.st_size, attr.st_mtime)]
+        dirs = []
+        files = []
+        pending = [('', remote)]
+        while pending:
+            rel, path = pending.pop()
+            dirs.append(rel)
+            for entry in sftp.listdir_attr(path):
+                child = path.rstrip('/') + '/' + entry.filename
+                childRel = rel + '/' + entry.filename if rel else entry.filename
+                mode = entry.st_mode
+                if stat.S_ISLNK(mode):
+                    # follow links to files, not to directories
+                    try:
+                        entry = sftp.stat(child)
+                    except IOError:
+                        continue
+                    mode = entry.st_mode
+                    if not stat.S_ISREG(mode):
+                        continue
+                if stat.S_ISDIR(mode):
+                    pending.append((childRel, child))
+                elif stat.S_ISREG(mode):
+                    files.append((child, childRel, entry.st_size, entry.st_mtime))
+        return dirs, files
+
+    @staticmethod
+    def walkLocal(local):
+        """
+        Return:
+            ([local dirs], [(local path, relative path, size, mtime)])
+        """
+        if not os.path.isdir(local):
+            st = os.stat(local)
+            return [], [(local, '', st.st_size, st.st_mtime)]
+        dirs = []
+        files = []
+        for root, dirnames, filenames in os.walk(local):
+            rel = os.path.relpath(root, local)
+            rel = '' if rel == '.' else rel.replace(os.sep, '/')
+            dirs.append(rel)
+            for name in filenames:
+                path = os.path.join(root, name)
+                if not os.path.isfile(path):
+                    continue
+                st = os.stat(path)
+                files.append((path, rel + '/' + name if rel else name, st.st_size, st.st_mtime))
+        return dirs, files
+
+    def _run(self, jobs, func, stats):
+        # largest files first, so the last worker is not left with a big one
+        jobs.sort(key=lambda job: -job[2])
+        stats.files = len(jobs)
+        stats.bytesTotal = sum(job[2] for job in jobs)
+
+        def run(job):
+            try:
+                func(job, stats)
+            except Exception as e:
+                self.logger.warn('transfer of %s failed: %s'%(job[0], e))
+                with stats.lock:
+                    stats.errors[job[0]] = str(e) or repr(e)
+            self._report(stats)
+        executor = ThreadPoolExecutor(max_workers=max(min(self.workers, len(jobs)), 1))
+        try:
+            list(executor.map(run, jobs))
+        finally:
+            executor.shutdown(wait=True)
+            self._closeClients()
+        stats.end = time.time()
+        self._report(stats, force=True)
+        summary = stats.summary()
+        self.logger.info('%d files, %d skipped, %d failed, %.1f MB in %.1fs, %.1f MB/s'%(
+            summary['files'], summary['skipped'], summary['failed'], summary['bytes'] / 1048576.0,
+            summary['elapsed'], (summary['rate'] or 0) / 1048576.0))
+        return stats
+
+    def _getFile(self, job, stats):
+        remote, local, size, mtime = job
+        if self.skip_same and os.path.exists(local):
+            st = os.stat(local)
+            if _same(size, mtime, (st.st_size, st.st_mtime)):
+                with stats.lock:
+                    stats.skipped += 1
+                return
+        part = local + PART_SUFFIX
+        source = part + SOURCE_SUFFIX
+        tag = _sourceTag(size, mtime)
+        offset = 0
+        if self.resume and os.path.exists(part) and _readLocal(source) == tag:
+            offset = os.path.getsize(part)
+            if offset > size:
+                offset = 0
+        if self.resume and not offset:
+            with open(source, 'w') as f:
+                f.write(tag)
+        sftp = self.sftp()
+        with sftp.open(remote, 'rb') as src:
+            src.seek(offset)
+            if offset < size:
+                try:
+                    src.prefetch(size, self.max_requests)
+                except TypeError:
+                    src.prefetch(size)
+            with open(part, 'ab' if offset else 'wb') as dst:
+                dst.truncate(offset)
+                if offset:
+                    with stats.lock:
+                        stats.resumed += 1
+                pos = offset
+                while pos < size:
+                    data = src.read(min(BLOCK_SIZE * 32, size - pos))
+                    if not data:
+                        break
+                    dst.write(data)
+                    pos += len(data)
+                    stats.add(len(data))
+                    self._report(stats)
+        if pos != size:
+            raise IOError('%s: got %d of %d bytes'%(remote, pos, size))
+        os.utime(part, (mtime, mtime))
+        os.rename(part, local)
+        _removeLocal(source)
+        with stats.lock:
+            stats.done += 1
+
+    def download(self, remote, local):
+        """
+        Download a remote file or directory tree
+
+        Args:
+            remote (str) :: remote file or directory
+            local (str) :: local destination; a remote file goes into an
+                           existing local directory under its own name
+
+        Return:
+            TransferResult
+        """
+        stats = TransferResult()
+        try:
+            dirs, files = self.walkRemote(remote)
+        except Exception:
+            self._closeClients()
+            raise
+        if not dirs and os.path.isdir(local):
+            local = os.path.join(local, os.path.basename(remote.rstrip('/')))
+        for rel in dirs:
+            path = os.path.join(local, *rel.split('/')) if rel else local
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        jobs = [(path, os.path.join(local, *rel.split('/')) if rel else local, size, mtime)
+                for path, rel, size, mtime in files]
+        return self._run(jobs, self._getFile, stats)
+
+    def _remoteStat(self, sftp, path):
+        try:
+            return sftp.stat(path)
+        except IOError as e:
+            if getattr(e, 'errno', None) == errno.ENOENT:
+                return None
+            raise
+
+    def _readRemote(self, sftp, path):
+        try:
+            with sftp.open(path, 'r') as f:
+                return f.read().decode()
+        except IOError:
+            return None
+
+    def _putFile(self, job, stats):
+        local, remote, size, mtime = job
+        sftp = self.sftp()
+        if self.skip_same:
+            attr = self._remoteStat(sftp, remote)
+            if attr is not None and _same(size, mtime, (attr.st_size, attr.st_mtime)):
+                with stats.lock:
+                    stats.skipped += 1
+                return
+        part = remote + PART_SUFFIX
+        source = part + SOURCE_SUFFIX
+        tag = _sourceTag(size, mtime)
+        offset = 0
+        if self.resume:
+            attr = self._remoteStat(sftp, part)
+            if attr is not None and attr.st_size <= size and self._readRemote(sftp, source) == tag:
+                offset = attr.st_size
+            if not offset:
+                with sftp.open(source, 'w') as f:
+                    f.write(tag)
+        with open(local, 'rb') as src:
+            src.seek(offset)
+            with sftp.open(part, 'r+b' if offset else 'wb') as dst:
+                dst.set_pipelined(True)
+                if offset:
+                    dst.seek(offset)
+                    with stats.lock:
+                        stats.resumed += 1
+                pos = offset
+                while True:
+                    data = src.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    dst.write(data)
+                    pos += len(data)
+                    stats.add(len(data))
+                    self._report(stats)
+        attr = sftp.stat(part)
+        if attr.st_size != pos:
+            raise IOError('%s: wrote %d of %d bytes'%(remote, attr.st_size, pos))
+        sftp.utime(part, (mtime, mtime))
+        sftp.chmod(part, stat.S_IMODE(os.stat(local).st_mode))
+        try:
+            sftp.posix_rename(part, remote)
+        except IOError:
+            # servers without the posix-rename extension refuse to replace
+            if self._remoteStat(sftp, remote) is not None:
+                sftp.remove(remote)
+            sftp.rename(part, remote)
+        if self.resume:
+            try:
+                sftp.remove(source)
+            except IOError:
+                pass
+        with stats.lock:
+            stats.done += 1
+
+    def upload(self, local, remote):
+        """
+        Upload a local file or directory tree
+
+        Args:
+            local (str) :: local file or directory
+            remote (str) :: remote destination; a local file goes into an
+                            existing remote directory under its own name
+
+        Return:
+            TransferResult
+        """
+        stats = TransferResult()
+        dirs, files = self.walkLocal(local)
+        sftp = self.sftp()
+        try:
+            if not dirs:
+                attr = self._remoteStat(sftp, remote)
+                if attr is not None and stat.S_ISDIR(attr.st_mode):
+                    remote = remote.rstrip('/') + '/' + os.path.basename(local)
+            for rel in dirs:
+                path = remote.rstrip('/') + '/' + rel if rel else remote
+                if self._remoteStat(sftp, path) is None:
+                    sftp.mkdir(path)
+        except Exception:
+            self._closeClients()
+            raise
+        jobs = [(path, remote.rstrip('/') + '/' + rel if rel else remote, size, mtime)
+                for path, rel, size, mtime in files]
+        return self._run(jobs, self._putFile, stats)
+
+    def uploadFiles(self, files, remote):
+        """
+        Upload some files of a local tree, creating the remote directories
+        they need
+
+        Args:
+            files (list) :: (local path, path relative to remote) pairs
+            remote (str) :: remote root directory
+
+        Return:
+            TransferResult
+        """
+        stats = TransferResult()
+        sftp = self.sftp()
+        dirs = set([''])
+        for local, rel in files:
+            parts = rel.split('/')[:-1]
+            for depth in range(1, len(parts) + 1):
+                dirs.add('/'.join(parts[:depth]))
+        try:
+            for rel in sorted(dirs):
+                path = remote.rstrip('/') + '/' + rel if rel else remote
+                if self._remoteStat(sftp, path) is None:
+                    sftp.mkdir(path)
+        except Exception:
+            self._closeClients()
+            raise
+        jobs = []
+        for local, rel in files:
+            st = os.stat(local)
+            jobs.append((local, remote.rstrip('/') + '/' + rel, st.st_size, st.st_mtime))
+        return self._run(jobs, self._putFile, stats)
@@ -0,0 +1,98 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from lock_async_server import AsyncLockServer
+
+
+@pytest.fixture
+def served():
+    produced = []
+    closed = threading.Event()
+
+    def stream(data, client):
+        try:
+            for index in range(data['count']):
+                time.sleep(data.get('delay', 0))
+                produced.append(index)
+                yield json.dumps({'index': index}) + '\n'
+        finally:
+            closed.set()
+
+    server = AsyncLockServer(lambda args, client: json.dumps(args), lambda data, client: data,
+                             lambda cmd, para: cmd == 'slow', workers=4, multi_cmd_stream=stream)
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    # the daemon thread serves until the test run exits
+    threading.Thread(target=server.serve_forever, args=('127.0.0.1', port), daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except socket.error:
+            time.sleep(0.05)
+    yield port, server, produced, closed
+
+
+def request(port, method, target, body=b''):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(('%s %s HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                  % (method, target, len(body))).encode() + body)
+    return sock
+
+
+def read_all(sock):
+    data = b''
+    while True:
+        got = sock.recv(65536)
+        if not got:
+            return data
+        data += got
+
+
+def test_fileop(served):
+    port, server, produced, closed = served
+    reply = read_all(request(port, 'GET', '/fileop?cmd=slow&fd=3'))
+    assert reply.startswith(b'HTTP/1.1 200')
+    assert json.loads(reply.split(b'\r\n\r\n', 1)[1]) == {'cmd': 'slow', 'fd': '3'}
+
+
+def test_stream_complete(served):
+    port, server, produced, closed = served
+    body = json.dumps({'stream': True, 'count': 50}).encode()
+    reply = read_all(request(port, 'POST', '/multi_cmd', body))
+    assert b'Transfer-Encoding: chunked' in reply
+    assert reply.count(b'"index"') == 50
+    assert reply.endswith(b'0\r\n\r\n')
+    assert closed.wait(5)
+
+
+def test_stream_stops_when_client_leaves(served):
+    port, server, produced, closed = served
+    body = json.dumps({'stream': True, 'count': 1000, 'delay': 0.01}).encode()
+    sock = request(port, 'POST', '/multi_cmd', body)
+    received = b''
+    while b'index' not in received:
+        received += sock.recv(65536)
+    sock.close()
+    assert closed.wait(5)
+    count = len(produced)
+    time.sleep(0.2)
+    assert len(produced) == count < 1000
+
+
+def test_stream_to_half_closed_client(served):
+    port, server, produced, closed = served
+    # idle longer than the server's disconnect check between results
+    body = json.dumps({'stream': True, 'count': 2, 'delay': 1.2}).encode()
+    sock = request(port, 'POST', '/multi_cmd', body)
+    # done sending, still reading
+    sock.shutdown(socket.SHUT_WR)
+    reply = read_all(sock)
+    assert reply.count(b'"index"') == 2
+    assert reply.endswith(b'0\r\n\r\n')
@@ -0,0 +1,32 @@
+import socket
+import threading
+import time
+
+from lock_cluster import LockCluster
+
+
+def test_hung_host_frees_its_worker():
+    # accepts connections and never answers
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    accepted = []
+    threading.Thread(target=lambda: accepted.append(listener.accept()), daemon=True).start()
+    address = '127.0.0.1:%d' % listener.getsockname()[1]
+    cluster = LockCluster([address], timeout=0.5, workers=1)
+    start = time.time()
+    result = cluster.close_session()
+    assert not result[address].ok
+    # the single worker is free again right after the timeout
+    free = cluster.executor.submit(time.time).result(5)
+    assert free - start < 3
+    cluster.close()
+    listener.close()
+
+
+def test_timeout_counts_from_call_start():
+    cluster = LockCluster(['127.0.0.1:1', '127.0.0.1:2'], timeout=0.5, workers=1)
+    # the second call waits for the worker longer than the timeout
+    result = cluster.scatter(lambda client: time.sleep(0.3) or 'done')
+    assert result.succeeded() == cluster.hosts
+    cluster.close()
@@ -0,0 +1,68 @@
+import pytest
+
+from lock_fd_table import FdTable, StaleHandle, SLOT_BITS, mode_flags
+
+
+def test_handles_are_never_zero_and_go_stale(tmp_path):
+    closed = []
+    table = FdTable(on_close=closed.append)
+    path = str(tmp_path / 'a')
+    entry = table.open(path, 'a+')
+    assert entry.handle != 0
+    assert entry.handle in table and len(table) == 1
+    table.close(entry.handle)
+    assert closed == [entry]
+    assert entry.handle not in table
+    with pytest.raises(StaleHandle):
+        table.get(entry.handle)
+    # the slot is reused with the next generation
+    again = table.open(path, 'r')
+    assert again.handle & ((1 << SLOT_BITS) - 1) == entry.handle & ((1 << SLOT_BITS) - 1)
+    assert again.handle != entry.handle
+    with pytest.raises(KeyError):
+        table.get(12345)
+
+
+def test_close_forgets_empty_session(tmp_path):
+    table = FdTable()
+    path = str(tmp_path / 'a')
+    first = table.open(path, 'a+', session='s1')
+    second = table.open(path, 'a+', session='s1')
+    table.close(first.handle)
+    assert table.sessions == {'s1': {second.handle}}
+    assert 's1' in table.last_seen
+    table.close(second.handle)
+    assert table.sessions == {}
+    assert table.last_seen == {}
+    assert table.session_info() == []
+
+
+def test_close_session_and_reap(tmp_path):
+    table = FdTable()
+    path = str(tmp_path / 'a')
+    for _ in range(3):
+        table.open(path, 'a+', session='s1')
+    table.open(path, 'a+', session='s2')
+    assert len(table.close_session('s1')) == 3
+    assert [info['session'] for info in table.session_info()] == ['s2']
+    assert table.reap(-1) == {'s2': 1}
+    assert len(table) == 0 and table.last_seen == {}
+
+
+def test_mode_flags():
+    assert mode_flags('rb') == mode_flags('r')
+    with pytest.raises(ValueError):
+        mode_flags('q')
+
+
+def test_close_waits_for_pinned_users(tmp_path):
+    closed = []
+    table = FdTable(on_close=closed.append)
+    entry = table.open(str(tmp_path / 'a'), 'a+')
+    with table.pinned(entry.handle) as pinned:
+        table.close(entry.handle)
+        assert entry.handle not in table
+        # the fd is still ours, a new open cannot get its number
+        assert table.open(str(tmp_path / 'b'), 'a+').fd != pinned.fd
+        assert closed == []
+    assert closed == [entry]
@@ -0,0 +1,39 @@
+import os
+
+from lock_mount_table import MountTable, parse_mountinfo
+
+LINE = '36 35 0:42 / %s rw,relatime shared:1 - nfs4 10.0.0.5:/export1 rw,vers=4.1,addr=10.0.0.5\n'
+
+
+def test_parse_mountinfo():
+    mounts = parse_mountinfo(LINE % '/mnt/with\\040space')
+    entry = mounts['/mnt/with space']
+    assert entry.source == '10.0.0.5:/export1'
+    assert entry.fstype == 'nfs4'
+    assert entry.option('vers') == '4.1'
+    assert entry.option('missing') is None
+
+
+def test_get_through_symlink(tmp_path):
+    real = tmp_path / 'real'
+    real.mkdir()
+    link = tmp_path / 'link'
+    os.symlink(str(real), str(link))
+    info = tmp_path / 'mountinfo'
+    info.write_text(LINE % os.path.realpath(str(real)))
+    table = MountTable(path=str(info))
+    assert table.get(str(link)).source == '10.0.0.5:/export1'
+    assert table.get(str(real) + '/') is not None
+    assert table.get(str(tmp_path / 'other')) is None
+
+
+def test_get_without_resolving(tmp_path):
+    real = tmp_path / 'real'
+    real.mkdir()
+    link = tmp_path / 'link'
+    os.symlink(str(real), str(link))
+    info = tmp_path / 'mountinfo'
+    info.write_text(LINE % str(real))
+    table = MountTable(path=str(info))
+    assert table.get(str(real) + '/./', resolve=False) is not None
+    assert table.get(str(link), resolve=False) is None
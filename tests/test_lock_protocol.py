@@ -0,0 +1,65 @@
+import threading
+from concurrent.futures import TimeoutError
+
+import pytest
+
+from lock_protocol import FrameServer, LockConnection, pack_frame, read_frame, CODEC_JSON
+
+
+@pytest.fixture
+def server():
+    release = threading.Event()
+
+    def dispatch(req, client):
+        if req['cmd'] == 'slow':
+            release.wait(5)
+        return {'cmd': req['cmd'], 'para': req.get('para'), 'result': 'success'}
+    srv = FrameServer(('127.0.0.1', 0), dispatch, lambda cmd, para: cmd == 'slow', workers=4)
+    srv.start()
+    yield srv, release
+    release.set()
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_frame_roundtrip():
+    import socket
+    a, b = socket.socketpair()
+    a.sendall(pack_frame(7, {'cmd': 'x', 'para': {'n': 1}}, CODEC_JSON))
+    assert read_frame(b) == (7, CODEC_JSON, {'cmd': 'x', 'para': {'n': 1}})
+    a.close()
+    b.close()
+
+
+def test_out_of_order_replies(server):
+    srv, release = server
+    conn = LockConnection('127.0.0.1', srv.server_address[1])
+    slow = conn.submit({'cmd': 'slow'})
+    assert conn.call({'cmd': 'fast', 'para': {'fd': 1}}, timeout=5)['para'] == {'fd': 1}
+    assert not slow.done()
+    release.set()
+    assert slow.result(5)['cmd'] == 'slow'
+    conn.close()
+
+
+def test_call_timeout_drops_pending(server):
+    srv, release = server
+    conn = LockConnection('127.0.0.1', srv.server_address[1])
+    with pytest.raises(TimeoutError):
+        conn.call({'cmd': 'slow'}, timeout=0.1)
+    assert conn.pending == {}
+    release.set()
+    assert conn.call({'cmd': 'fast'}, timeout=5)['result'] == 'success'
+    conn.close()
+
+
+def test_reply_to_cancelled_future_keeps_connection(server):
+    srv, release = server
+    conn = LockConnection('127.0.0.1', srv.server_address[1])
+    # the reply arrives after the caller gave up but before it left pending
+    slow = conn.submit({'cmd': 'slow'})
+    assert slow.cancel()
+    release.set()
+    assert conn.call({'cmd': 'fast'}, timeout=5)['result'] == 'success'
+    assert not conn.closed
+    conn.close()
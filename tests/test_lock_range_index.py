@@ -0,0 +1,93 @@
+import errno
+
+from lock_range_index import RangeIndex, LockBusy, SHARED, EXCLUSIVE, expand_range_spec
+
+
+def ranges(index, path):
+    return [(h['fd'], h['offset'], h['length'], h['mode']) for h in index.holders(path)]
+
+
+def test_add_merges_and_splits(tmp_path):
+    path = str(tmp_path / 'a')
+    index = RangeIndex()
+    index.track(1, path)
+    index.add(1, 0, 10, SHARED)
+    index.add(1, 10, 10, SHARED)
+    assert ranges(index, path) == [(1, 0, 20, SHARED)]
+    index.add(1, 5, 5, EXCLUSIVE)
+    assert ranges(index, path) == [(1, 0, 5, SHARED), (1, 5, 5, EXCLUSIVE), (1, 10, 10, SHARED)]
+    index.remove(1, 0, 7)
+    assert ranges(index, path) == [(1, 7, 3, EXCLUSIVE), (1, 10, 10, SHARED)]
+    index.add(1, 100, 0, SHARED)
+    assert ranges(index, path)[-1] == (1, 100, 0, SHARED)
+
+
+def test_conflicts(tmp_path):
+    path = str(tmp_path / 'a')
+    index = RangeIndex()
+    index.track(1, path)
+    index.track(2, path)
+    index.add(1, 0, 10, SHARED)
+    assert index.conflicts(path, 5, 10, SHARED) == []
+    assert [c['fd'] for c in index.conflicts(path, 5, 10, EXCLUSIVE)] == [1]
+    assert index.conflicts(path, 5, 10, EXCLUSIVE, fd=1) == []
+    assert index.conflicts(path, 10, 10, EXCLUSIVE) == []
+    # length 0 runs to EOF
+    assert [c['fd'] for c in index.conflicts(path, 9, 0, EXCLUSIVE)] == [1]
+
+
+def test_ofd_fds_are_separate_owners(tmp_path):
+    path = str(tmp_path / 'a')
+    index = RangeIndex()
+    index.track(1, path)
+    index.track(2, path)
+    index.add(1, 0, 10, SHARED)
+    index.add(2, 0, 10, SHARED)
+    index.remove(2, 0, 10)
+    index.untrack(2)
+    assert ranges(index, path) == [(1, 0, 10, SHARED)]
+
+
+def test_process_owned_fds_share_unlock_and_close(tmp_path):
+    path = str(tmp_path / 'a')
+    index = RangeIndex()
+    for fd in (1, 2, 3):
+        index.track(fd, path, process=True)
+    index.track(4, path)
+    index.add(1, 0, 10, SHARED)
+    index.add(2, 5, 10, SHARED)
+    index.add(4, 0, 10, SHARED)
+    # lockf merged both shared ranges, unlocking through fd 1 drops 0-10 for fd 2 too
+    index.remove(1, 0, 10)
+    assert ranges(index, path) == [(2, 10, 5, SHARED), (4, 0, 10, SHARED)]
+    index.add(1, 20, 5, EXCLUSIVE)
+    # closing any fd of the file drops every process owned range, not the OFD one
+    index.untrack(3)
+    assert ranges(index, path) == [(4, 0, 10, SHARED)]
+    index.untrack(4)
+    assert index.files == {}
+
+
+def test_lock_busy():
+    busy = LockBusy([{'fd': 7, 'offset': 0, 'length': 10, 'mode': EXCLUSIVE}])
+    assert busy.errno == errno.EAGAIN and 'fd 7' in str(busy)
+    assert LockBusy([], blocking=True).errno == errno.EDEADLK
+
+
+def test_expand_range_spec():
+    spec = {'start': 0, 'stride': 10, 'length': 2, 'count': 3}
+    assert list(expand_range_spec(spec)) == [(0, 2), (10, 2), (20, 2)]
+    assert list(expand_range_spec({'length': 4, 'count': 2, 'start': 8})) == [(8, 4), (12, 4)]
+    assert list(expand_range_spec({'length': 1, 'count': 0})) == []
+
+
+def test_expand_range_spec_seeded():
+    spec = {'start': 100, 'stride': 10, 'length': 2, 'count': 1000, 'seed': 7}
+    shuffled = list(expand_range_spec(spec))
+    assert shuffled == list(expand_range_spec(dict(spec)))
+    assert sorted(shuffled) == [(100 + i * 10, 2) for i in range(1000)]
+    assert shuffled != sorted(shuffled)
+    assert shuffled != list(expand_range_spec(dict(spec, seed=8)))
+    for count in (0, 1, 2, 3):
+        assert sorted(expand_range_spec({'length': 1, 'count': count, 'seed': 1})) == \
+            [(i, 1) for i in range(count)]
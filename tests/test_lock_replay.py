@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import File_Lock_Server_linux as server
+from lock_replay import plan_streams
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def records(self):
+        return [json.loads(line) for line in self.lines]
+
+
+@pytest.fixture
+def traced(tmp_path, monkeypatch):
+    server.log_writer.path = str(tmp_path / 'server.log')
+    recorder = Recorder()
+    monkeypatch.setattr(server, 'trace_writer', recorder)
+    return server.app.test_client(), recorder
+
+
+def fileop(client, **args):
+    return json.loads(client.get('/fileop', query_string=args).get_data(as_text=True))
+
+
+def test_timing_returns_server_duration(traced, tmp_path):
+    client, recorder = traced
+    result = fileop(client, cmd='open_file', file_path=str(tmp_path / 'a'), mode='a+', timing=1)
+    assert result['dur'] >= 0
+    assert 'timing' not in recorder.records()[0]['para']
+    fileop(client, cmd='close_file', fd=result['fd'])
+
+
+def test_streams_follow_sessions_and_batches(traced, tmp_path):
+    client, recorder = traced
+    path = str(tmp_path / 'locked')
+    # two sessions sharing one connection
+    first = fileop(client, cmd='open_file', file_path=path, mode='a+', session='s1')['fd']
+    second = fileop(client, cmd='open_file', file_path=path, mode='a+', session='s2')['fd']
+    batch = {'parallel': True,
+             'cmds': [{'cmd': 'lock_file', 'para': {'fd': first, 'op': 6, 'offset': 0, 'length': 10}},
+                      {'cmd': 'lock_file', 'para': {'fd': first, 'op': 6, 'offset': 20, 'length': 10}}]}
+    client.post('/multi_cmd', json=batch)
+    fileop(client, cmd='close_file', fd=second)
+    fileop(client, cmd='close_session', session='s1')
+    records = recorder.records()
+    assert len(set(r['client'] for r in records)) == 1
+    tags = [r['batch'] for r in records if 'batch' in r]
+    assert [(t['parallel'], t['index']) for t in sorted(tags, key=lambda t: t['index'])] == [(True, 0), (True, 1)]
+    assert tags[0]['id'] == tags[1]['id']
+    streams = plan_streams(records)
+    cmds = lambda units: [[records[i]['cmd'] for i in unit] for unit in units]
+    assert list(streams) == [('session', 's1'), ('session', 's2')]
+    assert cmds(streams[('session', 's1')]) == [['open_file'], ['lock_file', 'lock_file'], ['close_session']]
+    assert cmds(streams[('session', 's2')]) == [['open_file'], ['close_file']]
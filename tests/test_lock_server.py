@@ -0,0 +1,207 @@
+import json
+import time
+
+import pytest
+
+import File_Lock_Server_linux as server
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    server.log_writer.path = str(tmp_path_factory.mktemp('log') / 'server.log')
+    return server.app.test_client()
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'locked')
+
+
+def fileop(client, **args):
+    return json.loads(client.get('/fileop', query_string=args).get_data(as_text=True))
+
+
+def open_file(client, path, **args):
+    result = fileop(client, cmd='open_file', file_path=path, mode='a+', **args)
+    assert 'fd' in result, result
+    return result['fd']
+
+
+def holders(client, path):
+    return [(h['fd'], h['offset'], h['length'], h['mode'])
+            for h in fileop(client, cmd='list_locks', file_path=path)['locks']]
+
+
+def test_lock_unlock_close(client, path):
+    fd = open_file(client, path)
+    assert fileop(client, cmd='lock_file', fd=fd, op=6, offset=0, length=10)['result'] == 'success'
+    assert holders(client, path) == [(fd, 0, 10, 'ex')]
+    assert fileop(client, cmd='unlock_file', fd=fd, offset=0, length=10)['result'] == 'success'
+    assert holders(client, path) == []
+    assert fileop(client, cmd='close_file', fd=fd)['result'] == 'success'
+    closed = fileop(client, cmd='lock_file', fd=fd, op=6, offset=0, length=10)
+    assert closed['result'] == 'failed'
+
+
+def test_posix_overlap_is_reported(client, path):
+    first = open_file(client, path, lock_type='posix')
+    second = open_file(client, path, lock_type='posix')
+    assert fileop(client, cmd='lock_file', fd=first, op=6, offset=0, length=10)['result'] == 'success'
+    # one lock owner to the kernel, the overlap is granted and reported
+    merged = fileop(client, cmd='lock_file', fd=second, op=6, offset=5, length=10)
+    assert merged['result'] == 'success'
+    assert [c['fd'] for c in merged['conflicts']] == [first]
+    fileop(client, cmd='close_file', fd=second)
+    assert holders(client, path) == []
+    fileop(client, cmd='close_file', fd=first)
+
+
+def test_posix_overlap_refused(client, path, monkeypatch):
+    monkeypatch.setattr(server, 'refuse_posix_overlap', True)
+    first = open_file(client, path, lock_type='posix')
+    second = open_file(client, path, lock_type='posix')
+    assert fileop(client, cmd='lock_file', fd=first, op=6, offset=0, length=10)['result'] == 'success'
+    refused = fileop(client, cmd='lock_file', fd=second, op=6, offset=0, length=10)
+    assert refused['result'] == 'failed'
+    assert 'fd %s' % first in refused['reason']
+    blocking = fileop(client, cmd='lock_file', fd=second, op=2, offset=5, length=10)
+    assert blocking['result'] == 'failed'
+    assert holders(client, path) == [(first, 0, 10, 'ex')]
+    # closing any handle drops the process's locks on the file
+    fileop(client, cmd='close_file', fd=second)
+    assert holders(client, path) == []
+    fileop(client, cmd='close_file', fd=first)
+
+
+def test_posix_lockf_runs_outside_the_stripe(client, path, monkeypatch):
+    monkeypatch.setattr(server, 'refuse_posix_overlap', True)
+    seen = []
+
+    def lock_range(fd, op, length, offset):
+        seen.append((any(lock.locked() for lock in server.grant_locks), [list(p) for p in server.pending_grants.values()]))
+    monkeypatch.setitem(server.lock_calls, 'posix', (lock_range, server.lock_calls['posix'][1]))
+    fd = open_file(client, path, lock_type='posix')
+    assert fileop(client, cmd='lock_file', fd=fd, op=2, offset=0, length=10)['result'] == 'success'
+    assert seen == [(False, [[(fd, 0, 10, 'ex')]])]
+    assert server.pending_grants == {}
+    fileop(client, cmd='close_file', fd=fd)
+
+
+def test_ofd_handles_conflict_in_kernel(client, path):
+    first = open_file(client, path, lock_type='ofd')
+    second = open_file(client, path, lock_type='ofd')
+    assert fileop(client, cmd='lock_file', fd=first, op=6, offset=0, length=10)['result'] == 'success'
+    assert fileop(client, cmd='lock_file', fd=second, op=6, offset=0, length=10)['result'] == 'failed'
+    assert fileop(client, cmd='test_lock', fd=second, op=6, offset=0, length=10)['conflict'] is True
+    assert fileop(client, cmd='get_lock', fd=second, op=6, offset=0, length=10)['conflict'] is True
+    fileop(client, cmd='close_file', fd=second)
+    assert holders(client, path) == [(first, 0, 10, 'ex')]
+    fileop(client, cmd='close_file', fd=first)
+
+
+def test_lock_list_and_range_spec(client, path):
+    fd = open_file(client, path)
+    body = {'cmds': [{'cmd': 'lock_file', 'para': {'fd': fd, 'op': 5, 'range_spec':
+                                                   {'start': 0, 'stride': 10, 'length': 2, 'count': 3}}},
+                     {'cmd': 'lock_file', 'para': {'fd': fd, 'op': 6, 'lock_list':
+                                                   [{'offset': 100, 'length': 5}]}},
+                     {'cmd': 'list_locks', 'para': {'fd': fd}},
+                     {'cmd': 'close_file', 'para': {'fd': fd}}]}
+    cmds = client.post('/multi_cmd', json=body).get_json()['cmds']
+    assert cmds[0]['para']['passed'] == 3
+    assert cmds[1]['para']['lock_list'][0]['status'] == 'success'
+    assert [(h['offset'], h['length'], h['mode']) for h in cmds[2]['para']['locks']] == \
+        [(0, 2, 'sh'), (10, 2, 'sh'), (20, 2, 'sh'), (100, 5, 'ex')]
+    assert cmds[3]['para']['result'] == 'success'
+
+
+def test_sessions(client, path):
+    open_file(client, path, session='s1')
+    open_file(client, path, session='s1')
+    sessions = fileop(client, cmd='list_sessions')['sessions']
+    assert [(s['session'], s['handles']) for s in sessions] == [('s1', 2)]
+    assert fileop(client, cmd='close_session', session='s1')['closed'] == 2
+    assert fileop(client, cmd='list_sessions')['sessions'] == []
+
+
+def test_metrics(client):
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'lockserver_ops_total' in body
+
+
+def test_routed_ops_record_the_worker_syscall_time(monkeypatch):
+    class Pool(object):
+        def call(self, owner, request):
+            return {'para': {'result': 'success', 'locks': []}, 'syscall': 0.25}
+    monkeypatch.setattr(server, 'owner_pool', Pool())
+    before = server.op_seconds.values.get(('list_locks', 'syscall'), [None, 0.0])[1]
+    result = server.run_op('list_locks', {'file_path': '/x', 'owner': 3})
+    assert result['result'] == 'success'
+    assert server.op_seconds.values[('list_locks', 'syscall')][1] - before == pytest.approx(0.25)
+
+
+@pytest.mark.parametrize('lock_type', ['posix', 'ofd'])
+def test_lock_wait_granted_on_unlock(client, path, lock_type, monkeypatch):
+    # posix handles of the server only wait on each other when overlaps are refused
+    monkeypatch.setattr(server, 'refuse_posix_overlap', True)
+    holder = open_file(client, path, lock_type=lock_type)
+    waiter = open_file(client, path, lock_type=lock_type)
+    fileop(client, cmd='lock_file', fd=holder, op=6, offset=0, length=10)
+    queued = fileop(client, cmd='lock_wait', fd=waiter, op=2, offset=0, length=10, wait=30, poll=0.2)
+    assert queued['result'] == 'waiting'
+    assert holders(client, path) == [(holder, 0, 10, 'ex')]
+    fileop(client, cmd='unlock_file', fd=holder, offset=0, length=10)
+    granted = fileop(client, cmd='wait_status', ticket=queued['ticket'], poll=5)
+    assert granted['result'] == 'success'
+    assert holders(client, path) == [(waiter, 0, 10, 'ex')]
+    fileop(client, cmd='close_file', fd=holder)
+    fileop(client, cmd='close_file', fd=waiter)
+
+
+def test_wait_queue_sleeps_when_idle():
+    from lock_wait_queue import WaitQueue
+    waitq = WaitQueue(lambda waiter: False, lambda offset, length: (offset, offset + length))
+    assert waitq._timeout(0.5) is None
+    waiter = waitq.enqueue(1, '/a', 2, 0, 10, timeout=30)
+    # refused through this server only: no polling, wake up for the deadline
+    assert 25 < waitq.wait(waiter.ticket, 0.2)['remaining'] <= 30
+    assert waitq._timeout(0.5) > 25
+    assert waiter.attempts == 1
+    waitq.notify()
+    assert waitq.wait(waiter.ticket, 0.2)['attempts'] == 2
+
+
+def test_wait_queue_tries_locks_outside_its_condition():
+    import threading
+    from lock_wait_queue import WaitQueue, CANCELLED
+    entered = threading.Event()
+    release = threading.Event()
+
+    def try_lock(waiter):
+        if waiter.path == '/slow':
+            entered.set()
+            release.wait(5)
+        return False
+    waitq = WaitQueue(try_lock, lambda offset, length: (offset, offset + length))
+    slow = waitq.enqueue(1, '/slow', 2, 0, 10, timeout=30)
+    other = waitq.enqueue(2, '/other', 2, 0, 10, timeout=30)
+    assert entered.wait(5)
+    # a slow lockf on one file does not hold up other tickets
+    start = time.time()
+    assert waitq.cancel(other.ticket)['state'] == CANCELLED
+    waitq.notify()
+    assert time.time() - start < 1
+    # cancelling the ticket being tried waits for its attempt
+    threading.Timer(0.2, release.set).start()
+    assert waitq.cancel(slow.ticket)['state'] == CANCELLED
+    assert release.is_set()
+
+
+def test_filesystem_ops_leave_the_event_loop():
+    for name, para in [('open_file', {}), ('close_file', {}), ('close_session', {}),
+                       ('lock_file', {'op': 6}), ('unlock_file', {}), ('get_lock', {}),
+                       ('mount', {}), ('mount_batch', {}), ('lock_wait', {'poll': 5})]:
+        assert server.is_blocking(name, para), name
+    for name, para in [('test_lock', {}), ('list_locks', {}), ('list_sessions', {}),
+                       ('lock_wait', {'poll': 0}), ('wait_status', {}), ('wait_stats', {})]:
+        assert not server.is_blocking(name, para), name
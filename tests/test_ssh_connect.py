@@ -0,0 +1,25 @@
+import pytest
+
+from ssh_connect import ssh_connect, _splitLines
+
+
+def test_split_lines_across_chunks():
+    assert list(_splitLines(['a\nb', 'c\n', '\nd'])) == ['a\n', 'bc\n', '\n', 'd']
+    assert list(_splitLines([b'x', b'y\nz\n'])) == [b'xy\n', b'z\n']
+
+
+def test_split_lines_empty():
+    assert list(_splitLines([])) == []
+    assert list(_splitLines(['', ''])) == []
+
+
+def test_failed_start_opens_no_stderr_file(tmp_path):
+    conn = ssh_connect('10.0.0.1', 'root', 'pw', mode='exec')
+
+    def refuse(cmdSpec, combineStderr=False):
+        raise EOFError('channel refused')
+    conn.startCommand = refuse
+    sink = tmp_path / 'stderr'
+    with pytest.raises(EOFError):
+        list(conn.stream({'command': ['true']}, stderr=str(sink)))
+    assert not sink.exists()
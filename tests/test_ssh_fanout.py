@@ -0,0 +1,42 @@
+import time
+import threading
+
+from ssh_fanout import SSHFanout
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+def test_only_connection_errors_are_retried():
+    calls = []
+
+    def runner(conn, spec):
+        calls.append(spec['raise'])
+        if len(calls) == 1:
+            raise spec['raise']('boom')
+        return {'rc': 0, 'stdout': 'ok', 'stderr': ''}
+    fanout = SSHFanout(['10.0.0.1'], username='root', password='pw', mode='exec')
+    assert fanout.run({'raise': EOFError}, runner=runner)['10.0.0.1'].attempts == 2
+    del calls[:]
+    result = fanout.run({'raise': FileNotFoundError}, runner=runner)['10.0.0.1']
+    assert result.attempts == 1 and result.error == 'boom'
+    fanout.close()
+
+
+def test_deadline_closes_exec_channels():
+    def runner(conn, spec):
+        channel = FakeChannel()
+        conn.execChannels.add(channel)
+        channel.closed.wait(10)
+        return {'rc': None, 'stdout': '', 'stderr': ''}
+    fanout = SSHFanout(['10.0.0.1'], connect_timeout=0.1, username='root', password='pw', mode='exec')
+    start = time.time()
+    result = fanout.run({'timeout': 0.1}, runner=runner)['10.0.0.1']
+    assert time.time() - start < 5
+    assert result.error.startswith('timeout')
+    fanout.close()
@@ -0,0 +1,18 @@
+from ssh_pool import SSHTransportPool
+from ssh_connect import ssh_connect
+
+
+def test_key_includes_credentials():
+    key = SSHTransportPool.key
+    base = ssh_connect('10.0.0.1', 'root', 'pw')
+    assert key(base) == key(ssh_connect('10.0.0.1', 'root', 'pw'))
+    assert key(base) != key(ssh_connect('10.0.0.1', 'root', 'other'))
+    assert key(base) != key(ssh_connect('10.0.0.1', 'root'))
+    assert key(base) != key(ssh_connect('10.0.0.1', 'root', privateKey='pw'))
+    assert 'pw' not in repr(key(base))
+
+
+def test_pool_is_opt_in():
+    assert ssh_connect('10.0.0.1', 'root', 'pw').pool is None
+    pool = SSHTransportPool()
+    assert ssh_connect('10.0.0.1', 'root', 'pw', pool=pool).pool is pool
@@ -0,0 +1,27 @@
+from ssh_sync import parse_sha256sum, _unescape
+
+A = 'a' * 64
+B = 'b' * 64
+
+
+def test_parse_plain_names():
+    text = '%s  ./x.txt\n%s  ./dir/y z.bin\n' % (A, B)
+    assert parse_sha256sum(text) == {'x.txt': A, 'dir/y z.bin': B}
+
+
+def test_parse_escaped_newline():
+    assert parse_sha256sum('\\%s  ./a\\nb\n' % A) == {'a\nb': A}
+
+
+def test_parse_escaped_backslash_before_n():
+    # file named a\nb with a literal backslash, not a newline
+    assert parse_sha256sum('\\%s  ./a\\\\nb\n' % A) == {'a\\nb': A}
+
+
+def test_unescape_single_pass():
+    assert _unescape('\\\\\\n') == '\\\n'
+    assert _unescape('x\\\\\\\\y') == 'x\\\\y'
+
+
+def test_parse_skips_garbage():
+    assert parse_sha256sum('sha256sum: ./gone: No such file\n') == {}